@@ -0,0 +1,568 @@
+import argparse
+import heapq
+import json
+import time
+from collections import deque
+import maps
+
+
+__version__ = "2.1.1"
+__author__ = "FloatingInt"
+
+
+WALL = ord(maps.WALL)
+DOOR = ord(maps.SYMBOLS["door"])
+MAX_STATES = 50000  # shortest path search gives up past this, see 'route'
+
+
+def link(links: list, edges: list, a: int, b: int) -> None:
+    """Adds an edge to a graph
+
+    Args:
+        links (list): node -> [(node, edge)]
+        edges (list): edge -> (node, node)
+        a (int): node at one end
+        b (int): node at other end
+    """
+    links[a].append((b, len(edges)))
+    links[b].append((a, len(edges)))
+    edges.append((a, b))
+
+
+class Analyzer:
+    """Checks that a map can be finished.
+
+    The map is split once into regions: cells connected without passing
+    a wall or door. Solvability and reachable keys are found on the graph
+    of regions and doors, where a door is linked to the regions and doors
+    next to it. Shortest paths are searched over
+    (point of interest, collected keys bitmask) states, with cell distances
+    between points of interest measured only when needed. The search only
+    uses doors that lead towards the goal or loop back as a shortcut, and
+    keys of those doors, found on the region graph. If it still gives up, a feasible route is reported
+
+    A key is used up by the door it opens, so the model is exact when every
+    door has its own key id. Doors sharing an id are reported as a warning
+    and treated as opened by any key of that id
+    """
+
+    def __init__(self, data: maps.MapData) -> None:
+        """Splits map into regions
+
+        Args:
+            data (maps.MapData): compiled map
+        """
+        self.width = data.width
+        self.height = data.height
+        self.spawns = data.spawns
+        # grid with a border of walls, no bounds checks needed
+        self.stride = self.width + 2
+        self.tiles = bytearray([WALL]) * (self.stride * (self.height + 2))
+        for y in range(self.height):
+            start = self.cell(0, y)
+            self.tiles[start:start + self.width] = data.grid[y * self.width:(y + 1) * self.width]
+        self.offsets = (1, -1, self.stride, -self.stride)
+        self.keys = []  # (id, x, y)
+        self.doors = []  # (id, x, y)
+        self.goals = []  # (x, y)
+        for kind, id, _color, x, y in data.structures:
+            if kind == "key":
+                self.keys.append((id, x, y))
+            elif kind == "door":
+                self.doors.append((id, x, y))
+            else:
+                self.goals.append((x, y))
+        ids = sorted({id for id, _x, _y in self.keys + self.doors})
+        self.bits = {id: 1 << index for index, id in enumerate(ids)}
+        self.points = {}  # cell -> (kind, id) of every key, door and goal
+        for id, x, y in self.keys:
+            self.points[self.cell(x, y)] = ("key", id)
+        for id, x, y in self.doors:
+            self.points[self.cell(x, y)] = ("door", id)
+        for x, y in self.goals:
+            self.points[self.cell(x, y)] = ("goal", 0)
+        self.started = time.perf_counter()
+        self.region = [-1] * len(self.tiles)  # cell -> region, -1 if wall or door
+        self.count = 0  # number of regions
+        self.label()
+        self.keys_in = {}  # region -> keys in it
+        for key in self.keys:
+            self.keys_in.setdefault(
+                self.region[self.cell(key[1], key[2])], []).append(key)
+        # graph of regions and doors: regions are nodes 0 to count - 1, door n is node count + n
+        self.links = [[] for _ in range(self.count + len(self.doors))]  # node -> [(node, edge)]
+        self.edges = []  # edge -> (node, node), a door and a region once per side they share
+        index_of = {self.cell(x, y): index for index, (_id, x, y) in enumerate(self.doors)}
+        for index, (_id, x, y) in enumerate(self.doors):
+            cell = self.cell(x, y)
+            for offset in self.offsets:
+                near = cell + offset
+                if self.region[near] != -1:
+                    link(self.links, self.edges, self.region[near], self.count + index)
+                elif index_of.get(near, -1) > index:
+                    link(self.links, self.edges, self.count + index, self.count + index_of[near])
+        self.distances = {}  # cell of point -> {cell of point: steps}
+        self.seen = [0] * len(self.tiles)  # cell -> stamp of last search seeing it
+        self.stamp = 0
+
+    def cell(self, x: int, y: int) -> int:
+        """Index of a position in the bordered grid
+
+        Args:
+            x (int): x position
+            y (int): y position
+
+        Returns:
+            int: index of cell
+        """
+        return (y + 1) * self.stride + x + 1
+
+    def label(self) -> None:
+        """Labels every walkable cell with its region, one pass over the grid
+        """
+        tiles, region, offsets = self.tiles, self.region, self.offsets
+        for start in range(len(region)):
+            if region[start] != -1 or tiles[start] == WALL or tiles[start] == DOOR:
+                continue
+            region[start] = self.count
+            queue = [start]
+            for cell in queue:  # grows while iterating
+                for offset in offsets:
+                    near = cell + offset
+                    if region[near] == -1 and tiles[near] != WALL and tiles[near] != DOOR:
+                        region[near] = self.count
+                        queue.append(near)
+            self.count += 1
+
+    def reachable(self, x: int, y: int, opened: set = frozenset()) -> tuple:
+        """Regions and keys reachable by one player, on the region graph.
+        Doors open once the player collected a key with their id
+
+        Args:
+            x (int): x position
+            y (int): y position
+            opened (set, optional): (id, x, y) of doors opened by other players. Defaults to frozenset().
+
+        Returns:
+            tuple: sets of regions reached, (id, x, y) keys collected and doors passed
+        """
+        start = self.region[self.cell(x, y)]
+        reached = {start}  # regions and doors passed, as nodes
+        collected = set()
+        ids = set()
+        waiting = {}  # key id -> nodes of doors found but locked
+        queue = deque([start])
+        while queue:
+            current = queue.popleft()
+            unlocked = []
+            for key in self.keys_in.get(current, ()):
+                collected.add(key)
+                if key[0] not in ids:
+                    ids.add(key[0])
+                    unlocked += waiting.pop(key[0], [])
+            for near, _edge in self.links[current]:
+                if near in reached:
+                    continue
+                if near < self.count:
+                    reached.add(near)  # region, past the door being passed
+                    queue.append(near)
+                    continue
+                door = self.doors[near - self.count]
+                if door[0] in ids or door in opened:
+                    unlocked.append(near)
+                else:
+                    waiting.setdefault(door[0], []).append(near)
+            for near in unlocked:
+                if near not in reached:
+                    reached.add(near)
+                    queue.append(near)
+        regions = {node for node in reached if node < self.count}
+        passed = {self.doors[node - self.count] for node in reached if node >= self.count}
+        return regions, collected, passed
+
+    def team(self) -> tuple:
+        """Regions and keys reachable by all players together.
+        Keys are held by one player, doors opened stay open for everyone
+
+        Returns:
+            tuple: sets of regions reached and (id, x, y) keys collected
+        """
+        opened = set()
+        changed = True
+        while changed:
+            changed = False
+            regions, collected = set(), set()
+            for _cid, x, y in self.spawns:
+                reached, keys, passed = self.reachable(x, y, opened)
+                regions |= reached
+                collected |= keys
+                if not passed <= opened:
+                    opened |= passed
+                    changed = True
+        return regions, collected
+
+    def measure(self, start: int) -> dict:
+        """Steps from a point of interest to every point of interest
+        it reaches without passing another door. Cached
+
+        Args:
+            start (int): cell of point of interest
+
+        Returns:
+            dict: cell -> steps
+        """
+        if start in self.distances:
+            return self.distances[start]
+        tiles, points, seen = self.tiles, self.points, self.seen
+        self.stamp += 1
+        stamp = self.stamp  # marks cells seen by this search
+        seen[start] = stamp
+        found = {}
+        frontier = [start]
+        distance = 0
+        while frontier:
+            distance += 1
+            following = []
+            for cell in frontier:
+                for offset in self.offsets:
+                    near = cell + offset
+                    if seen[near] == stamp or tiles[near] == WALL:
+                        continue
+                    seen[near] = stamp
+                    if near in points:
+                        found[near] = distance
+                    if tiles[near] != DOOR:
+                        following.append(near)  # do not walk through doors
+            frontier = following
+        self.distances[start] = found
+        return found
+
+    def estimate(self, cell: int) -> int:
+        """Steps to the nearest goal if nothing was in the way
+
+        Args:
+            cell (int): index of cell
+
+        Returns:
+            int: manhattan distance, never more than the real distance
+        """
+        y, x = divmod(cell, self.stride)
+        return min(abs(x - 1 - goal_x) + abs(y - 1 - goal_y)
+                   for goal_x, goal_y in self.goals)
+
+    def block(self, start: int, targets: set) -> set:
+        """Regions and doors a path from a region to any target region can
+        use. On the graph of regions and doors, these are the nodes of the
+        biconnected block holding a virtual edge from start to a node joined
+        to every target, and of every block with a cycle hanging off one of
+        its regions, as a path may leave a region and come back to it.
+        Other doors lead to dead ends, entered and left through the same cell
+
+        Args:
+            start (int): region to start from
+            targets (set): regions to reach
+
+        Returns:
+            set: nodes of blocks, regions as is and doors as count + index of door
+        """
+        sink = len(self.links)
+        links = [list(near) for near in self.links] + [[]]
+        edges = list(self.edges)
+        for target in targets:
+            link(links, edges, target, sink)
+        virtual = len(edges)
+        link(links, edges, start, sink)
+        # iterative Tarjan, edges of a block are popped together
+        order = [0] * len(links)  # node -> discovery time, 0 if not seen
+        low = [0] * len(links)
+        order[start] = low[start] = 1
+        time = 1
+        stack = []  # edges of blocks not yet complete
+        main = {start}  # nodes of block with the virtual edge
+        cycles = {}  # region -> nodes of other blocks with a cycle through it
+        work = [(start, -1, iter(links[start]))]
+        while work:
+            node, through, following = work[-1]
+            for near, edge in following:
+                if edge == through:
+                    continue
+                if not order[near]:
+                    time += 1
+                    order[near] = low[near] = time
+                    stack.append(edge)
+                    work.append((near, edge, iter(links[near])))
+                    break
+                if order[near] < order[node]:
+                    low[node] = min(low[node], order[near])
+                    stack.append(edge)  # back edge
+            else:
+                work.pop()
+                if not work:
+                    break
+                parent = work[-1][0]
+                low[parent] = min(low[parent], low[node])
+                if low[node] >= order[parent]:
+                    component = []
+                    while True:
+                        edge = stack.pop()
+                        component.append(edge)
+                        if edge == through:
+                            break
+                    nodes = {end for edge in component for end in edges[edge]} - {sink}
+                    if virtual in component:
+                        main = nodes
+                    elif len(component) > 1:
+                        for member in nodes:
+                            if member < self.count:
+                                cycles.setdefault(member, []).append(nodes)
+        found = set(main)
+        queue = [node for node in main if node < self.count]
+        for region in queue:  # grows while iterating
+            for nodes in cycles.get(region, ()):
+                for node in nodes - found:
+                    found.add(node)
+                    if node < self.count:
+                        queue.append(node)
+        return found
+
+    def relevant(self, x: int, y: int) -> tuple:
+        """Doors worth opening from a position: doors on a way to a goal,
+        or to the key of such a door, and doors of shortcuts along them.
+        Other doors lead to dead ends
+
+        Args:
+            x (int): x position
+            y (int): y position
+
+        Returns:
+            tuple: cells of relevant doors and ids of keys worth collecting
+        """
+        start = self.region[self.cell(x, y)]
+        targets = {self.region[self.cell(goal_x, goal_y)] for goal_x, goal_y in self.goals}
+        while True:
+            nodes = self.block(start, targets)
+            doors = [self.doors[node - self.count] for node in nodes if node >= self.count]
+            ids = {id for id, _x, _y in doors}
+            more = targets | {self.region[self.cell(key_x, key_y)]
+                              for id, key_x, key_y in self.keys if id in ids}
+            if more == targets:
+                return {self.cell(door_x, door_y) for _id, door_x, door_y in doors}, ids
+            targets = more
+
+    def shortest(self, x: int, y: int) -> tuple:
+        """Shortest completion path from a position.
+        A* over (point of interest, collected keys bitmask),
+        skipping doors and keys that do not lead towards a goal
+
+        Args:
+            x (int): x position
+            y (int): y position
+
+        Returns:
+            tuple: steps and list of points visited, (None, None) if not solvable or too large
+        """
+        kinds = self.points
+        doors, useful = self.relevant(x, y)
+        start = self.cell(x, y)
+        best = {(start, 0): 0}
+        previous = {}
+        heap = [(self.estimate(start), 0, start, 0)]
+        while heap:
+            _guess, cost, cell, mask = heapq.heappop(heap)
+            if best.get((cell, mask), cost) < cost:
+                continue  # outdated
+            if kinds.get(cell, ("",))[0] == "goal":
+                return cost, self.trace(previous, (cell, mask), kinds)
+            if len(best) > MAX_STATES:
+                return None, None
+            for target, steps in self.measure(cell).items():
+                kind, id = kinds[target]
+                new_mask = mask
+                if kind == "key":
+                    if mask & self.bits[id] or id not in useful:
+                        continue  # nothing to gain, paths pass over it anyway
+                    new_mask |= self.bits[id]
+                elif kind == "door" and (target not in doors or not mask & self.bits.get(id, 0)):
+                    continue  # locked, or leads to a dead end
+                state = (target, new_mask)
+                if cost + steps < best.get(state, cost + steps + 1):
+                    best[state] = cost + steps
+                    previous[state] = (cell, mask)
+                    heapq.heappush(heap, (cost + steps + self.estimate(target),
+                                          cost + steps, target, new_mask))
+        return None, None
+
+    def route(self, x: int, y: int) -> tuple:
+        """Feasible completion path from a position, not always the shortest.
+        Walks to the nearest goal once one is open, else to the nearest
+        key worth collecting, over the distances of 'measure'
+
+        Args:
+            x (int): x position
+            y (int): y position
+
+        Returns:
+            tuple: steps and list of points visited, (None, None) if not solvable
+        """
+        kinds = self.points
+        doors, useful = self.relevant(x, y)
+        cell = self.cell(x, y)
+        mask = 0
+        steps = 0
+        path = []
+        while True:
+            # Dijkstra from cell, through doors already opened
+            best = {cell: 0}
+            previous = {}
+            heap = [(0, cell)]
+            goal = key = None
+            while heap:
+                cost, current = heapq.heappop(heap)
+                if best[current] < cost:
+                    continue  # outdated
+                kind, id = kinds.get(current, ("", 0))
+                if kind == "goal":
+                    goal = current
+                    break
+                if kind == "key" and key == None and id in useful and not mask & self.bits[id]:
+                    key = current  # nearest, in case no goal is open
+                for target, distance in self.measure(current).items():
+                    kind, id = kinds[target]
+                    if kind == "door" and (target not in doors or not mask & self.bits.get(id, 0)):
+                        continue
+                    if cost + distance < best.get(target, cost + distance + 1):
+                        best[target] = cost + distance
+                        previous[target] = current
+                        heapq.heappush(heap, (cost + distance, target))
+            end = goal if goal != None else key
+            if end == None:
+                return None, None
+            steps += best[end]
+            walked = []
+            point = end
+            while point != cell:
+                walked.append(self.describe(point, kinds))
+                point = previous[point]
+            path += reversed(walked)
+            if goal != None:
+                return steps, path
+            mask |= self.bits[kinds[key][1]]
+            cell = key
+
+    def describe(self, cell: int, kinds: dict) -> str:
+        """Describes a point of interest for paths
+
+        Args:
+            cell (int): cell of point
+            kinds (dict): cell -> (kind, id)
+
+        Returns:
+            str: f"{kind} {id} at {x},{y}", without id for goals
+        """
+        kind, id = kinds[cell]
+        y, x = divmod(cell, self.stride)
+        x, y = x - 1, y - 1
+        return f"{kind} at {x},{y}" if kind == "goal" else f"{kind} {id} at {x},{y}"
+
+    def trace(self, previous: dict, state: tuple, kinds: dict) -> list:
+        """Points visited on the way to a state
+
+        Args:
+            previous (dict): state -> state it was reached from
+            state (tuple): last state
+            kinds (dict): cell -> (kind, id)
+
+        Returns:
+            list: f"{kind} {id} at {x},{y}" of each point, in order
+        """
+        path = []
+        while state in previous:
+            path.append(self.describe(state[0], kinds))
+            state = previous[state]
+        path.reverse()
+        return path
+
+    def report(self) -> dict:
+        """Solvability, shortest path per spawn and unreachable keys.
+        Where the shortest path search gives up, the path of 'route' is
+        reported with "exact" False
+
+        Returns:
+            dict: report, ready for json
+        """
+        warnings = []
+        if not self.goals:
+            warnings.append("map has no goal")
+        if not self.spawns:
+            warnings.append("map has no spawns")
+        door_ids = [id for id, _x, _y in self.doors]
+        key_ids = {id for id, _x, _y in self.keys}
+        for id in sorted(set(door_ids)):
+            if door_ids.count(id) > 1:
+                warnings.append(f"doors with id {id} share their keys")
+            if id not in key_ids:
+                warnings.append(f"door {id} has no key")
+        goals = {self.region[self.cell(x, y)] for x, y in self.goals}
+        spawns = {}
+        for cid, x, y in self.spawns:
+            alone = not goals.isdisjoint(self.reachable(x, y)[0])
+            steps, path = self.shortest(x, y) if alone else (None, None)
+            exact = steps != None
+            if alone and not exact:
+                steps, path = self.route(x, y)
+            spawns[cid] = {"solvable": alone, "steps": steps, "path": path, "exact": exact}
+        regions, collected = self.team()
+        return {
+            "solvable": not goals.isdisjoint(regions),
+            "regions": self.count,
+            "doors": len(self.doors),
+            "spawns": spawns,
+            "unreachable_keys": [f"key {id} at {x},{y}" for id, x, y in self.keys
+                                 if (id, x, y) not in collected],
+            "warnings": warnings,
+            "seconds": round(time.perf_counter() - self.started, 4),
+        }
+
+
+def analyze(data: maps.MapData) -> dict:
+    """Analyzes a compiled map
+
+    Args:
+        data (maps.MapData): compiled map
+
+    Returns:
+        dict: report, see 'Analyzer.report'
+    """
+    return Analyzer(data).report()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Checks that Temple Treasure maps can be finished")
+    parser.add_argument("maps", nargs="+", help="map files to check")
+    parser.add_argument("--json", action="store_true",
+                        help="print reports as json")
+    args = parser.parse_args()
+    failed = False
+    for name in args.maps:
+        report = analyze(maps.load(name))
+        failed = failed or not report["solvable"]
+        if args.json:
+            print(json.dumps({name: report}))
+            continue
+        state = "\u001b[32;1msolvable" if report["solvable"] else "\u001b[31;1mnot solvable"
+        print(f"{name}: {state}\u001b[0m ({report['regions']} regions, "
+              f"{report['doors']} doors, {report['seconds'] * 1000:.1f} ms)")
+        for cid, spawn in report["spawns"].items():
+            if spawn["steps"] != None:
+                shortest = "" if spawn["exact"] else " (not the shortest)"
+                print(f"- Spawn {cid}: {spawn['steps']} steps{shortest}, " + ", ".join(spawn["path"]))
+            elif spawn["solvable"]:
+                print(f"- Spawn {cid}: can finish, path search gave up")
+            else:
+                print(f"- Spawn {cid}: cannot finish alone")
+        for key in report["unreachable_keys"]:
+            print(f"- Unreachable {key}")
+        for warning in report["warnings"]:
+            print(f"\u001b[33;1m[Warning]\u001b[0m {warning}")
+    exit(1 if failed else 0)
@@ -4,15 +4,22 @@ import socket
 import sys
 import os
 import keyboard
+from collections import deque
 from typing import Any
+import protocol
 
 
 __version__ = "2.1.1"
 __author__ = "FloatingInt"
 
+# key -> (x direction, y direction)
+KEYS = {"w": (0, -1), "s": (0, 1), "a": (-1, 0), "d": (1, 0)}
+
 
 class Clock:
-    """Clock to make sure the mainloop don't run too fast
+    """Clock to make sure the mainloop don't run too fast.
+    Ticks fall on fixed deadlines of a monotonic clock,
+    so a late wake up does not delay later ticks
     """
 
     def __init__(self, tps: float) -> None:
@@ -22,19 +29,154 @@ class Clock:
             tps (float): ticks per second
         """
         self.tps = tps
-        self.last = time.time()
+        self.interval = 1.0 / tps
+        self.deadline = time.monotonic()
+
+    def tick(self, wake: threading.Event = None) -> bool:
+        """Waits until the next deadline, or until wake is set.
+        Waking early does not use up the deadline
+
+        Args:
+            wake (threading.Event, optional): event to return early on. Defaults to None.
+
+        Returns:
+            bool: True if woken early
+        """
+        delay = self.deadline + self.interval - time.monotonic()
+        if wake != None and wake.wait(max(delay, 0)):
+            return True
+        if wake == None and delay > 0:
+            time.sleep(delay)
+        self.deadline += self.interval
+        if time.monotonic() - self.deadline > self.interval:
+            self.deadline = time.monotonic()  # fell behind, skip missed ticks
+        return False
+
+
+class Renderer:
+    """Draws content to the terminal. After the first frame only cells
+    changed since the last frame are written, with cursor-addressed ANSI
+    sequences, at most 'fps' times per second.
+    The cursor rests on the top left cell of the map between frames
+    """
+
+    def __init__(self, fps: float = 30) -> None:
+        """Renderer with nothing on screen
+
+        Args:
+            fps (float, optional): maximum frames per second. Defaults to 30.
+        """
+        self.fps = fps
+        self.lock = threading.Lock()  # guards content and terminal
+        self.content = None  # latest content requested
+        self.cells = set()  # (x, y) changed since last frame
+        self.full = True  # compare every cell next frame
+        self.last = None  # frame on screen
+        self.wake = threading.Event()
+
+    def request(self, content: list, cells: list = None) -> None:
+        """Asks for content to be drawn with the next frame
+
+        Args:
+            content (list): 2D array (with str elements) to draw
+            cells (list, optional): (x, y) of changed cells, None if unknown. Defaults to None.
+        """
+        with self.lock:
+            if cells == None or content is not self.content:
+                self.full = True
+            else:
+                self.cells.update(cells)
+            self.content = content
+        self.wake.set()
 
-    def tick(self) -> None:
-        """Waits until time since last tick is
-        greater than or equal to 1 second / ticks per second
+    def run(self, running: Any) -> None:
+        """Draws requested frames until running returns False. Own thread
+
+        Args:
+            running (Callable): returns False to stop
+        """
+        interval = 1.0 / self.fps
+        while running():
+            if not self.wake.wait(0.1):
+                continue
+            self.wake.clear()
+            start = time.monotonic()
+            self.draw()
+            delay = interval - (time.monotonic() - start)
+            if delay > 0:
+                time.sleep(delay)  # cap fps
+
+    def draw(self) -> None:
+        """Writes the difference between the last frame and content
+        """
+        with self.lock:
+            if self.content == None:
+                return
+            content = self.content
+            out = []
+            last = self.last
+            if last == None or [len(row) for row in last] != [len(row) for row in content]:
+                # first frame or new size, draw everything
+                if last != None:
+                    out.append("\u001b[J")  # clear old frame
+                out.append("\n".join("".join(row) for row in content))
+                up = len(content) - 1
+                out.append(f"\u001b[{up}A\r" if up > 0 else "\r")
+                self.last = [list(row) for row in content]
+            elif self.full:
+                for y, row in enumerate(content):
+                    if row == last[y]:
+                        continue
+                    x = 0
+                    while x < len(row):
+                        if row[x] == last[y][x]:
+                            x += 1
+                            continue
+                        start = x
+                        while x < len(row) and row[x] != last[y][x]:
+                            x += 1
+                        out.append(self.at(start, y, "".join(row[start:x])))
+                    last[y] = list(row)
+            else:
+                for x, y in self.cells:
+                    cell = content[y][x]
+                    if cell != last[y][x]:
+                        out.append(self.at(x, y, cell))
+                        last[y][x] = cell
+            self.cells.clear()
+            self.full = False
+            if out:
+                sys.stdout.write("".join(out))
+                sys.stdout.flush()
+
+    def write(self, x: int, y: int, text: str) -> None:
+        """Writes text relative to the top left cell of the map
+
+        Args:
+            x (int): column
+            y (int): row
+            text (str): text to write
         """
-        now = time.time()
-        tick_rate = 1.0 / self.tps
-        diff = now - self.last
-        recover = tick_rate - diff
-        if recover > 0:
-            time.sleep(recover)
-        self.last = time.time()
+        with self.lock:
+            sys.stdout.write(self.at(x, y, text))
+            sys.stdout.flush()
+
+    def at(self, x: int, y: int, text: str) -> str:
+        """ANSI sequence writing text at a position
+        and moving the cursor back to the top left cell
+
+        Args:
+            x (int): column
+            y (int): row
+            text (str): text to write
+
+        Returns:
+            str: escape sequences and text
+        """
+        down = f"\u001b[{y}B" if y else ""
+        right = f"\u001b[{x}C" if x else ""
+        up = f"\u001b[{y}A" if y else ""
+        return down + right + text + "\r" + up
 
 
 class App:
@@ -42,12 +184,15 @@ class App:
     Equivalent to a Client (serverside implementation)
     """
 
-    def __init__(self, host="vps.i-h.no", port=5050) -> None:
+    def __init__(self, host="vps.i-h.no", port=5050, fps: float = 30, compress: bool = True, udp: bool = False) -> None:
         """Init App (Client) and automatically start it
 
         Args:
             host (str, optional): server host. Defaults to "vps.i-h.no".
             port (int, optional): server port. Defaults to 5050.
+            fps (float, optional): maximum redraws per second. Defaults to 30.
+            compress (bool, optional): ask the server for compressed frames. Defaults to True.
+            udp (bool, optional): ask the server for a datagram channel. Defaults to False.
 
         Raises:
             ConnectionResetError: failed to recieve loading data from Server
@@ -55,6 +200,16 @@ class App:
         self.running = True
         self.port = port
         self.host = host
+        self.renderer = Renderer(fps)
+        self.held = set()  # movement keys held down
+        self.origin = (0, 0)  # position of viewport on the map
+        self.pressed = threading.Event()  # a movement key went down
+        self.udp = None  # datagram socket, once the server gave a token
+        self.token = 0  # token of datagram channel
+        self.udp_sent = 0  # last sequence number sent
+        self.udp_received = 0  # last sequence number received
+        self.recent = deque(maxlen=64)  # (seq, value) of last datagram deltas
+        self.mark = None  # deltas included in the next content, from "seq"
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:  # try to connect to server
             self.connecting = True  # loading decoration
@@ -80,14 +235,20 @@ class App:
             exit()  # exit program
 
         try:  # get client index from server
-            raw = self.socket.recv(1024).decode("utf-8")
-            index, server_size, content = raw.split("$")
+            self.frames = protocol.FrameReader(inflate=True)
+            self.backlog = []  # frames received with the handshake
+            while not self.backlog:
+                data = self.socket.recv(65536)
+                if not data:
+                    raise ConnectionResetError
+                self.backlog = self.frames.feed(data)
+            _kind, payload = self.backlog.pop(0)
+            index, server_size, content = payload.decode("utf-8").split("$", 2)
             if index == "":
                 raise ConnectionResetError
             else:
-                self.cid = int(index)  # from server
+                self.cid = int(index)  # from server, 0 for spectators
                 self.server_size = int(server_size)
-                self.update(content)  # content is single string
         except ConnectionResetError:
             self.running = False
             self.connecting = False
@@ -95,9 +256,7 @@ class App:
             print("\n-- Disconnected from server --")
             exit()
 
-        def func(item):
-            return list(item)
-        self.content = list(map(func, content.split("\n")))
+        self.content = self.parse(content)
 
         if self.cid > self.server_size:
             self.running = False
@@ -106,6 +265,14 @@ class App:
             print(
                 "\u001b[30;1m==  \u001b[31;1mDisconnected  \u001b[30;1m==\u001b[0m")
             exit()
+        self.spectator = self.cid == 0  # read-only, digit keys switch room
+        if compress and not self.spectator:
+            self.rpc_send("compress", 1)  # frames are inflated by self.frames
+        if udp and not self.spectator:
+            self.rpc_send("udp", 1)  # answered with a token
+        self.update()
+        threading.Thread(target=self.renderer.run, args=(lambda: self.running,),
+                         name="Render").start()
         # start visual loading...
         threading.Thread(target=self.rpc_listen, name="RPC Listen").start()
         self.mainloop()
@@ -128,13 +295,43 @@ class App:
             time.sleep(0.1)
         print("." * (3 - i) + "\u001b[0m")  # also newline
 
-    def update(self, content: str) -> None:
-        """Updated content is rendered to screen
+    def parse(self, content: str) -> list:
+        """Parses content string into a 2D array of cells.
+        Colored symbols are kept as one cell, same as on the server
 
         Args:
-            content (str): string to render to screen
+            content (str): content as one string
+
+        Returns:
+            list: 2D array (with str elements)
         """
-        print(content, end="\u001b[9A\r")
+        return protocol.parse_content(content)
+
+    def apply_delta(self, value: str) -> None:
+        """Applies changed cells to local content.
+        Requests a full keyframe if the delta does not fit local content
+
+        Format of argument value: f"{x},{y},{cell}|{x},{y},{cell}..."
+
+        Args:
+            value (str): changed cells
+        """
+        try:
+            with self.renderer.lock:
+                changes = protocol.apply_delta(
+                    self.content, value, self.origin)
+        except (ValueError, IndexError):
+            self.rpc_send("sync", 1)  # out of sync
+            return
+        self.update([(x, y) for x, y, _cell in changes])
+
+    def update(self, cells: list = None) -> None:
+        """Updated content is rendered to screen with the next frame
+
+        Args:
+            cells (list, optional): (x, y) of changed cells, None if all. Defaults to None.
+        """
+        self.renderer.request(self.content, cells)
 
     def rpc_send(self, attr: str, value: Any) -> None:
         """Requesting the server to update
@@ -147,10 +344,19 @@ class App:
             attr (str): name of attribute to update
             value (str): value to update atribute to
         """
-        string = f"{self.cid}${attr}${value}"
-        data = bytes(string, "utf-8")
+        if attr in ("x", "y"):
+            self.send_move(protocol.pack_move(self.cid, attr, value))
+            return
+        self.send(protocol.pack_text(f"{self.cid}${attr}${value}"))
+
+    def send(self, data: bytes) -> None:
+        """Sends packed frames to the server
+
+        Args:
+            data (bytes): one or more frames
+        """
         try:
-            self.socket.send(data)
+            self.socket.sendall(data)
         except ConnectionResetError:
             self.running = False
             self.socket.close()
@@ -158,15 +364,81 @@ class App:
             print(
                 "\u001b[30;1m-- \u001b[31;1mDisconnected or kicked \u001b[30;1m--\u001b[0m\n")
 
+    def send_move(self, data: bytes) -> None:
+        """Sends a move frame, as a datagram if the channel is open
+
+        Args:
+            data (bytes): packed move or step frame
+        """
+        if self.udp == None:
+            self.send(data)
+            return
+        self.udp_sent += 1
+        try:
+            self.udp.send(protocol.pack_datagram(self.token, self.udp_sent, data))
+        except OSError:
+            self.send(data)  # channel broken, stream still works
+
+    def open_udp(self, token: int) -> None:
+        """Opens the datagram channel given by the server
+
+        Args:
+            token (int): token of channel
+        """
+        if self.udp != None:
+            return
+        self.token = token
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.connect((self.host, self.port))
+        self.send_move(b"")  # tells the server where to send deltas
+        threading.Thread(target=self.udp_listen, name="UDP Listen").start()
+
+    def udp_listen(self) -> None:
+        """Listens for deltas on the datagram channel.
+        Stale and duplicate datagrams are dropped, a gap asks for a keyframe
+        """
+        self.udp.settimeout(0.5)
+        while self.running:
+            try:
+                data = self.udp.recv(65536)
+                token, seq, frames = protocol.unpack_datagram(data)
+            except socket.timeout:
+                continue
+            except ValueError:
+                continue  # malformed
+            except OSError:
+                return  # closed
+            if token != self.token or seq <= self.udp_received:
+                continue  # stale or duplicate
+            if seq != self.udp_received + 1:
+                self.rpc_send("sync", 1)  # lost some
+            self.udp_received = seq
+            for kind, payload in frames:
+                if kind != protocol.TEXT:
+                    continue
+                try:
+                    attr, value = payload.decode("utf-8").split("$", 1)
+                except (ValueError, UnicodeDecodeError):
+                    continue  # malformed
+                if attr.startswith("delta"):
+                    self.recent.append((seq, value))
+                    self.apply_delta(value)
+        self.udp.close()
+
     def rpc_listen(self) -> None:
         """Listens to the server for updates or messages
         """
+        for kind, payload in self.backlog:
+            if kind == protocol.TEXT:
+                self.on_recv(payload.decode("utf-8"))
         while self.running:
             try:
-                msg = self.socket.recv(1024)  # is bytes
-                if not msg:  # if empty msg
+                data = self.socket.recv(65536)  # is bytes
+                if not data:  # if empty msg
                     continue
-                self.on_recv(msg.decode("utf-8"))
+                for kind, payload in self.frames.feed(data):
+                    if kind == protocol.TEXT:
+                        self.on_recv(payload.decode("utf-8"))
             except ConnectionResetError as error:
                 self.running = False
                 self.socket.close()
@@ -191,13 +463,31 @@ class App:
             message (str): message received
         """
         try:
-            # rest is either possible duplicant or possibly double message combined
-            attr, value, *_rest = message.split("$")
+            attr, value = message.split("$", 1)
         except ValueError:
             return  # ignore error. ignore request
         if attr.startswith("content"):
-            self.content = value
-            self.update(value)
+            content = self.parse(value)
+            with self.renderer.lock:
+                self.content = content
+                if self.mark != None:  # datagrams may overtake the stream
+                    for seq, delta in tuple(self.recent):
+                        if seq > self.mark:
+                            try:
+                                protocol.apply_delta(content, delta, self.origin)
+                            except (ValueError, IndexError):
+                                pass  # older viewport
+                    self.mark = None
+            self.update()
+        elif attr.startswith("seq"):
+            self.mark = int(value)  # content follows
+        elif attr.startswith("udp"):
+            if value != "0":
+                self.open_udp(int(value, 16))
+        elif attr.startswith("view"):
+            self.origin = protocol.parse_view(value)  # content follows
+        elif attr.startswith("delta"):
+            self.apply_delta(value)
         elif attr.startswith("kick"):
             self.running = False
             self.socket.close()
@@ -205,29 +495,66 @@ class App:
             print(
                 "\u001b[30;1m-- \u001b[31;1mKicked from server \u001b[30;1m--\u001b[0m\n")
         elif attr.startswith("finished"):
-            print("\u001b[3B\u001b[62C" + "\u001b[32;1m" +
-                  "Finished" + "\u001b[0m" + "\u001b[3A", end="\r")
+            width = max(len(line) for line in self.content)
+            self.renderer.write(width + 2, 3, "\u001b[32;1m" +
+                                "Finished" + "\u001b[0m")
+
+    def on_key(self, event: Any) -> None:
+        """Keyboard hook. Tracks movement keys held down.
+        Spectators switch to the room of a digit key instead
+
+        Args:
+            event (keyboard.KeyboardEvent): key event
+        """
+        if self.spectator:
+            if event.event_type == keyboard.KEY_DOWN and event.name.isdigit():
+                self.rpc_send("watch", event.name)  # answered with the content of that room
+            return
+        if event.name not in KEYS:
+            return
+        if event.event_type == keyboard.KEY_DOWN:
+            if event.name not in self.held:
+                self.held.add(event.name)
+                self.pressed.set()  # send without waiting for next tick
+        else:
+            self.held.discard(event.name)
+
+    def direction(self) -> tuple:
+        """Combined direction of the movement keys held down
+
+        Returns:
+            tuple: x and y direction, opposite keys cancel out
+        """
+        dx = dy = 0
+        for name in tuple(self.held):
+            x, y = KEYS[name]
+            dx += x
+            dy += y
+        return dx, dy
 
     def mainloop(self) -> None:
-        """Mainloop to handle input from the user
+        """Mainloop to handle input from the user.
+        Sends at most one combined movement message per tick,
+        and one right away when a key goes down
         """
         clock = Clock(8)
-        while self.running:
-            clock.tick()
-            # y-axis
-            if keyboard.is_pressed("w"):
-                self.rpc_send("y", -1)
-            if keyboard.is_pressed("s"):
-                self.rpc_send("y", 1)
-            # x-axis
-            if keyboard.is_pressed("a"):
-                self.rpc_send("x", -1)
-            if keyboard.is_pressed("d"):
-                self.rpc_send("x", 1)
+        keyboard.hook(self.on_key)
+        early = False  # sent early this tick
+        try:
+            while self.running:
+                woke = clock.tick(None if early else self.pressed)
+                self.pressed.clear()
+                early = woke
+                dx, dy = self.direction()
+                if dx or dy:
+                    self.send_move(protocol.pack_step(self.cid, dx, dy))
+        finally:
+            keyboard.unhook_all()
 
 
 if __name__ == "__main__":
     # activate ANSI ESCAPE codes
     os.system("")
     # init
-    app = App(port=5050, host="127.0.0.1")
+    port = 5051 if "--spectate" in sys.argv else 5050  # spectator port of server
+    app = App(port=port, host="127.0.0.1")
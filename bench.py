@@ -0,0 +1,259 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import maps
+import server
+
+
+__version__ = "2.1.1"
+__author__ = "FloatingInt"
+
+
+def measure(func, rounds: int, setup=None) -> dict:
+    """Times func over rounds. Setup runs before each round, untimed
+
+    Args:
+        func (Callable): function to time
+        rounds (int): number of rounds
+        setup (Callable, optional): called before each round. Defaults to None.
+
+    Returns:
+        dict: timing of one round
+    """
+    times = []
+    for _ in range(rounds):
+        if setup != None:
+            setup()
+        start = time.perf_counter_ns()
+        func()
+        times.append(time.perf_counter_ns() - start)
+    times.sort()
+    mean = sum(times) / len(times)
+    return {
+        "rounds": rounds,
+        "mean_us": round(mean / 1000, 3),
+        "median_us": round(times[len(times) // 2] / 1000, 3),
+        "min_us": round(times[0] / 1000, 3),
+        "ops_per_sec": round(1e9 / mean, 1) if mean else 0.0,
+    }
+
+
+def large_map(repeat: int) -> str:
+    """Writes temple.map tiled repeat times in both directions to a temp file.
+    Spawns and structures are kept only in the first tile
+
+    Args:
+        repeat (int): tiles per direction
+
+    Returns:
+        str: path of map file
+    """
+    with open("./temple.map", "r") as f:
+        head, tiles = f.read().split("[tiles]\n", 1)
+    lines = tiles.rstrip("\n").split("\n")
+    plain = ["".join(char if char in "# " else " " for char in line)
+             for line in lines]
+    rows = []
+    for tile in range(repeat):
+        block = lines if tile == 0 else plain
+        for index, line in enumerate(block):
+            rows.append(line + plain[index] * (repeat - 1))
+    fd, path = tempfile.mkstemp(suffix=".map")
+    with os.fdopen(fd, "w") as f:
+        f.write(head + "[tiles]\n" + "\n".join(rows))
+    return path
+
+
+def bench_render(results: dict, name: str, level: server.Level, rounds: int) -> None:
+    """Full and cached map render
+
+    Args:
+        results (dict): results to add to
+        name (str): name of map
+        level (server.Level): level to render
+        rounds (int): number of rounds
+    """
+    room = server.Room(1, level)
+
+    def dirty():
+        room.dirty.update(range(room.height))
+    results[f"stringify_{name}"] = measure(room.stringify, rounds, dirty)
+    results[f"render_cached_{name}"] = measure(room.render, rounds)
+    results[f"keyframe_{name}"] = measure(room.keyframe, rounds, dirty)
+
+
+def bench_moves(results: dict, level: server.Level, rounds: int) -> None:
+    """Move handling: plain move, key pickup, door opening and goal
+
+    Args:
+        results (dict): results to add to
+        level (server.Level): level to play
+        rounds (int): number of rounds
+    """
+    room = server.Room(1, level)
+    client = room.clients[0]
+    client.socket = server.NullSocket()
+    direction = [1]
+
+    def plain():
+        room.handle_input(client, "x", direction[0])
+        room.flush()
+        direction[0] = -direction[0]
+    results["handle_input_move"] = measure(plain, rounds)
+
+    def place(x: int, y: int, keys: tuple = ()):
+        def setup():
+            room.reset()
+            room.clients[0].socket = server.NullSocket()
+            start = room.clients[0]
+            room.set_cell(start.x, start.y, server.EMPTY)
+            start.x, start.y = x, y
+            start.keys.update(keys)
+            room.set_cell(x, y, ord(str(start.id)))
+            room.flush()
+        return setup
+
+    def step():
+        room.handle_input(room.clients[0], "y", 1)
+        room.flush()
+
+    # key 2 at (3, 4), door 2 at (5, 6), goal at (55, 2)
+    results["handle_input_key"] = measure(step, rounds, place(3, 3))
+    results["handle_input_door"] = measure(step, rounds, place(5, 5, (2,)))
+    results["handle_input_goal"] = measure(step, rounds, place(55, 1))
+
+
+def bench_broadcast(results: dict, level: server.Level, rounds: int, fanout: list) -> None:
+    """Broadcast of one delta to N sockets
+
+    Args:
+        results (dict): results to add to
+        level (server.Level): level to play
+        rounds (int): number of rounds
+        fanout (list): numbers of sockets
+    """
+    for size in fanout:
+        room = server.Room(1, level)
+        room.clients = [server.ClientInfo(index + 1, 0, 0)
+                        for index in range(size)]
+        for client in room.clients:
+            client.socket = server.NullSocket()
+
+        def send():
+            room.broadcast("delta$3,2, |4,2,1")
+        results[f"broadcast_{size}"] = measure(send, rounds)
+
+
+def bench_load(results: dict, path: str, rounds: int) -> None:
+    """Map loading: parsing the map file and mapping the compiled cache
+
+    Args:
+        results (dict): results to add to
+        path (str): path of map file
+        rounds (int): number of rounds
+    """
+    cache = maps.cache_path(path)
+
+    def remove():
+        if os.path.exists(cache):
+            os.remove(cache)
+    results["load_map_parse"] = measure(lambda: maps.load(path), rounds, remove)
+    maps.load(path)
+    results["load_map_cached"] = measure(lambda: maps.load(path), rounds)
+    remove()
+
+
+def bench_handshake(results: dict, rounds: int) -> None:
+    """Matchmaking and handshake of a new connection, then leaving
+
+    Args:
+        results (dict): results to add to
+        rounds (int): number of rounds
+    """
+    host = server.Server(start=False)
+
+    def handshake():
+        room, client = host.accept(server.NullSocket(), ("127.0.0.1", 0))
+        host.release(room, client)
+    results["handshake"] = measure(handshake, rounds)
+
+
+def run(rounds: int, repeat: int, fanout: list) -> dict:
+    """Runs every benchmark
+
+    Args:
+        rounds (int): number of rounds per benchmark
+        repeat (int): tiles per direction of large map
+        fanout (list): numbers of sockets to broadcast to
+
+    Returns:
+        dict: results by benchmark name
+    """
+    results = {}
+    small = server.Level("./temple.map", 2)
+    path = large_map(repeat)
+    try:
+        large = server.Level(path, 2)
+        bench_load(results, path, max(1, rounds // 100))
+    finally:
+        os.remove(path)
+        if os.path.exists(maps.cache_path(path)):
+            os.remove(maps.cache_path(path))
+    bench_render(results, "small", small, rounds)
+    bench_render(results, "large", large, max(1, rounds // 10))
+    bench_moves(results, small, rounds)
+    bench_broadcast(results, small, rounds, fanout)
+    bench_handshake(results, rounds)
+    return results
+
+
+def compare(results: dict, path: str) -> None:
+    """Prints speed of results relative to an earlier json output
+
+    Args:
+        results (dict): results of this run
+        path (str): path of earlier json output
+    """
+    with open(path, "r") as f:
+        old = json.load(f)["results"]
+    for name, result in results.items():
+        if name not in old or not old[name]["mean_us"]:
+            continue
+        ratio = old[name]["mean_us"] / result["mean_us"]
+        print(f"{name:>24}: {ratio:6.2f}x {'faster' if ratio >= 1 else 'slower'}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmarks of the Temple Treasure server hot paths")
+    parser.add_argument("--rounds", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=16,
+                        help="tiles per direction of the large map")
+    parser.add_argument("--fanout", type=int, nargs="+", default=[2, 64, 1024],
+                        help="numbers of sockets to broadcast to")
+    parser.add_argument("--output", help="write results as json to path")
+    parser.add_argument("--compare", help="earlier json output to compare to")
+    args = parser.parse_args()
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))  # temple.map
+    sys.stdout, console = open(os.devnull, "w"), sys.stdout  # game prints
+    try:
+        results = run(args.rounds, args.repeat, args.fanout)
+    finally:
+        sys.stdout.close()
+        sys.stdout = console
+    for name, result in results.items():
+        print(f"{name:>24}: {result['mean_us']:>12.3f} us  {result['ops_per_sec']:>12.1f} ops/s")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "version": server.__version__,
+                "python": platform.python_version(),
+                "time": time.time(),
+                "results": results
+            }, f, indent=2)
+    if args.compare:
+        compare(results, args.compare)
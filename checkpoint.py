@@ -0,0 +1,188 @@
+import os
+import struct
+import threading
+import zlib
+
+
+__version__ = "2.1.1"
+__author__ = "FloatingInt"
+
+
+# checkpoint file: header, then per room its header, clients, structure bitmap and grid
+MAGIC = b"TTCP"
+CHECKPOINT_VERSION = 1
+HEADER = struct.Struct("!4sH32sBH")  # magic, version, sha256 of map file, server size, rooms
+ROOM = struct.Struct("!H?BHI")  # id, finished, clients, bitmap length, compressed grid length
+CLIENT = struct.Struct("!BIIBB")  # id, x, y, keys, host length; then keys as "!h", then host
+
+
+def encode(digest: bytes, server_size: int, order: list, rooms: list) -> bytes:
+    """Packs saved rooms into a checkpoint
+
+    Args:
+        digest (bytes): sha256 of map file
+        server_size (int): maximum allowed clients per room
+        order (list): (x, y) of every structure of the level, in level order
+        rooms (list): saved rooms, see 'Room.save'
+
+    Returns:
+        bytes: content of checkpoint file
+    """
+    parts = [HEADER.pack(MAGIC, CHECKPOINT_VERSION, digest, server_size, len(rooms))]
+    for id, finished, grid, structures, clients in rooms:
+        bitmap = bytearray((len(order) + 7) // 8)
+        for index, position in enumerate(order):
+            if position in structures:
+                bitmap[index >> 3] |= 1 << (index & 7)
+        grid = zlib.compress(grid, 1)  # mostly walls and spaces
+        parts.append(ROOM.pack(id, finished, len(clients), len(bitmap), len(grid)))
+        for cid, x, y, keys, host in clients:
+            host = bytes(host or "", "ascii")
+            parts.append(CLIENT.pack(cid, x, y, len(keys), len(host)))
+            parts.append(struct.pack(f"!{len(keys)}h", *keys))
+            parts.append(host)
+        parts.append(bitmap)
+        parts.append(grid)
+    return b"".join(parts)
+
+
+def decode(data: bytes, order: list) -> tuple:
+    """Unpacks a checkpoint
+
+    Args:
+        data (bytes): content of checkpoint file
+        order (list): (x, y) of every structure of the level, in level order
+
+    Raises:
+        ValueError: not a checkpoint of this version, or truncated
+
+    Returns:
+        tuple: digest, server size and saved rooms, see 'Room.save'
+    """
+    try:
+        magic, version, digest, server_size, count = HEADER.unpack_from(data)
+        if magic != MAGIC or version != CHECKPOINT_VERSION:
+            raise ValueError("Not a checkpoint of this version")
+        offset = HEADER.size
+        rooms = []
+        for _ in range(count):
+            id, finished, client_count, bitmap_length, grid_length = \
+                ROOM.unpack_from(data, offset)
+            offset += ROOM.size
+            clients = []
+            for _ in range(client_count):
+                cid, x, y, key_count, host_length = CLIENT.unpack_from(data, offset)
+                offset += CLIENT.size
+                keys = struct.unpack_from(f"!{key_count}h", data, offset)
+                offset += 2 * key_count
+                host = data[offset:offset + host_length].decode("ascii")
+                offset += host_length
+                clients.append((cid, x, y, keys, host or None))
+            bitmap = data[offset:offset + bitmap_length]
+            offset += bitmap_length
+            structures = tuple(position for index, position in enumerate(order)
+                               if bitmap[index >> 3] & 1 << (index & 7))
+            grid = zlib.decompress(data[offset:offset + grid_length])
+            offset += grid_length
+            rooms.append((id, finished, grid, structures, clients))
+    except (struct.error, zlib.error, IndexError):
+        raise ValueError("Checkpoint is truncated") from None
+    return digest, server_size, rooms
+
+
+def write(path: str, data: bytes) -> None:
+    """Writes a checkpoint atomically, readers see the old or the new file
+
+    Args:
+        path (str): path of checkpoint file
+        data (bytes): content of checkpoint file
+    """
+    temp = path + ".tmp"
+    with open(temp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp, path)
+
+
+def read(path: str, order: list) -> tuple:
+    """Reads a checkpoint file
+
+    Args:
+        path (str): path of checkpoint file
+        order (list): (x, y) of every structure of the level, in level order
+
+    Raises:
+        ValueError: not a checkpoint of this version, or truncated
+
+    Returns:
+        tuple: digest, server size and saved rooms, None if there is no file
+    """
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    return decode(data, order)
+
+
+class Checkpointer:
+    """Encodes and writes checkpoints on its own thread.
+    The simulation worker only copies room state and hands it over.
+    Only the latest hand-over is written if writes fall behind
+    """
+
+    def __init__(self, path: str, digest: bytes, server_size: int, order: list) -> None:
+        """Checkpointer with nothing to write
+
+        Args:
+            path (str): path of checkpoint file
+            digest (bytes): sha256 of map file
+            server_size (int): maximum allowed clients per room
+            order (list): (x, y) of every structure of the level, in level order
+        """
+        self.path = path
+        self.digest = digest
+        self.server_size = server_size
+        self.order = order
+        self.latest = None  # saved rooms not yet written
+        self.lock = threading.Lock()
+        self.writing = threading.Lock()  # one write at a time
+        self.woken = threading.Event()
+        self.written = 0  # checkpoints written
+
+    def submit(self, rooms: list) -> None:
+        """Hands saved rooms over to the writing thread. Never blocks on disk
+
+        Args:
+            rooms (list): saved rooms, see 'Room.save'
+        """
+        with self.lock:
+            self.latest = rooms
+        self.woken.set()
+
+    def write_latest(self) -> None:
+        """Writes the latest hand-over, if any. Any thread
+        """
+        with self.writing:
+            with self.lock:
+                rooms, self.latest = self.latest, None
+            if rooms == None:
+                return
+            try:
+                write(self.path, encode(self.digest, self.server_size, self.order, rooms))
+                self.written += 1
+            except OSError as error:
+                print(f"\u001b[33;1m[Warning] \u001b[0mCheckpoint failed: {error}")
+
+    def run(self, running) -> None:
+        """Writes hand-overs until running returns False. Own thread
+
+        Args:
+            running (Callable): returns False to stop
+        """
+        while running():
+            if self.woken.wait(1.0):
+                self.woken.clear()
+                self.write_latest()
+        self.write_latest()
@@ -0,0 +1,376 @@
+import argparse
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+from multiprocessing import reduction
+from typing import Any
+import profiler
+import server
+
+
+__version__ = "2.1.1"
+__author__ = "FloatingInt"
+
+
+STATUS_INTERVAL = 0.1  # seconds between status checks of a worker
+COMMAND_TIMEOUT = 5.0  # seconds to wait for a worker to run a console command
+PER_WORKER_PORTS = ("metrics_port", "spectate_port")  # worker index is added
+PER_WORKER_FILES = ("metrics_file", "input_log", "state_file")  # worker number is appended
+
+
+def worker_options(options: dict, index: int) -> dict:
+    """Server options of one worker. Ports get the worker index added,
+    files the worker number appended, so workers never share them
+
+    Args:
+        options (dict): Server options given to the supervisor
+        index (int): index of worker, from 0
+
+    Returns:
+        dict: Server options of worker
+    """
+    options = dict(options)
+    for name in PER_WORKER_PORTS:
+        if options.get(name):
+            options[name] += index
+    for name in PER_WORKER_FILES:
+        if options.get(name) != None:
+            options[name] = f"{options[name]}.{index + 1}"
+    return options
+
+
+def status(game: server.Server) -> tuple:
+    """Load of a worker for placement, read from the published snapshots.
+    Joins are read first, so the snapshots hold at least every join counted
+
+    Args:
+        game (server.Server): server of worker
+
+    Returns:
+        tuple: free slots in rooms with players, connected players, hosts with a kept slot and connections joined
+    """
+    joined = game.joined
+    free = players = 0
+    reserved = []
+    for snapshot in game.snapshots:
+        players += len(snapshot.players)
+        reserved += snapshot.reserved
+        if snapshot.players and not snapshot.finished:
+            free += max(game.server_size - len(snapshot.players) - len(snapshot.reserved), 0)
+    return free, players, tuple(reserved), joined
+
+
+def work(conn: Any, index: int, options: dict) -> None:
+    """Worker process. Runs a Server without a listening socket,
+    serving the connections the supervisor hands over.
+    Reports its load whenever it changes
+
+    Args:
+        conn (multiprocessing.connection.Connection): pipe to supervisor
+        index (int): index of worker, from 0
+        options (dict): Server options of worker
+    """
+    game = server.Server(start=False, **options)
+    game.start(listen=False)
+    while game.engine == "asyncio" and game.stopped == None:
+        time.sleep(0.01)  # event loop is starting
+    last = None
+    while game.running:
+        if conn.poll(STATUS_INTERVAL):
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                game.shutdown()  # supervisor is gone
+                return
+            if message[0] == "join":
+                _kind, address, shared = message
+                if shared != None:
+                    clientsocket = socket.fromshare(shared)  # Windows
+                else:
+                    clientsocket = socket.socket(fileno=reduction.recv_handle(conn))
+                game.adopt(clientsocket, address)
+            elif message[0] == "command":
+                game.command(message[1])
+                sys.stdout.flush()  # output before the supervisor goes on
+                conn.send(("done",))
+        current = status(game)
+        if current != last and game.running:
+            conn.send(("status",) + current)
+            last = current
+
+
+class Worker:
+    """Supervisor side of one worker process
+    """
+    __slots__ = ("number", "process", "conn", "lock", "done", "alive",
+                 "report", "sent")
+
+    def __init__(self, number: int, process: Any, conn: Any) -> None:
+        """Worker with no load
+
+        Args:
+            number (int): number of worker, from 1
+            process (multiprocessing.Process): started worker process
+            conn (multiprocessing.connection.Connection): pipe to worker
+        """
+        self.number = number
+        self.process = process
+        self.conn = conn
+        self.lock = threading.Lock()  # one message (and handle) at a time
+        self.done = threading.Event()  # last console command ran
+        self.alive = True
+        self.report = (0, 0, (), 0)  # last 'status' of worker, replaced whole
+        self.sent = 0  # connections handed over
+
+    def load(self, size: int) -> tuple:
+        """Load of the worker once every connection handed over joined.
+        Connections the worker has not reported as joined yet fill free
+        slots first, then open rooms of size clients, like 'Server.match'
+
+        Args:
+            size (int): clients per room
+
+        Returns:
+            tuple: free slots in rooms with players and players
+        """
+        free, players, _reserved, joined = self.report
+        pending = self.sent - joined
+        free -= pending
+        if free < 0:
+            free %= size  # last room opened by pending connections
+        return free, players + pending
+
+
+class Supervisor:
+    """Spreads rooms over worker processes, one Server per core.
+    The supervisor accepts every connection and hands it over to a worker.
+    A room lives in one worker for its whole life: connections go to
+    the worker with a room waiting for players, so players of one game
+    meet, else to the worker with fewest players.
+    Console commands are sent to every worker
+    """
+
+    def __init__(self, workers: int = None, server_size: int = 2, host: str = "vps.i-h.no", port: int = 5050, start: bool = True, **options: Any) -> None:
+        """Init Supervisor and automatically start it
+
+        Args:
+            workers (int, optional): number of worker processes, None for one per core. Defaults to None.
+            server_size (int, optional): maximum allowed clients per room. Defaults to 2.
+            host (str, optional): server host. Defaults to "vps.i-h.no".
+            port (int, optional): server port. Defaults to 5050.
+            start (bool, optional): bind, spawn workers and read console. Defaults to True.
+            options (Any): other Server options, see 'server.Server'
+
+        Raises:
+            ValueError: datagram channels asked for, workers cannot share a datagram port
+        """
+        if options.get("udp"):
+            raise ValueError("Datagram channels are not supported with workers")
+        self.running = True
+        self.count = workers or os.cpu_count() or 1
+        self.server_size = server_size
+        self.host = host
+        self.port = port
+        self.options = dict(options, server_size=server_size, host=host, port=port)
+        self.workers = []
+        self.socket = None
+        if start:
+            self.start()
+            self.console()
+
+    def start(self) -> None:
+        """Binds the server socket, spawns the workers and starts accepting
+        """
+        print("\u001b[30;1m-- \u001b[32;1mSupervisor startup \u001b[30;1m--\u001b[0m")
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.bind((self.host, self.port))
+        self.socket.listen(socket.SOMAXCONN)
+        self.socket.settimeout(1.0)  # check running now and then
+        context = multiprocessing.get_context("spawn")  # no threads forked
+        for index in range(self.count):
+            conn, child = context.Pipe()
+            process = context.Process(
+                target=work, args=(child, index, worker_options(self.options, index)),
+                name=f"Worker {index + 1}")
+            process.start()
+            child.close()
+            worker = Worker(index + 1, process, conn)
+            self.workers.append(worker)
+            threading.Thread(target=self.handle_worker, args=(worker,)).start()  # looping
+        threading.Thread(target=self.handle_clients).start()  # looping
+        print(f"\u001b[30;1m== \u001b[32;1mSupervisor is running \u001b[37;1m{self.count} workers\u001b[30;1m...\u001b[0m")
+
+    def handle_worker(self, worker: Worker) -> None:
+        """Reads status reports and command acknowledgements of a worker
+
+        Args:
+            worker (Worker): worker to read from
+        """
+        while True:
+            try:
+                message = worker.conn.recv()
+            except (EOFError, OSError):
+                break  # worker exited
+            if message[0] == "status":
+                worker.report = message[1:]
+            elif message[0] == "done":
+                worker.done.set()
+        worker.alive = False
+        worker.done.set()
+        if self.running:
+            print(f"\u001b[31;1m[Error] \u001b[37;1mWorker {worker.number} exited\u001b[0m")
+
+    def place(self, host: str) -> Worker:
+        """Chooses the worker for a new connection. Sticky: a slot kept
+        for the host wins, then a room waiting for players, then the
+        worker with fewest players. Connections handed over count until
+        the worker reports them joined, so a burst of connections fills
+        one room before the reports catch up
+
+        Args:
+            host (str): host of the connection
+
+        Returns:
+            Worker: worker to hand the connection to, None if every worker exited
+        """
+        workers = [worker for worker in self.workers if worker.alive]
+        if not workers:
+            return None
+        loads = {worker: worker.load(self.server_size) for worker in workers}
+        waiting = [worker for worker in workers if loads[worker][0]]
+        reserved = [worker for worker in workers if host in worker.report[2]]
+        if reserved:
+            worker = reserved[0]  # reconnecting after a restore
+        elif waiting:
+            worker = waiting[0]
+        else:
+            worker = min(workers, key=lambda worker: loads[worker][1])
+        worker.sent += 1
+        return worker
+
+    def handle_clients(self) -> None:
+        """Accepts client connections and hands them over to workers
+        """
+        while self.running:
+            try:
+                clientsocket, address = self.socket.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                return  # listening socket closed
+            worker = self.place(address[0])
+            if worker == None:
+                clientsocket.close()
+                continue
+            self.hand(worker, clientsocket, address)
+
+    def hand(self, worker: Worker, clientsocket: socket.socket, address: tuple) -> None:
+        """Hands a connection over to a worker and closes it here
+
+        Args:
+            worker (Worker): worker to hand to
+            clientsocket (socket.socket): accepted socket
+            address (tuple): address of the connection
+        """
+        try:
+            with worker.lock:
+                if hasattr(clientsocket, "share"):  # Windows
+                    worker.conn.send(("join", address, clientsocket.share(worker.process.pid)))
+                else:
+                    worker.conn.send(("join", address, None))
+                    reduction.send_handle(worker.conn, clientsocket.fileno(), worker.process.pid)
+        except OSError as error:
+            worker.sent -= 1  # never joins
+            print(f"= Client [{address[1]}] was not handed over: {error}")
+        clientsocket.close()
+
+    def command(self, worker: Worker, string: str) -> None:
+        """Runs a console command on a worker and waits for it
+
+        Args:
+            worker (Worker): worker to run on
+            string (str): command as typed
+        """
+        if not worker.alive:
+            print(f"= Worker {worker.number} exited")
+            return
+        worker.done.clear()
+        try:
+            with worker.lock:
+                worker.conn.send(("command", string))
+        except OSError:
+            return
+        worker.done.wait(COMMAND_TIMEOUT)
+
+    def console(self) -> None:
+        """Reads supervisor commands until shutdown.
+        Same commands as the server, rooms are numbered per worker
+        """
+        while self.running:
+            string = input("")
+            try:
+                if string.startswith("exit"):
+                    self.shutdown()
+                elif string.startswith("kick"):
+                    # "kick {client}", "kick {room} {client}" in worker 1 or "kick {worker} {room} {client}"
+                    args = string.split(" ")[1:]
+                    number = int(args[0]) if len(args) > 2 else 1
+                    self.command(self.workers[number - 1], "kick " + " ".join(args[-2:]))
+                elif string.startswith("list") or string.startswith("stats"):
+                    players = sum(worker.load(self.server_size)[1]
+                                  for worker in self.workers if worker.alive)
+                    print(f"= Workers {self.count}, players {players}")
+                    for worker in self.workers:
+                        print(f"= Worker {worker.number}")
+                        self.command(worker, string)
+                elif string.startswith("profile"):
+                    # every worker profiles itself, dumps get the worker number appended
+                    args = string.split(" ")[1:]
+                    for worker in self.workers:
+                        if args[:1] == ["dump"]:
+                            path = args[1] if len(args) > 1 else profiler.DEFAULT_PATH
+                            string = f"profile dump {path}.{worker.number}"
+                        print(f"= Worker {worker.number}")
+                        self.command(worker, string)
+                elif string.startswith("cls"):
+                    os.system("cls")
+                    print("\u001b[30;1m-- \u001b[32;1mSupervisor \u001b[30;1m--\u001b[0m")
+                else:
+                    print("| [Invalid]", string)
+            except (TypeError, IndexError, ValueError) as error:
+                print("[Error]", type(error).__name__, error)
+
+    def shutdown(self) -> None:
+        """Shuts every worker down, then the supervisor
+        """
+        self.running = False
+        for worker in self.workers:
+            self.command(worker, "exit")
+        for worker in self.workers:
+            worker.process.join(COMMAND_TIMEOUT)
+            if worker.process.is_alive():
+                worker.process.terminate()
+            worker.conn.close()
+        if self.socket != None:
+            self.socket.close()
+        print("== Supervisor shutdown ==")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Runs a Temple Treasure server on several worker processes")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, one per core by default")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5050)
+    parser.add_argument("--size", type=int, default=2, help="clients per room")
+    parser.add_argument("--asyncio", action="store_true", help="asyncio engine in every worker")
+    parser.add_argument("--log", default=None, help="input log, one file per worker")
+    parser.add_argument("--state", default=None, help="checkpoint file, one file per worker")
+    parser.add_argument("--spectate", action="store_true", help="spectator ports from 5051, one per worker")
+    args = parser.parse_args()
+    Supervisor(args.workers, args.size, host=args.host, port=args.port,
+               engine="asyncio" if args.asyncio else "thread", input_log=args.log,
+               state_file=args.state, spectate_port=5051 if args.spectate else 0)
@@ -0,0 +1,172 @@
+import hashlib
+import os
+import struct
+
+
+__version__ = "2.1.1"
+__author__ = "FloatingInt"
+
+
+# input log: header, then one record per accepted input, in tick order
+MAGIC = b"TTIL"
+LOG_VERSION = 1
+HEADER = struct.Struct("!4sH32sBHHf")  # magic, version, sha256 of map file, server size, view width, view height, tps
+RECORD = struct.Struct("!BIHBb")  # kind, tick, room id, client id, value
+MOVE_X = 0
+MOVE_Y = 1
+SYNC = 2
+RESET = 3  # room recycled, client id and value unused
+BUFFER = 1 << 16  # bytes buffered before a write
+
+
+def map_digest(path: str) -> bytes:
+    """sha256 of a map file, ties a log to the map it was recorded on
+
+    Args:
+        path (str): path of map file
+
+    Returns:
+        bytes: digest
+    """
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).digest()
+
+
+class InputLog:
+    """Append-only binary log of every input applied by the simulation.
+    Written by the simulation worker only, buffered and flushed
+    about once a second, so a crash loses at most the last second
+    """
+
+    def __init__(self, path: str, map_path: str, server_size: int, view: tuple, tps: float) -> None:
+        """Opens a log for appending, writes the header if the file is new
+
+        Args:
+            path (str): path of log file
+            map_path (str): path of map file played
+            server_size (int): maximum allowed clients per room
+            view (tuple): width and height of client viewports
+            tps (float): simulation ticks per second
+
+        Raises:
+            ValueError: existing log was recorded with other settings
+        """
+        header = HEADER.pack(MAGIC, LOG_VERSION, map_digest(map_path),
+                             server_size, view[0], view[1], tps)
+        self.tick = 0
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, "rb") as f:
+                if f.read(HEADER.size) != header:
+                    raise ValueError(f"Input log {path} was recorded with other settings")
+            self.tick = last_tick(path) + 1  # ticks keep increasing across runs
+        self.file = open(path, "ab", buffering=BUFFER)
+        if self.file.tell() == 0:
+            self.file.write(header)
+        self.flush_every = max(1, int(tps))
+        self.records = 0
+
+    def write(self, room: int, cid: int, attr: str, value) -> None:
+        """Appends one applied input. Attributes the game ignores are skipped
+
+        Args:
+            room (int): id of room
+            cid (int): id of client
+            attr (str): attribute of input
+            value (Any): value of input
+        """
+        if attr.startswith("x"):
+            kind, value = MOVE_X, min(max(int(value), -1), 1)
+        elif attr.startswith("y"):
+            kind, value = MOVE_Y, min(max(int(value), -1), 1)
+        elif attr.startswith("sync"):
+            kind, value = SYNC, 0
+        else:
+            return
+        self.file.write(RECORD.pack(kind, self.tick, room, cid, value))
+        self.records += 1
+
+    def reset(self, room: int) -> None:
+        """Appends the recycling of a room
+
+        Args:
+            room (int): id of room
+        """
+        self.file.write(RECORD.pack(RESET, self.tick, room, 0, 0))
+
+    def advance(self) -> None:
+        """Ends the current tick. Flushes once every second of ticks
+        """
+        self.tick += 1
+        if self.tick % self.flush_every == 0:
+            self.file.flush()
+
+    def close(self) -> None:
+        """Flushes and closes the log
+        """
+        if not self.file.closed:
+            self.file.close()
+
+
+def read_header(f) -> dict:
+    """Reads and checks the header of a log
+
+    Args:
+        f (BinaryIO): log file at its start
+
+    Raises:
+        ValueError: not an input log, or of another version
+
+    Returns:
+        dict: settings the log was recorded with
+    """
+    try:
+        magic, version, digest, server_size, width, height, tps = \
+            HEADER.unpack(f.read(HEADER.size))
+    except struct.error:
+        raise ValueError("Input log is empty or truncated") from None
+    if magic != MAGIC or version != LOG_VERSION:
+        raise ValueError("Not an input log of this version")
+    return {"digest": digest, "server_size": server_size,
+            "view": (width, height), "tps": tps}
+
+
+def read(path: str, chunk: int = 4096) -> tuple:
+    """Reads a whole log. Records are read in chunks, a partly written
+    last record (crash) is ignored
+
+    Args:
+        path (str): path of log file
+        chunk (int, optional): records per read. Defaults to 4096.
+
+    Returns:
+        tuple: settings (see 'read_header') and list of (kind, tick, room, cid, value)
+    """
+    records = []
+    with open(path, "rb") as f:
+        header = read_header(f)
+        size = RECORD.size * chunk
+        while True:
+            data = f.read(size)
+            end = len(data) - len(data) % RECORD.size
+            records.extend(RECORD.iter_unpack(data[:end]))
+            if len(data) < size:
+                break
+    return header, records
+
+
+def last_tick(path: str) -> int:
+    """Tick of the last complete record of a log
+
+    Args:
+        path (str): path of log file
+
+    Returns:
+        int: tick, -1 if the log has no records
+    """
+    size = os.path.getsize(path) - HEADER.size
+    count = size // RECORD.size
+    if count <= 0:
+        return -1
+    with open(path, "rb") as f:
+        f.seek(HEADER.size + (count - 1) * RECORD.size)
+        return RECORD.unpack(f.read(RECORD.size))[1]
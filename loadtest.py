@@ -0,0 +1,405 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+import protocol
+
+
+__version__ = "2.1.1"
+__author__ = "FloatingInt"
+
+
+DIRECTIONS = (("x", -1), ("x", 1), ("y", -1), ("y", 1))
+WALKABLE = (" ", "!", "?")  # cells a bot tries to step on
+CONNECT_TIMEOUT = 10.0  # seconds a bot waits for its handshake before it counts as failed
+
+
+class Stats:
+    """Numbers collected by every bot of one load test
+    """
+
+    def __init__(self) -> None:
+        """Empty stats
+        """
+        self.connected = 0
+        self.rejected = 0  # server or room full
+        self.failed = 0  # could not connect
+        self.lost = 0  # datagrams missing from sequence
+        self.moves = 0
+        self.updates = 0  # frames received after handshake
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.latencies = []  # seconds from move to update showing it
+        self.connect_start = 0.0
+        self.connect_end = 0.0
+
+    def percentile(self, percent: float) -> float:
+        """Latency percentile in milliseconds
+
+        Args:
+            percent (float): percentile, 0 to 100
+
+        Returns:
+            float: latency, 0 if nothing was measured
+        """
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * percent / 100))
+        return ordered[index] * 1000
+
+    def report(self, duration: float) -> dict:
+        """Summary of the load test
+
+        Args:
+            duration (float): seconds the bots were playing
+
+        Returns:
+            dict: summary, ready for json
+        """
+        connect_time = max(self.connect_end - self.connect_start, 1e-9)
+        return {
+            "connected": self.connected,
+            "rejected": self.rejected,
+            "failed": self.failed,
+            "connections_per_sec": round(self.connected / connect_time, 1),
+            "moves_per_sec": round(self.moves / duration, 1),
+            "updates_per_sec": round(self.updates / duration, 1),
+            "latency_p50_ms": round(self.percentile(50), 2),
+            "latency_p99_ms": round(self.percentile(99), 2),
+            "bytes_sent_per_sec": round(self.bytes_sent / duration, 1),
+            "bytes_received_per_sec": round(self.bytes_received / duration, 1),
+            "datagrams_lost": self.lost,
+        }
+
+
+class BotDatagrams(asyncio.DatagramProtocol):
+    """Datagram channel of a bot
+    """
+
+    def __init__(self, bot: "Bot") -> None:
+        """Channel feeding a bot
+
+        Args:
+            bot (Bot): bot to feed
+        """
+        self.bot = bot
+
+    def datagram_received(self, data: bytes, address: tuple) -> None:
+        self.bot.on_datagram(data)
+
+
+class Bot:
+    """Headless client doing a random walk. Speaks the same protocol as App
+    """
+
+    def __init__(self, stats: Stats, tps: float, compress: bool = False, udp: bool = False) -> None:
+        """Bot reporting to stats
+
+        Args:
+            stats (Stats): stats shared by all bots
+            tps (float): moves per second
+            compress (bool, optional): ask the server for compressed frames. Defaults to False.
+            udp (bool, optional): ask the server for a datagram channel. Defaults to False.
+        """
+        self.stats = stats
+        self.tps = tps
+        self.compress = compress
+        self.udp = udp
+        self.address = None  # (host, port) of server
+        self.transport = None  # datagram transport, once the server gave a token
+        self.token = 0
+        self.udp_sent = 0  # last sequence number sent
+        self.udp_received = 0  # last sequence number received
+        self.cid = 0
+        self.content = []
+        self.origin = (0, 0)  # position of viewport on the map
+        self.x = 0
+        self.y = 0
+        self.sent_at = None  # time of move not yet seen in an update
+        self.frames = protocol.FrameReader(inflate=True)
+        self.reader = None
+        self.writer = None
+
+    async def connect(self, host: str, port: int) -> bool:
+        """Connects and reads the handshake, gives up after CONNECT_TIMEOUT
+
+        Args:
+            host (str): server host
+            port (int): server port
+
+        Returns:
+            bool: True if the bot got a slot
+        """
+        self.address = (host, port)
+        try:
+            return await asyncio.wait_for(self.handshake(host, port), CONNECT_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.stats.failed += 1
+            if self.writer != None:
+                self.writer.close()
+            return False
+
+    async def handshake(self, host: str, port: int) -> bool:
+        """Connects and reads the handshake
+
+        Args:
+            host (str): server host
+            port (int): server port
+
+        Returns:
+            bool: True if the bot got a slot
+        """
+        try:
+            self.reader, self.writer = await asyncio.open_connection(host, port)
+        except OSError:
+            self.stats.failed += 1
+            return False
+        backlog = []
+        while not backlog:
+            data = await self.reader.read(65536)
+            if not data:
+                self.stats.failed += 1
+                return False
+            self.stats.bytes_received += len(data)
+            backlog = self.frames.feed(data)
+        _kind, payload = backlog.pop(0)
+        index, server_size, content = payload.decode("utf-8").split("$", 2)
+        self.cid = int(index)
+        if self.cid > int(server_size):
+            self.stats.rejected += 1
+            self.writer.close()
+            return False
+        self.content = protocol.parse_content(content)
+        self.locate()
+        if self.compress:
+            self.writer.write(protocol.pack_text(f"{self.cid}$compress$1"))
+        if self.udp:
+            self.writer.write(protocol.pack_text(f"{self.cid}$udp$1"))
+        self.stats.connected += 1
+        for kind, payload in backlog:
+            self.on_frame(kind, payload)
+        return True
+
+    def locate(self) -> None:
+        """Finds own position in local content
+        """
+        for y, line in enumerate(self.content):
+            if str(self.cid) in line:
+                self.x, self.y = line.index(str(self.cid)), y
+                return
+
+    def on_frame(self, kind: int, payload: bytes) -> None:
+        """Applies one frame from the server to local content
+
+        Args:
+            kind (int): kind of frame
+            payload (bytes): payload of frame
+        """
+        if kind != protocol.TEXT:
+            return
+        self.stats.updates += 1
+        attr, value = payload.decode("utf-8").split("$", 1)
+        if attr.startswith("content"):
+            self.content = protocol.parse_content(value)
+            self.locate()
+        elif attr.startswith("view"):
+            self.origin = protocol.parse_view(value)  # content follows
+        elif attr.startswith("udp") and value != "0":
+            asyncio.ensure_future(self.open_udp(int(value, 16)))
+        elif attr.startswith("delta"):
+            try:
+                changes = protocol.apply_delta(self.content, value, self.origin)
+            except (ValueError, IndexError):
+                self.writer.write(protocol.pack_text(f"{self.cid}$sync$1"))
+                return
+            for x, y, cell in changes:
+                if cell == str(self.cid) and (x, y) != (self.x, self.y):
+                    self.x, self.y = x, y
+                    if self.sent_at != None:
+                        self.stats.latencies.append(
+                            time.perf_counter() - self.sent_at)
+                        self.sent_at = None
+
+    async def open_udp(self, token: int) -> None:
+        """Opens the datagram channel given by the server
+
+        Args:
+            token (int): token of channel
+        """
+        if self.transport != None:
+            return
+        self.token = token
+        self.transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: BotDatagrams(self), remote_addr=self.address)
+        self.send_move(b"")  # tells the server where to send deltas
+
+    def on_datagram(self, data: bytes) -> None:
+        """Applies one datagram from the server.
+        Stale and duplicate datagrams are dropped, a gap asks for a keyframe
+
+        Args:
+            data (bytes): datagram received
+        """
+        try:
+            token, seq, frames = protocol.unpack_datagram(data)
+        except ValueError:
+            return
+        if token != self.token or seq <= self.udp_received:
+            return  # stale or duplicate
+        if seq != self.udp_received + 1:
+            self.stats.lost += seq - self.udp_received - 1
+            self.writer.write(protocol.pack_text(f"{self.cid}$sync$1"))
+        self.udp_received = seq
+        self.stats.bytes_received += len(data)
+        for kind, payload in frames:
+            self.on_frame(kind, payload)
+
+    def send_move(self, data: bytes) -> None:
+        """Sends a move frame, as a datagram if the channel is open
+
+        Args:
+            data (bytes): packed move frame
+        """
+        if self.transport == None:
+            self.writer.write(data)
+            return
+        self.udp_sent += 1
+        self.transport.sendto(protocol.pack_datagram(self.token, self.udp_sent, data))
+
+    def choose(self) -> tuple:
+        """Picks a random direction into a walkable cell
+
+        Returns:
+            tuple: axis and value, None if boxed in
+        """
+        options = []
+        for attr, value in DIRECTIONS:
+            x = self.x + (value if attr == "x" else 0)
+            y = self.y + (value if attr == "y" else 0)
+            try:
+                cell = self.content[y][x]
+            except IndexError:
+                continue
+            symbol = cell if len(cell) == 1 else cell[-5]  # strip color
+            if symbol in WALKABLE:
+                options.append((attr, value))
+        return random.choice(options) if options else None
+
+    async def listen(self) -> None:
+        """Receives updates until the connection closes
+        """
+        while True:
+            try:
+                data = await self.reader.read(65536)
+            except ConnectionError:
+                return
+            if not data:
+                return
+            self.stats.bytes_received += len(data)
+            for kind, payload in self.frames.feed(data):
+                self.on_frame(kind, payload)
+
+    async def walk(self, until: float) -> None:
+        """Sends one move per tick until the given time
+
+        Args:
+            until (float): perf_counter time to stop at
+        """
+        interval = 1.0 / self.tps
+        deadline = time.perf_counter() + random.random() * interval
+        while deadline < until:
+            await asyncio.sleep(max(0.0, deadline - time.perf_counter()))
+            deadline += interval
+            direction = self.choose()
+            if direction == None:
+                continue
+            data = protocol.pack_move(self.cid, *direction)
+            try:
+                self.send_move(data)
+            except ConnectionError:
+                return
+            if self.sent_at == None:
+                self.sent_at = time.perf_counter()
+            self.stats.moves += 1
+            self.stats.bytes_sent += len(data)
+
+    def close(self) -> None:
+        """Closes the connection
+        """
+        if self.writer != None:
+            self.writer.close()
+        if self.transport != None:
+            self.transport.close()
+
+
+async def run(host: str, port: int, bots: int, duration: float, tps: float, rate: float, compress: bool = False, udp: bool = False) -> dict:
+    """Connects bots, lets them walk and collects stats
+
+    Args:
+        host (str): server host
+        port (int): server port
+        bots (int): number of bots
+        duration (float): seconds to walk after every bot connected
+        tps (float): moves per second per bot
+        rate (float): new connections per second, 0 for all at once
+        compress (bool, optional): bots ask for compressed frames. Defaults to False.
+        udp (bool, optional): bots ask for a datagram channel. Defaults to False.
+
+    Returns:
+        dict: summary of the load test
+    """
+    stats = Stats()
+    stats.connect_start = time.perf_counter()
+    connected = []
+    pending = []
+    for index in range(bots):
+        bot = Bot(stats, tps, compress, udp)
+        pending.append(asyncio.ensure_future(bot.connect(host, port)))
+        connected.append(bot)
+        if rate > 0:
+            await asyncio.sleep(1.0 / rate)
+    results = await asyncio.gather(*pending)
+    stats.connect_end = time.perf_counter()
+    playing = [bot for bot, ok in zip(connected, results) if ok]
+    start = time.perf_counter()
+    stats.moves = stats.updates = stats.bytes_sent = 0
+    received = stats.bytes_received
+    listeners = [asyncio.ensure_future(bot.listen()) for bot in playing]
+    await asyncio.gather(*(bot.walk(start + duration) for bot in playing))
+    await asyncio.sleep(0.5)  # let last updates arrive
+    for bot in playing:
+        bot.close()
+    for listener in listeners:
+        listener.cancel()
+    stats.bytes_received -= received
+    return stats.report(duration)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Headless load test for a Temple Treasure server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5050)
+    parser.add_argument("--bots", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=10.0,
+                        help="seconds to walk")
+    parser.add_argument("--tps", type=float, default=8.0,
+                        help="moves per second per bot")
+    parser.add_argument("--rate", type=float, default=0.0,
+                        help="new connections per second, 0 for all at once")
+    parser.add_argument("--compress", action="store_true",
+                        help="ask the server for compressed frames")
+    parser.add_argument("--udp", action="store_true",
+                        help="ask the server for datagram channels")
+    parser.add_argument("--json", action="store_true",
+                        help="print summary as json")
+    args = parser.parse_args()
+    summary = asyncio.run(run(args.host, args.port, args.bots, args.duration,
+                              args.tps, args.rate, args.compress, args.udp))
+    if args.json:
+        print(json.dumps(summary))
+    else:
+        for name, value in summary.items():
+            print(f"{name:>24}: {value}")
@@ -0,0 +1,275 @@
+import hashlib
+import mmap
+import os
+import struct
+
+
+__version__ = "2.1.1"
+__author__ = "FloatingInt"
+
+
+# Map format, one section per "[name]" line, ";" starts a comment line
+#
+# [legend]
+# <char> key <id> <color>     opens one door with the same id, used up
+# <char> door <id> <color>
+# <char> goal <color>
+# <char> spawn <client id>
+# [tiles]
+# rows of the map, "#" is wall, " " is empty, any other char is in legend
+
+WALL = "#"
+EMPTY = " "
+SYMBOLS = {"key": "!", "door": "&", "goal": "?"}  # kind -> symbol on grid
+KINDS = ("key", "door", "goal")  # index is kind code in cache
+COLORS = {
+    "black": "30", "red": "31", "green": "32", "yellow": "33",
+    "blue": "34", "magenta": "35", "cyan": "36", "white": "37"
+}
+
+# binary cache: header, spawns, structures, then grid row by row
+MAGIC = b"TTMC"
+CACHE_VERSION = 1
+HEADER = struct.Struct("!4sH32sIIII")  # magic, version, sha256 of map file, width, height, spawns, structures
+SPAWN = struct.Struct("!BII")  # client id, x, y
+RECORD = struct.Struct("!BhII8s")  # kind, id, x, y, color code
+
+
+class MapData:
+    """Compiled map: grid of tile codes, spawns and structures.
+    The grid is read-only and may be backed by a memory-mapped cache
+    """
+    __slots__ = ("width", "height", "grid", "spawns", "structures")
+
+    def __init__(self, width: int, height: int, grid: bytes, spawns: list, structures: list) -> None:
+        """Map data
+
+        Args:
+            width (int): width of map
+            height (int): height of map
+            grid (bytes): bytes-like tile codes, y * width + x
+            spawns (list): (cid, x, y) of each spawn, sorted by cid
+            structures (list): (kind, id, color, x, y) of each structure
+        """
+        self.width = width
+        self.height = height
+        self.grid = grid
+        self.spawns = spawns
+        self.structures = structures
+
+
+def parse(text: str) -> MapData:
+    """Parses a map file
+
+    Args:
+        text (str): content of map file
+
+    Raises:
+        ValueError: map is malformed
+
+    Returns:
+        MapData: map data, grid as bytes
+    """
+    legend = {}  # char -> (kind, id, color)
+    rows = []
+    section = None
+    for number, line in enumerate(text.split("\n"), 1):
+        line = line.rstrip("\r")
+        if line.strip() in ("[legend]", "[tiles]"):
+            section = line.strip()[1:-1]
+        elif section == "tiles":
+            rows.append(line.rstrip())
+        elif line.strip() == "" or line.startswith(";"):
+            continue
+        elif section == "legend":
+            legend[line[0]] = parse_legend(line, number)
+        else:
+            raise ValueError(f"Line {number}: outside of a section")
+    while rows and rows[-1] == "":
+        rows.pop()
+    if not rows:
+        raise ValueError("Map has no tiles")
+    width = max(len(row) for row in rows)
+    grid = bytearray()
+    spawns = []
+    structures = []
+    for y, row in enumerate(rows):
+        for x, char in enumerate(row.ljust(width)):
+            if char in (WALL, EMPTY):
+                grid.append(ord(char))
+                continue
+            if char not in legend:
+                raise ValueError(f"Tile {char!r} at {x},{y} is not in legend")
+            kind, id, color = legend[char]
+            if kind == "spawn":
+                if any(cid == id for cid, _x, _y in spawns):
+                    raise ValueError(f"Spawn {id} placed twice")
+                spawns.append((id, x, y))
+                grid.append(ord(str(id)))
+            else:
+                structures.append((kind, id, color, x, y))
+                grid.append(ord(SYMBOLS[kind]))
+    spawns.sort()
+    return MapData(width, len(rows), bytes(grid), spawns, structures)
+
+
+def parse_legend(line: str, number: int) -> tuple:
+    """Parses one line of the legend
+
+    Args:
+        line (str): line of legend
+        number (int): line number, for errors
+
+    Raises:
+        ValueError: line is malformed
+
+    Returns:
+        tuple: kind, id and color code
+    """
+    char, *words = line.split()
+    if len(char) != 1 or char in (WALL, EMPTY):
+        raise ValueError(f"Line {number}: legend char must be one symbol")
+    kind = words[0] if words else ""
+    try:
+        if kind == "spawn":
+            id = int(words[1])
+            if not 1 <= id <= 9:
+                raise ValueError
+            return kind, id, ""
+        if kind in ("key", "door"):
+            return kind, int(words[1]), color_code(words[2])
+        if kind == "goal":
+            return kind, -1, color_code(words[1])
+    except (IndexError, ValueError, KeyError):
+        raise ValueError(f"Line {number}: malformed {kind}") from None
+    raise ValueError(f"Line {number}: unknown kind {kind!r}")
+
+
+def color_code(color: str) -> str:
+    """ANSI code of a color name, or the code itself
+
+    Args:
+        color (str): name like "green", or code like "32;1"
+
+    Raises:
+        KeyError: unknown color
+
+    Returns:
+        str: ANSI code
+    """
+    if color in COLORS:
+        return COLORS[color]
+    if all(part.isdigit() for part in color.split(";")) and len(color) <= 8:
+        return color
+    raise KeyError(color)
+
+
+def compile_map(data: MapData, digest: bytes) -> bytes:
+    """Packs map data into the binary cache format
+
+    Args:
+        data (MapData): map data
+        digest (bytes): sha256 of map file
+
+    Returns:
+        bytes: content of cache file
+    """
+    parts = [HEADER.pack(MAGIC, CACHE_VERSION, digest, data.width, data.height,
+                         len(data.spawns), len(data.structures))]
+    for cid, x, y in data.spawns:
+        parts.append(SPAWN.pack(cid, x, y))
+    for kind, id, color, x, y in data.structures:
+        parts.append(RECORD.pack(KINDS.index(kind), id, x, y,
+                                 bytes(color, "ascii")))
+    parts.append(data.grid)
+    return b"".join(parts)
+
+
+def read_cache(path: str, digest: bytes) -> MapData:
+    """Memory-maps a cache file. The grid stays in the mapping
+
+    Args:
+        path (str): path of cache file
+        digest (bytes): sha256 the map file must have
+
+    Returns:
+        MapData: map data, None if cache is missing, stale or broken
+    """
+    try:
+        with open(path, "rb") as f:
+            view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    except (OSError, ValueError):
+        return None  # missing or empty
+    try:
+        magic, version, cached, width, height, spawn_count, structure_count = \
+            HEADER.unpack_from(view)
+    except struct.error:
+        return None
+    if magic != MAGIC or version != CACHE_VERSION or cached != digest:
+        return None
+    offset = HEADER.size
+    grid_offset = offset + SPAWN.size * spawn_count + RECORD.size * structure_count
+    if len(view) != grid_offset + width * height:
+        return None  # truncated
+    spawns = []
+    for _ in range(spawn_count):
+        spawns.append(SPAWN.unpack_from(view, offset))
+        offset += SPAWN.size
+    structures = []
+    for _ in range(structure_count):
+        kind, id, x, y, color = RECORD.unpack_from(view, offset)
+        structures.append(
+            (KINDS[kind], id, color.rstrip(b"\0").decode("ascii"), x, y))
+        offset += RECORD.size
+    return MapData(width, height, view[grid_offset:], spawns, structures)
+
+
+def cache_path(path: str) -> str:
+    """Path of the cache file of a map file
+
+    Args:
+        path (str): path of map file
+
+    Returns:
+        str: path of cache file
+    """
+    return os.path.splitext(path)[0] + ".mapc"
+
+
+def load(path: str) -> MapData:
+    """Loads a map, from its cache if the cache matches the map file.
+    Otherwise the map is parsed and the cache written again
+
+    Args:
+        path (str): path of map file
+
+    Raises:
+        ValueError: map is malformed
+
+    Returns:
+        MapData: map data
+    """
+    with open(path, "rb") as f:
+        source = f.read()
+    digest = hashlib.sha256(source).digest()
+    cache = cache_path(path)
+    data = read_cache(cache, digest)
+    if data != None:
+        return data
+    data = parse(source.decode("utf-8"))
+    temp = cache + ".tmp"
+    try:
+        with open(temp, "wb") as f:
+            f.write(compile_map(data, digest))
+        os.replace(temp, cache)
+    except OSError:
+        pass  # read-only location, parse again next time
+    return data
+
+
+if __name__ == "__main__":
+    import sys
+    for name in sys.argv[1:]:
+        data = load(name)
+        print(f"{name}: {data.width}x{data.height}, {len(data.spawns)} spawns, "
+              f"{len(data.structures)} structures -> {cache_path(name)}")
@@ -0,0 +1,251 @@
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+
+
+__version__ = "2.1.1"
+__author__ = "FloatingInt"
+
+
+class Counter:
+    """Monotonic counter, safe to increment from any thread
+    """
+    __slots__ = ("value", "lock")
+
+    def __init__(self) -> None:
+        """Counter at zero
+        """
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount: int = 1) -> None:
+        """Adds to the counter
+
+        Args:
+            amount (int, optional): amount to add. Defaults to 1.
+        """
+        with self.lock:
+            self.value += amount
+
+
+class Histogram:
+    """Latency histogram with power of two microsecond buckets.
+    Constant memory and constant time per observation
+    """
+    __slots__ = ("buckets", "count", "total", "max", "lock")
+    size = 28  # 1 us to ~2 min
+
+    def __init__(self) -> None:
+        """Empty histogram
+        """
+        self.buckets = [0] * self.size
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds: float) -> None:
+        """Records one duration
+
+        Args:
+            seconds (float): duration to record
+        """
+        index = min(int(seconds * 1e6).bit_length(), self.size - 1)
+        with self.lock:
+            self.buckets[index] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def percentile(self, percent: float) -> float:
+        """Upper bound of the bucket holding a percentile
+
+        Args:
+            percent (float): percentile, 0 to 100
+
+        Returns:
+            float: duration in seconds, 0 if nothing was recorded
+        """
+        if not self.count:
+            return 0.0
+        rank = self.count * percent / 100
+        seen = 0
+        for index, amount in enumerate(self.buckets):
+            seen += amount
+            if seen >= rank and amount:
+                return min((1 << index) / 1e6, self.max)
+        return self.max
+
+
+class Metrics:
+    """Registry of counters, histograms and gauges.
+    Read by the "stats" console command, a dump file or a scrape endpoint
+    """
+
+    def __init__(self) -> None:
+        """Empty registry
+        """
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.started = time.time()
+
+    def counter(self, name: str) -> Counter:
+        """Gets or makes a counter
+
+        Args:
+            name (str): name of counter
+
+        Returns:
+            Counter: counter registered under name
+        """
+        if name not in self.counters:
+            self.counters[name] = Counter()
+        return self.counters[name]
+
+    def histogram(self, name: str) -> Histogram:
+        """Gets or makes a histogram
+
+        Args:
+            name (str): name of histogram
+
+        Returns:
+            Histogram: histogram registered under name
+        """
+        if name not in self.histograms:
+            self.histograms[name] = Histogram()
+        return self.histograms[name]
+
+    def gauge(self, name: str, func: Callable) -> None:
+        """Registers a value computed when read
+
+        Args:
+            name (str): name of gauge
+            func (Callable): returns the current value
+        """
+        self.gauges[name] = func
+
+    def snapshot(self) -> dict:
+        """Current value of everything registered
+
+        Returns:
+            dict: values, ready for json
+        """
+        data = {"uptime_seconds": round(time.time() - self.started, 1)}
+        for name, counter in self.counters.items():
+            data[name] = counter.value
+        for name, histogram in self.histograms.items():
+            data[name] = {
+                "count": histogram.count,
+                "mean": histogram.total / histogram.count if histogram.count else 0.0,
+                "p50": histogram.percentile(50),
+                "p99": histogram.percentile(99),
+                "max": histogram.max,
+            }
+        for name, func in self.gauges.items():
+            data[name] = func()
+        return data
+
+    def render(self) -> str:
+        """Snapshot as text for the console
+
+        Returns:
+            str: one line per value
+        """
+        lines = []
+        for name, value in self.snapshot().items():
+            if isinstance(value, dict) and "p50" in value:
+                lines.append(
+                    f"- {name}: count {value['count']}, mean {value['mean'] * 1e3:.3f} ms, "
+                    f"p50 {value['p50'] * 1e3:.3f} ms, p99 {value['p99'] * 1e3:.3f} ms, "
+                    f"max {value['max'] * 1e3:.3f} ms")
+            else:
+                lines.append(f"- {name}: {value}")
+        return "\n".join(lines)
+
+    def exposition(self) -> str:
+        """Snapshot in the Prometheus text format
+
+        Returns:
+            str: one line per sample
+        """
+        lines = []
+        for name, value in self.snapshot().items():
+            if isinstance(value, dict) and "p50" in value:
+                lines.append(f"{name}_count {value['count']}")
+                lines.append(f"{name}_sum {value['mean'] * value['count']}")
+                lines.append(f'{name}{{quantile="0.5"}} {value["p50"]}')
+                lines.append(f'{name}{{quantile="0.99"}} {value["p99"]}')
+            elif isinstance(value, dict):
+                for label, amount in value.items():
+                    lines.append(f'{name}{{id="{label}"}} {amount}')
+            else:
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path: str) -> None:
+        """Writes snapshot as json, atomically
+
+        Args:
+            path (str): path of dump file
+        """
+        temp = path + ".tmp"
+        with open(temp, "w") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(temp, path)
+
+    def start_dump(self, path: str, interval: float, running: Callable) -> None:
+        """Dumps snapshot periodically on a daemon thread
+
+        Args:
+            path (str): path of dump file
+            interval (float): seconds between dumps
+            running (Callable): returns False to stop dumping
+        """
+        def loop():
+            while running():
+                time.sleep(interval)
+                self.dump(path)
+        threading.Thread(target=loop, name="Metrics dump", daemon=True).start()
+
+    def serve(self, port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+        """Serves snapshot over http on a daemon thread.
+        "/metrics" answers in Prometheus format, anything else as json
+
+        Args:
+            port (int): port to listen on
+            host (str, optional): host to listen on. Defaults to "127.0.0.1".
+
+        Returns:
+            ThreadingHTTPServer: server, call 'shutdown' to stop it
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.startswith("/metrics"):
+                    body = bytes(metrics.exposition(), "utf-8")
+                    kind = "text/plain; version=0.0.4"
+                else:
+                    body = bytes(json.dumps(metrics.snapshot()), "utf-8")
+                    kind = "application/json"
+                self.send_response(200)
+                self.send_header("Content-Type", kind)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass  # keep console clean
+
+        httpd = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=httpd.serve_forever,
+                         name="Metrics endpoint", daemon=True).start()
+        return httpd
+
+
+REGISTRY = Metrics()  # default registry of this process
@@ -0,0 +1,187 @@
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+
+__version__ = "2.1.1"
+__author__ = "FloatingInt"
+
+
+INTERVAL = 0.005  # seconds between samples
+DEFAULT_PATH = "./profile.folded"
+THREAD_NUMBER = re.compile(r"-\d+")  # "Thread-12 (run_ticks)" -> "Thread (run_ticks)"
+
+
+class Sampler:
+    """Sampling profiler of every thread of the process, on its own thread.
+    Nothing is hooked into the profiled threads: the stacks of all threads
+    are read with 'sys._current_frames' at a fixed interval, so there is
+    no cost while stopped and little while running.
+
+    Where threads have their own CPU clock (POSIX), a thread is only
+    counted when it used CPU since the last sample, weighted by the
+    microseconds used. Threads blocked in recv or select do not show up.
+    Elsewhere every thread is counted once per sample (wall clock).
+
+    Stacks are dumped in collapsed format, one "thread;outer;...;inner weight"
+    line per stack, ready for flamegraph.pl or speedscope
+    """
+
+    def __init__(self, interval: float = INTERVAL) -> None:
+        """Stopped sampler with no samples
+
+        Args:
+            interval (float, optional): seconds between samples. Defaults to INTERVAL.
+        """
+        self.interval = interval
+        self.cpu = hasattr(time, "pthread_getcpuclockid")
+        self.stacks = Counter()  # (thread, frame, ...) outermost first -> weight
+        self.labels = {}  # code object -> frame label
+        self.clocks = {}  # thread ident -> (clock id, cpu seconds at last sample)
+        self.samples = 0
+        self.seconds = 0.0  # time spent sampling
+        self.running = False
+        self.thread = None
+        self.lock = threading.Lock()  # stacks, between sampling and dumping
+
+    def start(self) -> bool:
+        """Starts sampling, keeping samples of earlier runs
+
+        Returns:
+            bool: False if already running
+        """
+        if self.running:
+            return False
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="Profiler", daemon=True)
+        self.thread.start()
+        return True
+
+    def stop(self) -> bool:
+        """Stops sampling, samples are kept for 'dump'
+
+        Returns:
+            bool: False if not running
+        """
+        if not self.running:
+            return False
+        self.running = False
+        self.thread.join()
+        return True
+
+    def run(self) -> None:
+        """Samples until stopped. Own thread
+        """
+        own = threading.get_ident()
+        deadline = time.monotonic()
+        while self.running:
+            start = time.perf_counter()
+            self.sample(own)
+            self.seconds += time.perf_counter() - start
+            deadline += self.interval
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                deadline = time.monotonic()  # fell behind, skip missed samples
+
+    def sample(self, own: int) -> None:
+        """Records the stack of every other thread once
+
+        Args:
+            own (int): ident of sampling thread, skipped
+        """
+        names = {thread.ident: THREAD_NUMBER.sub("", thread.name)
+                 for thread in threading.enumerate()}
+        frames = sys._current_frames()
+        taken = []
+        for ident, frame in frames.items():
+            if ident == own:
+                continue
+            weight = self.weight(ident) if self.cpu else 1
+            if not weight:
+                continue  # blocked since last sample
+            stack = []
+            while frame != None:
+                stack.append(self.label(frame.f_code))
+                frame = frame.f_back
+            stack.append(names.get(ident, "Thread"))
+            stack.reverse()
+            taken.append((tuple(stack), weight))
+        del frames  # frames keep locals alive
+        with self.lock:
+            for stack, weight in taken:
+                self.stacks[stack] += weight
+            self.samples += 1
+
+    def weight(self, ident: int) -> int:
+        """CPU used by a thread since its last sample
+
+        Args:
+            ident (int): ident of thread
+
+        Returns:
+            int: microseconds of CPU, 0 on the first sample of a thread or if it ended
+        """
+        try:
+            clock, last = self.clocks.get(ident) or (time.pthread_getcpuclockid(ident), None)
+            used = time.clock_gettime(clock)
+        except (OSError, OverflowError):
+            self.clocks.pop(ident, None)  # thread ended
+            return 0
+        self.clocks[ident] = (clock, used)
+        return int((used - last) * 1e6) if last != None else 0
+
+    def label(self, code) -> str:
+        """Label of a frame in collapsed stacks. Cached per code object
+
+        Args:
+            code (types.CodeType): code of frame
+
+        Returns:
+            str: f"{function} ({file}:{line})"
+        """
+        label = self.labels.get(code)
+        if label == None:
+            name = getattr(code, "co_qualname", code.co_name)
+            label = f"{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            label = self.labels[code] = label.replace(";", ":")  # ";" separates frames
+        return label
+
+    def dump(self, path: str = DEFAULT_PATH) -> int:
+        """Writes the collapsed stacks sampled so far. Sampling goes on
+
+        Args:
+            path (str, optional): file to write. Defaults to DEFAULT_PATH.
+
+        Returns:
+            int: number of distinct stacks written
+        """
+        with self.lock:
+            stacks = list(self.stacks.items())
+        temp = path + ".tmp"
+        with open(temp, "w", encoding="utf-8") as f:
+            for stack, weight in stacks:
+                f.write(f"{';'.join(stack)} {weight}\n")
+        os.replace(temp, path)
+        return len(stacks)
+
+    def top(self, count: int = 10) -> list:
+        """Functions with the most weight while on top of a stack
+
+        Args:
+            count (int, optional): number of functions. Defaults to 10.
+
+        Returns:
+            list: (label, share of total weight) of each, heaviest first
+        """
+        own = Counter()
+        with self.lock:
+            for stack, weight in self.stacks.items():
+                own[stack[-1]] += weight
+        total = sum(own.values()) or 1
+        return [(label, weight / total) for label, weight in own.most_common(count)]
+
@@ -0,0 +1,319 @@
+import re
+import struct
+import zlib
+
+
+__version__ = "2.1.1"
+__author__ = "FloatingInt"
+
+
+# frame kinds
+TEXT = 0  # utf-8 f"{attr}${value}"
+MOVE = 1  # binary move request
+STEP = 2  # binary move request on both axes
+DEFLATE = 3  # chunk of the zlib stream of a connection, holds whole frames
+
+HEADER = struct.Struct("!IB")  # payload length, kind
+MOVE_BODY = struct.Struct("!Bcb")  # client id, axis, value
+STEP_BODY = struct.Struct("!Bbb")  # client id, x direction, y direction
+MAX_FRAME = 1 << 24  # largest payload accepted by clients (16 MiB)
+MAX_REQUEST = 4096  # largest payload accepted by the server, requests are short
+COMPRESS_MIN = 256  # frames shorter than this are sent raw
+
+# datagram channel: header, then whole frames
+DATAGRAM = struct.Struct("!QI")  # token of connection, sequence number
+MAX_DATAGRAM = 1200  # larger payloads go over the stream, fits any MTU
+
+# one map cell: a colored symbol or a single plain character
+CELL = re.compile("\u001b\\[[0-9;]*m.\u001b\\[0m|.")
+
+
+def pack(kind: int, payload: bytes) -> bytes:
+    """Packs payload into one length-prefixed frame
+
+    Args:
+        kind (int): kind of frame
+        payload (bytes): payload of frame
+
+    Returns:
+        bytes: frame ready to send
+    """
+    return HEADER.pack(len(payload), kind) + payload
+
+
+def pack_text(message: str) -> bytes:
+    """Packs a text message into one frame
+
+    Args:
+        message (str): message to pack
+
+    Returns:
+        bytes: frame ready to send
+    """
+    return pack(TEXT, bytes(message, "utf-8"))
+
+
+def pack_move(cid: int, attr: str, value: int) -> bytes:
+    """Packs a move request into one compact binary frame
+
+    Args:
+        cid (int): id of client moving
+        attr (str): axis, "x" or "y"
+        value (int): direction, -1 or 1
+
+    Returns:
+        bytes: frame ready to send
+    """
+    return pack(MOVE, MOVE_BODY.pack(cid, bytes(attr, "ascii"), value))
+
+
+def unpack_move(payload: bytes) -> tuple:
+    """Unpacks payload of a move frame
+
+    Args:
+        payload (bytes): payload of frame
+
+    Raises:
+        ValueError: payload has the wrong size
+
+    Returns:
+        tuple: client id, axis and value
+    """
+    if len(payload) != MOVE_BODY.size:
+        raise ValueError(f"Move payload of {len(payload)} bytes")
+    cid, attr, value = MOVE_BODY.unpack(payload)
+    return cid, attr.decode("ascii"), value
+
+
+def parse_content(content: str) -> list:
+    """Parses content string into a 2D array of cells.
+    Colored symbols are kept as one cell, same as on the server
+
+    Args:
+        content (str): content as one string
+
+    Returns:
+        list: 2D array (with str elements)
+    """
+    return [CELL.findall(line) for line in content.split("\n")]
+
+
+def apply_delta(content: list, value: str, origin: tuple = (0, 0)) -> list:
+    """Applies changed cells of a delta message to content.
+    Positions in the delta are on the map, content is the viewport at origin
+
+    Format of argument value: f"{x},{y},{cell}|{x},{y},{cell}..."
+
+    Args:
+        content (list): 2D array (with str elements) to update
+        value (str): changed cells
+        origin (tuple, optional): (x, y) of content on the map. Defaults to (0, 0).
+
+    Raises:
+        ValueError: delta is malformed
+        IndexError: delta does not fit content
+
+    Returns:
+        list: (x, y, cell) of each changed cell, relative to content
+    """
+    changes = []
+    for change in value.split("|"):
+        x, y, cell = change.split(",", 2)
+        x, y = int(x) - origin[0], int(y) - origin[1]
+        if x < 0 or y < 0:
+            raise IndexError("Delta outside of viewport")
+        content[y][x] = cell
+        changes.append((x, y, cell))
+    return changes
+
+
+def parse_view(value: str) -> tuple:
+    """Parses value of a "view" message
+
+    Format of argument value: f"{x},{y}"
+
+    Args:
+        value (str): origin of viewport
+
+    Returns:
+        tuple: (x, y) of viewport on the map
+    """
+    x, y = value.split(",")
+    return int(x), int(y)
+
+
+def pack_datagram(token: int, seq: int, frames: bytes) -> bytes:
+    """Packs frames into one datagram
+
+    Args:
+        token (int): token of the connection, given over the stream
+        seq (int): sequence number, one more than the last datagram sent
+        frames (bytes): bytes-like, packed frames, may be empty
+
+    Returns:
+        bytes: datagram ready to send
+    """
+    return DATAGRAM.pack(token, seq) + frames
+
+
+def unpack_datagram(data: bytes) -> tuple:
+    """Unpacks a datagram. Frames must be whole
+
+    Args:
+        data (bytes): datagram received
+
+    Raises:
+        ValueError: datagram is malformed
+
+    Returns:
+        tuple: token, sequence number and list of (kind, payload) of each frame
+    """
+    if len(data) < DATAGRAM.size:
+        raise ValueError("Datagram too short")
+    token, seq = DATAGRAM.unpack_from(data)
+    frames = []
+    offset = DATAGRAM.size
+    while offset < len(data):
+        if len(data) - offset < HEADER.size:
+            raise ValueError("Partial frame in datagram")
+        length, kind = HEADER.unpack_from(data, offset)
+        end = offset + HEADER.size + length
+        if end > len(data):
+            raise ValueError("Partial frame in datagram")
+        frames.append((kind, bytes(data[offset + HEADER.size:end])))
+        offset = end
+    return token, seq, frames
+
+
+def pack_step(cid: int, dx: int, dy: int) -> bytes:
+    """Packs a move on both axes into one compact binary frame
+
+    Args:
+        cid (int): id of client moving
+        dx (int): x direction, -1, 0 or 1
+        dy (int): y direction, -1, 0 or 1
+
+    Returns:
+        bytes: frame ready to send
+    """
+    return pack(STEP, STEP_BODY.pack(cid, dx, dy))
+
+
+def unpack_step(payload: bytes) -> tuple:
+    """Unpacks payload of a step frame
+
+    Args:
+        payload (bytes): payload of frame
+
+    Raises:
+        ValueError: payload has the wrong size
+
+    Returns:
+        tuple: client id, x direction and y direction
+    """
+    if len(payload) != STEP_BODY.size:
+        raise ValueError(f"Step payload of {len(payload)} bytes")
+    return STEP_BODY.unpack(payload)
+
+
+class Deflater:
+    """Compresses frames sent on one connection.
+    One zlib stream per connection, so repeated frames compress
+    against earlier ones. Every chunk is flushed and decodable on arrival
+    """
+    __slots__ = ("stream", "threshold")
+
+    def __init__(self, level: int = 6, threshold: int = COMPRESS_MIN) -> None:
+        """New zlib stream
+
+        Args:
+            level (int, optional): zlib level, 1 (fast) to 9 (small). Defaults to 6.
+            threshold (int, optional): bytes below which data is sent raw. Defaults to COMPRESS_MIN.
+        """
+        self.stream = zlib.compressobj(level)
+        self.threshold = threshold
+
+    def pack(self, data: bytes) -> bytes:
+        """Compresses packed frames into one "deflate" frame
+
+        Args:
+            data (bytes): bytes-like, one or more packed frames
+
+        Returns:
+            bytes: "deflate" frame, or data itself if shorter than threshold
+        """
+        if len(data) < self.threshold:
+            return data
+        return pack(DEFLATE, self.stream.compress(data) +
+                    self.stream.flush(zlib.Z_SYNC_FLUSH))
+
+
+class FrameReader:
+    """Parses frames out of a byte stream.
+    Keeps incomplete frames until the rest arrives
+    """
+
+    def __init__(self, inflate: bool = False, limit: int = MAX_FRAME) -> None:
+        """Frame reader with empty buffer
+
+        Args:
+            inflate (bool, optional): unpack "deflate" frames in place. Defaults to False.
+            limit (int, optional): largest payload accepted. Defaults to MAX_FRAME.
+        """
+        self.buffer = bytearray()
+        self.inflate = inflate
+        self.limit = limit
+        self.stream = None  # zlib stream of "deflate" frames, made on first one
+        self.inner = None  # frame reader of inflated data
+
+    def feed(self, data: bytes) -> list:
+        """Adds received data and parses every complete frame
+
+        Args:
+            data (bytes): data received
+
+        Raises:
+            ValueError: frame is larger than limit, or "deflate" frame is corrupt
+
+        Returns:
+            list: (kind, payload) of each complete frame, in order
+        """
+        self.buffer += data
+        frames = []
+        offset = 0
+        while len(self.buffer) - offset >= HEADER.size:
+            length, kind = HEADER.unpack_from(self.buffer, offset)
+            if length > self.limit:
+                raise ValueError(f"Frame too large: {length}")
+            end = offset + HEADER.size + length
+            if len(self.buffer) < end:
+                break  # wait for rest of frame
+            payload = bytes(self.buffer[offset + HEADER.size:end])
+            offset = end
+            if kind == DEFLATE and self.inflate:
+                frames += self.unpack(payload)
+                continue
+            frames.append((kind, payload))
+        del self.buffer[:offset]
+        return frames
+
+    def unpack(self, payload: bytes) -> list:
+        """Inflates a "deflate" frame, incrementally
+
+        Args:
+            payload (bytes): payload of frame
+
+        Raises:
+            ValueError: data is not part of the zlib stream
+
+        Returns:
+            list: (kind, payload) of each frame inside
+        """
+        if self.stream == None:
+            self.stream = zlib.decompressobj()
+            self.inner = FrameReader(limit=self.limit)
+        try:
+            data = self.stream.decompress(payload)
+        except zlib.error as error:
+            raise ValueError(f"Corrupt compressed frame: {error}") from None
+        return self.inner.feed(data)
@@ -0,0 +1,151 @@
+import argparse
+import json
+import os
+import sys
+import time
+import zlib
+import inputlog
+import server
+
+
+__version__ = "2.1.1"
+__author__ = "FloatingInt"
+
+
+class Replay:
+    """Headless replay of an input log. Inputs go through the same
+    'Room.tick' as on the server, with no sockets and no sleeps,
+    so a replay runs as fast as the game logic allows
+    """
+
+    def __init__(self, header: dict, map_path: str) -> None:
+        """Replay on the map and settings of a log
+
+        Args:
+            header (dict): settings of log, see 'inputlog.read_header'
+            map_path (str): path of map file
+
+        Raises:
+            ValueError: map file is not the one the log was recorded on
+        """
+        if inputlog.map_digest(map_path) != header["digest"]:
+            raise ValueError(f"Map {map_path} is not the map of the log")
+        self.level = server.Level(map_path, header["server_size"])
+        self.view = header["view"]
+        self.rooms = {}  # id -> Room
+        self.sinks = []  # every NullSocket handed out
+
+    def room(self, id: int) -> server.Room:
+        """Gets or makes a room, with every slot connected
+
+        Args:
+            id (int): id of room
+
+        Returns:
+            server.Room: room
+        """
+        room = self.rooms.get(id)
+        if room == None:
+            room = self.rooms[id] = server.Room(id, self.level, self.view)
+            self.connect(room)
+        return room
+
+    def connect(self, room: server.Room) -> None:
+        """Connects every client of a room to a new NullSocket
+
+        Args:
+            room (server.Room): room to connect
+        """
+        for client in room.clients:
+            client.socket = server.NullSocket()
+            self.sinks.append(client.socket)
+
+    def run(self, records: list) -> dict:
+        """Replays records, one room tick per room and logged tick
+
+        Args:
+            records (list): (kind, tick, room, cid, value) in log order
+
+        Returns:
+            dict: throughput and final state of every room
+        """
+        attrs = ("x", "y", "sync")
+        busy = {}  # id -> Room with inputs in current tick
+        current = None
+        ticks = 0
+        start = time.perf_counter()
+        for kind, tick, id, cid, value in records:
+            if tick != current:
+                for room in busy.values():
+                    room.tick()
+                busy.clear()
+                current = tick
+                ticks += 1
+            room = self.room(id)
+            if kind == inputlog.RESET:
+                if busy.pop(id, None) != None:
+                    room.tick()  # inputs before the reset
+                room.reset()
+                self.connect(room)
+                continue
+            room.inputs.append((room.clients[cid - 1], attrs[kind], value))
+            busy[id] = room
+        for room in busy.values():
+            room.tick()
+        seconds = time.perf_counter() - start
+        return {
+            "records": len(records),
+            "ticks": ticks,
+            "seconds": round(seconds, 4),
+            "records_per_sec": round(len(records) / seconds, 1) if seconds else 0.0,
+            "ticks_per_sec": round(ticks / seconds, 1) if seconds else 0.0,
+            "bytes_sent": sum(sink.sent for sink in self.sinks),
+            "rooms": {
+                id: {
+                    "finished": room.finished,
+                    "crc32": zlib.crc32(room.grid),
+                    "players": [(client.id, client.x, client.y) for client in room.clients],
+                }
+                for id, room in sorted(self.rooms.items())
+            },
+        }
+
+
+def replay(path: str, map_path: str = "./temple.map") -> dict:
+    """Replays a whole log
+
+    Args:
+        path (str): path of log file
+        map_path (str, optional): path of map file. Defaults to "./temple.map".
+
+    Returns:
+        dict: results, see 'Replay.run'
+    """
+    header, records = inputlog.read(path)
+    return Replay(header, map_path).run(records)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Replays a Temple Treasure input log as fast as possible")
+    parser.add_argument("log", help="input log written by the server")
+    parser.add_argument("--map", default="./temple.map", help="map the log was recorded on")
+    parser.add_argument("--json", action="store_true", help="print results as json")
+    args = parser.parse_args()
+    sys.stdout, console = open(os.devnull, "w"), sys.stdout  # game prints
+    try:
+        results = replay(args.log, args.map)
+    finally:
+        sys.stdout.close()
+        sys.stdout = console
+    if args.json:
+        print(json.dumps(results))
+        exit(0)
+    print(f"{args.log}: {results['records']} inputs over {results['ticks']} ticks "
+          f"in {results['seconds'] * 1000:.1f} ms")
+    print(f"- {results['records_per_sec']:.1f} inputs/s, {results['ticks_per_sec']:.1f} ticks/s, "
+          f"{results['bytes_sent']} bytes encoded")
+    for id, room in results["rooms"].items():
+        state = "\u001b[32;1mfinished\u001b[0m" if room["finished"] else "playing"
+        players = ", ".join(f"{cid} at {x},{y}" for cid, x, y in room["players"])
+        print(f"- Room {id}: {state}, crc32 {room['crc32']:08x}, {players}")
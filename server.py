@@ -3,142 +3,1833 @@ import threading
 import socket
 import time
 import os
+import asyncio
+import re
+import selectors
+import secrets
+from collections import deque
 from typing import Any
+import protocol
+import metrics
+import maps
+import analyzer
+import inputlog
+import checkpoint
+import profiler
 
 
 __version__ = "2.1.1"
 __author__ = "FloatingInt"
 
+# tile codes of the map grid, one byte per cell
+EMPTY = ord(" ")
+WALL = ord("#")
+RESET = "\u001b[0m"
+STRUCTURE_TILES = re.compile("[!&?]")  # symbols of Key, Door and Goal
+
+# outbound backlog per client, in bytes
+COLLAPSE = 64 * 1024  # skip deltas past this, keyframe once caught up
+LIMIT = 1024 * 1024  # disconnect past this
+
+# most frames in one vectored write to a spectator, below IOV_MAX
+MAX_IOV = 512
+VECTORED = hasattr(socket.socket, "sendmsg")  # not on Windows, frames are joined there
+
+# viewport of a client, in cells. Smaller maps are sent whole
+VIEW_WIDTH = 80
+VIEW_HEIGHT = 24
+
+# instrumentation, see "stats" console command
+REQUESTS = metrics.REGISTRY.counter("requests_total")
+REQUEST_TIME = metrics.REGISTRY.histogram("request_seconds")
+BROADCAST_TIME = metrics.REGISTRY.histogram("broadcast_seconds")
+BYTES_SENT = metrics.REGISTRY.counter("bytes_sent_total")
+BYTES_RECEIVED = metrics.REGISTRY.counter("bytes_received_total")
+BYTES_DEFLATED = metrics.REGISTRY.counter("bytes_deflated_total")  # before compression
+DATAGRAMS_SENT = metrics.REGISTRY.counter("datagrams_sent_total")
+DATAGRAMS_RECEIVED = metrics.REGISTRY.counter("datagrams_received_total")
+DATAGRAMS_DROPPED = metrics.REGISTRY.counter("datagrams_dropped_total")  # stale, duplicate or unknown
+SPECTATOR_BYTES = metrics.REGISTRY.counter("spectator_bytes_sent_total")
+SPECTATORS_SKIPPED = metrics.REGISTRY.counter("spectators_skipped_total")  # sends skipped by slow spectators
+
 
 class ClientInfo:
     """Used to store information about clients and game data associated.
     Use method 'clear' to wipe socket related information.
     Game data is never wiped
     """
+    __slots__ = (
+        "id", "x", "y", "keys", "socket", "address", "sent", "received",
+        "stale", "view", "reserved", "deflater", "udp"
+    )
+
+    def __init__(self, id: int, x: int, y: int) -> None:
+        """Client object to store client info
+
+        Args:
+            id (int): if of client on server
+            x (int): x position
+            y (int): y position
+        """
+        self.id = id
+        self.x = x
+        self.y = y
+        self.keys = set()  # ids of keys held
+        self.socket = None
+        self.address = None
+        self.sent = 0  # bytes sent to socket
+        self.received = 0  # bytes received from socket
+        self.stale = False  # skipped deltas, needs a keyframe
+        self.view = None  # (x, y) origin of viewport on map
+        self.reserved = None  # host the slot is kept for after a restore
+        self.deflater = None  # protocol.Deflater if the client asked for compression
+        self.udp = None  # Channel if the client asked for datagrams
+
+    def clear(self):
+        """Clears socket object, address and byte counts
+        """
+        if self.socket != None:
+            self.socket.close()
+            self.socket = None
+        self.address = None
+        self.sent = 0
+        self.received = 0
+        self.stale = False
+        self.deflater = None
+        if self.udp != None:
+            self.udp.close()
+            self.udp = None
+
+
+class Outbox:
+    """Outbound queue of one connection of the thread engine.
+    'sendall' only queues, a Writer drains the queue with non-blocking sends.
+    Same interface as StreamSocket
+    """
+
+    def __init__(self, sock: socket.socket, writer: "Writer") -> None:
+        """Wrap socket. The socket is made non-blocking
+
+        Args:
+            sock (socket.socket): socket of the connection
+            writer (Writer): writer draining this outbox
+        """
+        sock.setblocking(False)
+        self.sock = sock
+        self.writer = writer
+        self.queue = deque()  # memoryviews, first may be partly sent
+        self.pending = 0  # bytes queued
+        self.closing = False
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def sendall(self, data: Any) -> None:
+        """Queues data. Never blocks
+
+        Args:
+            data (Any): bytes-like to send
+
+        Raises:
+            ConnectionResetError: closed, or backlog over LIMIT
+        """
+        if self.closing or self.closed:
+            raise ConnectionResetError
+        if self.pending > LIMIT:
+            self.abort()
+            self.writer.wake(self)  # writer stops watching the socket
+            raise ConnectionResetError("Backlog over limit")
+        with self.lock:
+            self.queue.append(memoryview(data))
+            self.pending += len(data)
+        self.writer.wake(self)
+
+    send = sendall
+
+    def backlog(self) -> int:
+        """Bytes queued and not yet sent
+
+        Returns:
+            int: size of backlog
+        """
+        return self.pending
+
+    def flush(self) -> bool:
+        """Sends as much as the socket takes without blocking.
+        Called by the writer
+
+        Returns:
+            bool: True if data is left in queue
+        """
+        with self.lock:
+            while self.queue:
+                head = self.queue[0]
+                try:
+                    sent = self.sock.send(head)
+                except (BlockingIOError, InterruptedError):
+                    return True
+                except OSError:
+                    self.queue.clear()
+                    self.pending = 0
+                    self.abort()
+                    return False
+                self.pending -= sent
+                if sent < len(head):
+                    self.queue[0] = head[sent:]
+                    return True
+                self.queue.popleft()
+        if self.closing:
+            self.abort()  # everything sent
+        return False
+
+    def close(self) -> None:
+        """Closes the socket once the queue is sent
+        """
+        self.closing = True
+        self.writer.wake(self)
+
+    def abort(self) -> None:
+        """Closes the socket now, dropping the queue
+        """
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)  # wakes recv thread
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class Writer:
+    """Drains every Outbox of the thread engine on one thread
+    """
+
+    def __init__(self) -> None:
+        """Writer with nothing to write
+        """
+        self.selector = selectors.DefaultSelector()
+        self.ready = deque()  # outboxes with new data
+        self.waiting = set()  # outboxes waiting for socket to take more
+        self.waker, self.waker_out = socket.socketpair()
+        self.waker.setblocking(False)
+        self.waker_out.setblocking(False)
+        self.selector.register(self.waker, selectors.EVENT_READ)
+
+    def wake(self, outbox: Outbox) -> None:
+        """Tells the writer that an outbox has data or is closing
+
+        Args:
+            outbox (Outbox): outbox to drain
+        """
+        self.ready.append(outbox)
+        try:
+            self.waker_out.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass  # already awake
+
+    def run(self, running: Any) -> None:
+        """Drains outboxes until running returns False. Own thread
+
+        Args:
+            running (Callable): returns False to stop
+        """
+        while running():
+            for key, _mask in self.selector.select(0.5):
+                if key.fileobj is self.waker:
+                    try:
+                        while self.waker.recv(4096):
+                            pass
+                    except (BlockingIOError, OSError):
+                        pass
+                else:
+                    self.drain(key.data)
+            while self.ready:
+                self.drain(self.ready.popleft())
+
+    def drain(self, outbox: Outbox) -> None:
+        """Flushes an outbox and watches its socket while data is left.
+        Closed outboxes are never watched
+
+        Args:
+            outbox (Outbox): outbox to drain
+        """
+        left = False if outbox.closed else outbox.flush()
+        if left and outbox not in self.waiting:
+            self.watch(outbox)
+        elif not left and outbox in self.waiting:
+            self.waiting.discard(outbox)
+            try:
+                self.selector.unregister(outbox.sock)
+            except (KeyError, ValueError, OSError):
+                pass  # closed meanwhile
+
+    def watch(self, outbox: Outbox) -> None:
+        """Watches the socket of an outbox for write space.
+        A closed outbox still registered with the same fd is dropped first
+
+        Args:
+            outbox (Outbox): outbox with data left
+        """
+        stale = self.selector.get_map().get(outbox.sock.fileno())
+        if stale != None:
+            self.waiting.discard(stale.data)
+            try:
+                self.selector.unregister(stale.fileobj)
+            except (KeyError, ValueError, OSError):
+                pass
+        self.selector.register(outbox.sock, selectors.EVENT_WRITE, outbox)
+        self.waiting.add(outbox)
+
+
+class StreamSocket:
+    """Socket-like wrapper around an asyncio stream writer.
+    Lets the game logic call 'send' and 'close' the same way
+    it does on a blocking socket, from any thread
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, writer: asyncio.StreamWriter) -> None:
+        """Wrap stream writer
+
+        Args:
+            loop (asyncio.AbstractEventLoop): loop the writer belongs to
+            writer (asyncio.StreamWriter): writer of the connection
+        """
+        self.loop = loop
+        self.writer = writer
+
+    def send(self, data: bytes) -> int:
+        """Queue data on the stream. Never blocks
+
+        Args:
+            data (bytes): data to send
+
+        Returns:
+            int: number of bytes queued
+
+        Raises:
+            ConnectionResetError: closed, or backlog over LIMIT
+        """
+        if self.writer.is_closing():
+            raise ConnectionResetError
+        if self.backlog() > LIMIT:
+            self.abort()
+            raise ConnectionResetError("Backlog over limit")
+        if self.in_loop():
+            self.writer.write(data)
+        else:
+            self.loop.call_soon_threadsafe(self.writer.write, data)
+        return len(data)
+
+    sendall = send  # writer never sends partially
+
+    def backlog(self) -> int:
+        """Bytes buffered and not yet sent
+
+        Returns:
+            int: size of backlog
+        """
+        return self.writer.transport.get_write_buffer_size()
+
+    def close(self) -> None:
+        """Closes the stream once the buffer is sent
+        """
+        if self.in_loop():
+            self.writer.close()
+        else:
+            self.loop.call_soon_threadsafe(self.writer.close)
+
+    def abort(self) -> None:
+        """Closes the stream now, dropping the buffer
+        """
+        if self.in_loop():
+            self.writer.transport.abort()
+        else:
+            self.loop.call_soon_threadsafe(self.writer.transport.abort)
+
+    def in_loop(self) -> bool:
+        """Whether the caller runs inside the event loop thread
+
+        Returns:
+            bool: True if called from the event loop
+        """
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+
+class NullSocket:
+    """Connection that accepts everything and sends nothing.
+    Stands in for real sockets in benchmarks and headless replays
+    """
+    __slots__ = ("sent",)
+
+    def __init__(self) -> None:
+        """Null socket with nothing sent
+        """
+        self.sent = 0
+
+    def sendall(self, data) -> None:
+        """Counts data as sent
+
+        Args:
+            data (Any): bytes-like to send
+        """
+        self.sent += len(data)
+
+    send = sendall
+
+    def backlog(self) -> int:
+        """Nothing is ever queued
+
+        Returns:
+            int: always 0
+        """
+        return 0
+
+    def close(self) -> None:
+        """Nothing to close
+        """
+        pass
+
+
+class Channel:
+    """Datagram channel of one client, next to its stream.
+    Carries sequence-numbered moves in and deltas out
+    """
+    __slots__ = ("token", "datagrams", "address", "received", "sent")
+
+    def __init__(self, token: int, datagrams: "Datagrams") -> None:
+        """Channel with no address yet. The address is learned
+        from the first datagram of the client
+
+        Args:
+            token (int): token of channel, told to the client over the stream
+            datagrams (Datagrams): registry sending datagrams
+        """
+        self.token = token
+        self.datagrams = datagrams
+        self.address = None  # (host, port) of last datagram received
+        self.received = 0  # last sequence number received
+        self.sent = 0  # last sequence number sent
+
+    def ready(self, size: int) -> bool:
+        """Whether frames can go over the channel
+
+        Args:
+            size (int): bytes to send
+
+        Returns:
+            bool: True if the address is known and size fits a datagram
+        """
+        return self.address != None and \
+            size <= protocol.MAX_DATAGRAM - protocol.DATAGRAM.size
+
+    def send(self, frames: bytes) -> int:
+        """Sends frames as one datagram. May be lost, never blocks
+
+        Args:
+            frames (bytes): bytes-like, packed frames
+
+        Returns:
+            int: bytes sent
+        """
+        self.sent += 1
+        data = protocol.pack_datagram(self.token, self.sent, frames)
+        self.datagrams.sendto(data, self.address)
+        return len(data)
+
+    def close(self) -> None:
+        """Forgets the token, later datagrams are dropped
+        """
+        self.datagrams.channels.pop(self.token, None)
+
+
+class Datagrams:
+    """Registry of datagram channels of one server socket.
+    Datagrams from unknown tokens and stale or duplicate sequence
+    numbers are dropped. Only moves are accepted, anything else goes
+    over the stream
+    """
+
+    def __init__(self) -> None:
+        """Registry with no channels and no socket
+        """
+        self.channels = {}  # token -> (room, client)
+        self.transport = None  # socket or asyncio transport with 'sendto'
+
+    def open(self, room: "Room", client: ClientInfo) -> Channel:
+        """Opens a channel for a client. Simulation worker only
+
+        Args:
+            room (Room): room the client is in
+            client (ClientInfo): client asking
+
+        Returns:
+            Channel: channel, token to be told over the stream
+        """
+        token = secrets.randbits(64)
+        while token in self.channels:
+            token = secrets.randbits(64)
+        self.channels[token] = (room, client)
+        return Channel(token, self)
+
+    def sendto(self, data: bytes, address: tuple) -> None:
+        """Sends one datagram, drops it if the socket does not take it
+
+        Args:
+            data (bytes): datagram
+            address (tuple): (host, port) to send to
+        """
+        try:
+            self.transport.sendto(data, address)
+        except (OSError, AttributeError):
+            DATAGRAMS_DROPPED.inc()  # buffer full or closed, same as lost
+            return
+        DATAGRAMS_SENT.inc()
+        BYTES_SENT.inc(len(data))
+
+    def receive(self, data: bytes, address: tuple) -> None:
+        """Handles one datagram. Only parses and enqueues, any thread
+
+        Args:
+            data (bytes): datagram received
+            address (tuple): (host, port) it came from
+        """
+        try:
+            token, seq, frames = protocol.unpack_datagram(data)
+        except ValueError:
+            DATAGRAMS_DROPPED.inc()
+            return
+        room, client = self.channels.get(token, (None, None))
+        channel = client.udp if client != None else None
+        if channel == None or channel.token != token or seq <= channel.received:
+            DATAGRAMS_DROPPED.inc()  # unknown, stale or duplicate
+            return
+        channel.received = seq
+        channel.address = address  # follows the client across NAT rebinding
+        client.received += len(data)
+        DATAGRAMS_RECEIVED.inc()
+        BYTES_RECEIVED.inc(len(data))
+        for kind, payload in frames:
+            if kind in (protocol.MOVE, protocol.STEP):
+                try:
+                    room.handle_frame(client, kind, payload)
+                except (IndexError, ValueError):
+                    DATAGRAMS_DROPPED.inc()
+
+
+class DatagramEndpoint(asyncio.DatagramProtocol):
+    """Datagram socket of the asyncio engine
+    """
+
+    def __init__(self, datagrams: Datagrams) -> None:
+        """Endpoint feeding a registry
+
+        Args:
+            datagrams (Datagrams): registry to feed
+        """
+        self.datagrams = datagrams
+
+    def connection_made(self, transport: asyncio.DatagramTransport) -> None:
+        self.datagrams.transport = transport
+
+    def datagram_received(self, data: bytes, address: tuple) -> None:
+        self.datagrams.receive(data, address)
+
+
+class Spectator:
+    """Read-only connection watching one room. Owned by the fan-out worker
+    """
+    __slots__ = ("sock", "address", "feed", "pending", "behind", "joined", "frames")
+
+    def __init__(self, sock: socket.socket, address: tuple) -> None:
+        """Spectator waiting for its first keyframe
+
+        Args:
+            sock (socket.socket): non-blocking socket of the connection
+            address (tuple): address of the connection
+        """
+        self.sock = sock
+        self.address = address
+        self.feed = None  # Feed watched
+        self.pending = None  # memoryview of data the socket did not take yet
+        self.behind = True  # needs a keyframe before the next delta
+        self.joined = False  # got the handshake
+        self.frames = protocol.FrameReader(limit=protocol.MAX_REQUEST)
+
+
+class Feed:
+    """Spectator side of a room. The simulation worker publishes one
+    frame per tick into it, the fan-out worker sends it to every watcher
+    """
+    __slots__ = ("room", "watchers", "watching", "wanted", "body", "keyframe", "handshake")
+
+    def __init__(self, room: int) -> None:
+        """Feed without watchers
+
+        Args:
+            room (int): id of room
+        """
+        self.room = room
+        self.watchers = set()  # Spectator, fan-out worker only
+        self.watching = 0  # len(watchers), read by the simulation worker
+        self.wanted = False  # a watcher needs a keyframe, set by the fan-out worker
+        self.body = None  # content of last keyframe
+        self.keyframe = None  # "content" frame of body, packed once
+        self.handshake = None  # handshake frame of body, packed once
+
+
+class FanOut:
+    """Sends the frames of every room to its spectators, on its own thread.
+    Frames are encoded once per tick by the simulation worker and
+    shared by every watcher. A watcher whose socket does not take a frame
+    skips every frame until it caught up, then gets one keyframe.
+    Also accepts spectators and reads their "watch" requests
+    """
+
+    def __init__(self, server_size: int, choose: Any) -> None:
+        """Fan-out worker without spectators
+
+        Args:
+            server_size (int): maximum allowed clients per room, sent in handshake
+            choose (Callable): returns id of room to watch, given the id asked for or None
+        """
+        self.server_size = server_size
+        self.choose = choose
+        self.feeds = {}  # room id -> Feed
+        self.inbox = deque()  # (feed, frame, body, resync) from the simulation worker
+        self.spectators = set()
+        self.listener = None
+        self.selector = selectors.DefaultSelector()
+        self.waker, self.waker_out = socket.socketpair()
+        self.waker.setblocking(False)
+        self.waker_out.setblocking(False)
+        self.selector.register(self.waker, selectors.EVENT_READ)
+
+    def open(self, room: int) -> Feed:
+        """Gets or makes the feed of a room. Any thread
+
+        Args:
+            room (int): id of room
+
+        Returns:
+            Feed: feed of room
+        """
+        return self.feeds.setdefault(room, Feed(room))
+
+    def listen(self, sock: socket.socket) -> None:
+        """Accepts spectators on a listening socket
+
+        Args:
+            sock (socket.socket): bound and listening socket
+        """
+        sock.setblocking(False)
+        self.listener = sock
+        self.selector.register(sock, selectors.EVENT_READ)
+
+    def publish(self, feed: Feed, frame: bytes, body: bytes = None, resync: bool = False) -> None:
+        """Hands the frame of a tick over. Simulation worker only, never blocks
+
+        Args:
+            feed (Feed): feed of room
+            frame (bytes): packed frames of tick, may be empty
+            body (bytes, optional): content after this tick, for keyframes. Defaults to None.
+            resync (bool, optional): every watcher needs a keyframe (room recycled). Defaults to False.
+        """
+        self.inbox.append((feed, frame, body, resync))
+        try:
+            self.waker_out.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass  # already awake
+
+    def run(self, running: Any) -> None:
+        """Serves spectators until running returns False. Own thread
+
+        Args:
+            running (Callable): returns False to stop
+        """
+        while running():
+            for key, mask in self.selector.select(0.5):
+                if key.fileobj is self.waker:
+                    try:
+                        while self.waker.recv(4096):
+                            pass
+                    except (BlockingIOError, OSError):
+                        pass
+                elif key.fileobj is self.listener:
+                    self.accept()
+                else:
+                    if mask & selectors.EVENT_WRITE:
+                        self.flush(key.data)
+                    if mask & selectors.EVENT_READ:
+                        self.receive(key.data)
+            self.deliver()
+        for spectator in tuple(self.spectators):
+            self.drop(spectator)
+        if self.listener != None:
+            self.listener.close()
+
+    def accept(self) -> None:
+        """Accepts every waiting spectator
+        """
+        while True:
+            try:
+                sock, address = self.listener.accept()
+            except (BlockingIOError, OSError):
+                return
+            sock.setblocking(False)
+            spectator = Spectator(sock, address)
+            self.spectators.add(spectator)
+            self.selector.register(sock, selectors.EVENT_READ, spectator)
+            self.watch(spectator, self.choose(None))
+            print(f"-- Spectator [{address[1]}] is watching room {spectator.feed.room} --")
+
+    def watch(self, spectator: Spectator, room: int) -> None:
+        """Moves a spectator to the feed of a room
+
+        Args:
+            spectator (Spectator): spectator
+            room (int): id of room
+        """
+        if spectator.feed != None:
+            spectator.feed.watchers.discard(spectator)
+            spectator.feed.watching = len(spectator.feed.watchers)
+        feed = self.open(room)
+        spectator.feed = feed
+        spectator.behind = True
+        feed.watchers.add(spectator)
+        feed.watching = len(feed.watchers)
+        feed.wanted = True
+
+    def receive(self, spectator: Spectator) -> None:
+        """Reads "watch" requests of a spectator
+
+        Format: f"0$watch${room}"
+
+        Args:
+            spectator (Spectator): spectator with data to read
+        """
+        try:
+            data = spectator.sock.recv(4096)
+            if not data:
+                raise ConnectionAbortedError
+            frames = spectator.frames.feed(data)
+        except (BlockingIOError, InterruptedError):
+            return
+        except (OSError, ValueError):
+            self.drop(spectator)
+            return
+        for kind, payload in frames:
+            _cid, attr, value, *_rest = payload.decode("utf-8", "replace").split("$") + ["", ""]
+            if kind == protocol.TEXT and attr.startswith("watch") and value.isdigit():
+                self.watch(spectator, self.choose(int(value)))
+
+    def deliver(self) -> None:
+        """Sends every frame handed over since last call.
+        Frames of one feed are sent with one vectored write per watcher
+        """
+        batches = {}  # feed -> [(frame, body, resync)]
+        while self.inbox:
+            feed, frame, body, resync = self.inbox.popleft()
+            batches.setdefault(feed, []).append((frame, body, resync))
+        for feed, items in batches.items():
+            start = 0  # first item after the last keyframe
+            for index, (_frame, body, resync) in enumerate(items):
+                if resync:
+                    for spectator in feed.watchers:
+                        spectator.behind = True
+                if body != None:
+                    feed.body, feed.keyframe, feed.handshake = body, None, None
+                    start = index
+            keyed = any(body != None for _frame, body, _resync in items)
+            frames = [frame for frame, _body, _resync in items if frame]
+            after = [frame for frame, _body, _resync in items[start + 1:] if frame]
+            for spectator in tuple(feed.watchers):
+                if spectator.pending != None:
+                    spectator.behind = True  # slow, skip to latest
+                    SPECTATORS_SKIPPED.inc()
+                elif spectator.behind:
+                    if keyed:
+                        self.write(spectator, [self.key(feed, spectator)] + after)
+                    else:
+                        feed.wanted = True
+                elif frames:
+                    self.write(spectator, frames)
+
+    def key(self, feed: Feed, spectator: Spectator) -> bytes:
+        """Keyframe for a spectator, packed once per body and kind.
+        New spectators get it as handshake
+
+        Args:
+            feed (Feed): feed watched
+            spectator (Spectator): spectator behind
+
+        Returns:
+            bytes: packed handshake or "content" frame
+        """
+        spectator.behind = False
+        if spectator.joined:
+            if feed.keyframe == None:
+                feed.keyframe = protocol.pack(protocol.TEXT, b"content$" + feed.body)
+            return feed.keyframe
+        spectator.joined = True
+        if feed.handshake == None:
+            feed.handshake = protocol.pack(
+                protocol.TEXT, bytes(f"0${self.server_size}$", "utf-8") + feed.body)
+        return feed.handshake
+
+    def write(self, spectator: Spectator, frames: list) -> None:
+        """Sends frames with one vectored write, or one joined send where
+        sockets have no 'sendmsg'. Keeps what the socket did not take
+
+        Args:
+            spectator (Spectator): spectator to send to
+            frames (list): packed frames
+        """
+        if len(frames) > MAX_IOV or not VECTORED:
+            frames = [b"".join(frames)]
+        try:
+            if VECTORED:
+                sent = spectator.sock.sendmsg(frames)
+            else:
+                sent = spectator.sock.send(frames[0])
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            self.drop(spectator)
+            return
+        SPECTATOR_BYTES.inc(sent)
+        total = sum(len(frame) for frame in frames)
+        if sent < total:
+            spectator.pending = memoryview(b"".join(frames))[sent:]
+            self.selector.modify(spectator.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, spectator)
+
+    def flush(self, spectator: Spectator) -> None:
+        """Sends what a slow spectator has left. Once done it waits for a keyframe
+
+        Args:
+            spectator (Spectator): spectator to send to
+        """
+        if spectator.pending == None:
+            return
+        try:
+            sent = spectator.sock.send(spectator.pending)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self.drop(spectator)
+            return
+        SPECTATOR_BYTES.inc(sent)
+        spectator.pending = spectator.pending[sent:]
+        if spectator.pending:
+            return
+        spectator.pending = None
+        self.selector.modify(spectator.sock, selectors.EVENT_READ, spectator)
+        if spectator.behind:
+            spectator.feed.wanted = True
+
+    def drop(self, spectator: Spectator) -> None:
+        """Closes a spectator
+
+        Args:
+            spectator (Spectator): spectator to close
+        """
+        if spectator not in self.spectators:
+            return
+        self.spectators.discard(spectator)
+        spectator.feed.watchers.discard(spectator)
+        spectator.feed.watching = len(spectator.feed.watchers)
+        try:
+            self.selector.unregister(spectator.sock)
+        except (KeyError, ValueError):
+            pass
+        spectator.sock.close()
+        print(f"= Spectator [{spectator.address[1]}] has disconnected")
+
+
+class Structure:
+    """Base class for structures to interact with on the map
+
+    Returns:
+        Structure: subclass object of Structure
+    """
+    __slots__ = ("id", "color", "x", "y")
+    symbol = "^"  # error symbol
+
+    def __init__(self, id: int, color: str, x: int, y: int) -> None:
+        self.id = id
+        self.color = color
+        self.x = x
+        self.y = y
+
+    def __repr__(self) -> str:
+        return self.color + self.symbol + "\u001b[0m"
+
+
+class Goal(Structure):
+    """Structure: Goal
+    """
+    __slots__ = ()
+    symbol = "?"
+
+
+class Key(Structure):
+    """Structure: Key
+    """
+    __slots__ = ()
+    symbol = "!"
+
+
+class Door(Structure):
+    """Structure: Door
+    """
+    __slots__ = ()
+    symbol = "&"
+
+
+STRUCTURES = {"key": Key, "door": Door, "goal": Goal}  # kind in map file -> class
+
+
+class Level:
+    """Map data parsed once and shared read-only by every Room
+    """
+    __slots__ = ("grid", "width", "height", "spawns", "structures")
+
+    def __init__(self, path: str, server_size: int) -> None:
+        """Load map and place structures. See maps.py for the map format
+
+        Args:
+            path (str): path of map file
+            server_size (int): maximum allowed clients per room
+        """
+        data = maps.load(path)  # compiled once, then memory-mapped
+        self.width = data.width
+        self.height = data.height
+        self.grid = data.grid  # read-only, shared by every room
+        self.spawns = []  # (cid, x, y)
+        unused = []
+        for cid, x, y in data.spawns:
+            if cid <= server_size:
+                self.spawns.append((cid, x, y))
+            else:
+                unused.append(y * self.width + x)
+        if unused:  # clear spawns of clients that never join
+            grid = bytearray(self.grid)
+            for index in unused:
+                grid[index] = EMPTY
+            self.grid = bytes(grid)
+        self.structures = {}  # (x, y) -> Structure
+        for kind, id, color, x, y in data.structures:
+            self.structures[(x, y)] = STRUCTURES[kind](
+                id, f"\u001b[{color}m", x, y)  # color side table
+
+
+class Snapshot:
+    """Read-only view of a room, published by the simulation worker.
+    Other threads (console, metrics) read it instead of the live room
+    """
+    __slots__ = ("room", "version", "finished", "players", "reserved")
+
+    def __init__(self, room: int, version: int, finished: bool, players: tuple, reserved: tuple = ()) -> None:
+        """Snapshot of a room
+
+        Args:
+            room (int): id of room
+            version (int): render version of map
+            finished (bool): whether the goal was reached
+            players (tuple): (id, address, x, y) of each connected client
+            reserved (tuple, optional): hosts slots are kept for after a restore. Defaults to ().
+        """
+        self.room = room
+        self.version = version
+        self.finished = finished
+        self.players = players
+        self.reserved = reserved
+
+
+class Room:
+    """One game instance with its own map and clients.
+    A room is recycled with 'reset' when its last client leaves
+    """
+    __slots__ = (
+        "id", "level", "clients", "grid", "width", "height", "structures",
+        "inputs", "changes", "pending", "row_cache", "dirty", "body",
+        "version", "keyframe_version", "keyframe_cache", "finished", "queued",
+        "snapshot", "view_width", "view_height", "window_cache", "log", "compress",
+        "datagrams", "fanout", "feed"
+    )
+
+    def __init__(self, id: int, level: Level, view: tuple = (VIEW_WIDTH, VIEW_HEIGHT), log: inputlog.InputLog = None, compress: int = 0, datagrams: Datagrams = None, fanout: FanOut = None) -> None:
+        """Room playing a fresh game of level
+
+        Args:
+            id (int): id of room on server
+            level (Level): level to play, shared with other rooms
+            view (tuple, optional): width and height of viewport. Defaults to (VIEW_WIDTH, VIEW_HEIGHT).
+            log (inputlog.InputLog, optional): log of applied inputs. Defaults to None.
+            compress (int, optional): zlib level offered to clients, 0 for none. Defaults to 0.
+            datagrams (Datagrams, optional): datagram channels offered to clients, None for none. Defaults to None.
+            fanout (FanOut, optional): sends the room to spectators, None for none. Defaults to None.
+        """
+        self.id = id
+        self.level = level
+        self.compress = compress
+        self.datagrams = datagrams
+        self.fanout = fanout
+        self.feed = fanout.open(id) if fanout != None else None
+        self.view_width, self.view_height = view
+        self.log = None  # fresh room, nothing to log
+        self.inputs = deque()  # (client, attr, value) until next tick
+        self.queued = False  # waiting in matchmaking queue
+        self.reset()
+        self.log = log
+
+    def reset(self) -> None:
+        """Restores a fresh game of the level. Sockets are not closed
+        """
+        level = self.level
+        self.width = level.width
+        self.height = level.height
+        self.grid = bytearray(level.grid)
+        self.structures = dict(level.structures)  # (x, y) -> Structure still on map
+        self.clients = [ClientInfo(cid, x, y) for cid, x, y in level.spawns]
+        self.inputs.clear()
+        self.changes = {}  # (x, y) -> tile code, not yet broadcasted
+        self.pending = []  # messages to broadcast with next delta
+        self.row_cache = [b""] * self.height  # encoded rows
+        self.dirty = set(range(self.height))  # rows to render again
+        self.body = b""  # encoded map, as of last render
+        self.version = 0  # bumped every time the map is rendered again
+        self.keyframe_version = -1
+        self.keyframe_cache = memoryview(b"")
+        self.window_cache = {}  # (x, y) origin -> (version, packed frame)
+        self.finished = False
+        if self.log != None:
+            self.log.reset(self.id)
+        if self.feed != None and self.feed.watching:
+            self.feed.wanted = False
+            self.fanout.publish(self.feed, b"", self.render(), True)  # every watcher starts over
+        self.publish()
+
+    def publish(self) -> Snapshot:
+        """Publishes a new snapshot of the room. Simulation worker only
+
+        Returns:
+            Snapshot: snapshot published
+        """
+        self.snapshot = Snapshot(self.id, self.version, self.finished, tuple(
+            (client.id, client.address, client.x, client.y)
+            for client in self.clients if client.socket != None), tuple(
+            client.reserved for client in self.clients
+            if client.socket == None and client.reserved != None))
+        return self.snapshot
+
+    def save(self) -> tuple:
+        """Copies the game state of the room for a checkpoint.
+        Simulation worker only, the copy is encoded on another thread
+
+        Returns:
+            tuple: id, finished, grid, (x, y) of structures left and (id, x, y, keys, host) of each client
+        """
+        return (self.id, self.finished, bytes(self.grid), frozenset(self.structures), tuple(
+            (client.id, client.x, client.y, tuple(client.keys),
+             client.address[0] if client.socket != None else client.reserved)
+            for client in self.clients))
+
+    def restore(self, saved: tuple) -> None:
+        """Restores the game state of a checkpoint. Every client is
+        disconnected, slots of connected clients are kept for their host.
+        No reset is logged: the last checkpoint is written after the last
+        input, so a replay of the log reaches the saved state on its own
+
+        Args:
+            saved (tuple): game state, see 'save'
+        """
+        _id, finished, grid, structures, clients = saved
+        log, self.log = self.log, None  # not recycled, the log goes on from the saved state
+        self.reset()
+        self.log = log
+        self.grid[:] = grid
+        self.structures = {position: self.level.structures[position]
+                           for position in structures}
+        for cid, x, y, keys, host in clients:
+            client = self.clients[cid - 1]
+            client.x, client.y = x, y
+            client.keys = set(keys)
+            client.reserved = host
+        self.finished = finished
+        self.publish()
+
+    def reservations(self) -> int:
+        """Number of slots kept for clients reconnecting after a restore
+
+        Returns:
+            int: free slots with a host
+        """
+        return sum(1 for client in self.clients
+                   if client.socket == None and client.reserved != None)
+
+    def players(self) -> int:
+        """Number of connected clients
+
+        Returns:
+            int: clients with a socket
+        """
+        return sum(1 for client in self.clients if client.socket != None)
+
+    def is_open(self) -> bool:
+        """Whether a new client can join
+
+        Returns:
+            bool: True if not finished and a slot is free and not kept
+        """
+        return not self.finished and \
+            self.players() + self.reservations() < len(self.clients)
+
+    def accept(self, clientsocket: Any, address: tuple) -> ClientInfo:
+        """Handshake with a new connection and assign it a free ClientInfo.
+        Sends f"{index}${server_size}${content}" as one frame,
+        content being the viewport of the client, followed by a "view" frame.
+        An index greater than server_size tells the client the room is full.
+        A slot kept for the host of the connection is taken first
+
+        Args:
+            clientsocket (Any): socket (or StreamSocket) of the connection
+            address (tuple): address of the connection
+
+        Returns:
+            ClientInfo: client assigned, or None if full or failed
+        """
+        free = None
+        for client in self.clients:
+            if client.socket != None:
+                continue
+            if client.reserved == address[0]:
+                free = client  # reconnecting after a restore
+                break
+            if free == None and client.reserved == None:
+                free = client
+        index = free.id if free != None else len(self.clients) + 1
+        head = bytes(f"{index}${len(self.clients)}$", "utf-8")
+        view = b""
+        if free != None:
+            free.view = None
+            self.follow(free)
+            body = self.window_body(*free.view)
+            view = protocol.pack_text(f"view${free.view[0]},{free.view[1]}")
+        else:
+            body = self.render()
+        try:
+            clientsocket.sendall(b"".join([
+                protocol.HEADER.pack(len(head) + len(body), protocol.TEXT),
+                head,
+                body,
+                view
+            ]))
+        except ConnectionError:
+            clientsocket.close()
+            return None
+        if free == None:
+            clientsocket.close()  # room is full
+            return None
+        # keep track of new client socket in existing ClientInfo obj
+        free.address = address
+        free.socket = clientsocket
+        free.reserved = None
+        return free
+
+    def tick(self) -> None:
+        """Applies every input queued since last tick in one pass,
+        then broadcasts at most one update and publishes a snapshot.
+        Only the last input per client and attribute is kept.
+        Inputs of clients that left are dropped, applied ones are logged
+        """
+        inputs = {}
+        for _ in range(len(self.inputs)):
+            client, attr, value = self.inputs.popleft()
+            if client.socket == None:
+                continue  # left before this tick
+            inputs[(client.id, attr)] = (client, attr, value)
+        for client, attr, value in inputs.values():
+            start = time.perf_counter()
+            try:
+                self.handle_input(client, attr, value)
+            except (TypeError, ValueError, OverflowError) as error:
+                print(f"= Client {client.id} in room {self.id} sent a bad input: {type(error).__name__}")
+                continue  # never stops the simulation worker
+            REQUEST_TIME.observe(time.perf_counter() - start)
+            if self.log != None:
+                self.log.write(self.id, client.id, attr, value)
+        REQUESTS.inc(len(inputs))
+        self.flush()
+        self.publish()
+
+    def stringify(self) -> str:
+        """Renders the map grid as one string, with structures colorized
+
+        Returns:
+            str: content as one string
+        """
+        return self.render().decode("utf-8")
+
+    def render(self) -> bytes:
+        """Renders the map grid as encoded content.
+        Only rows changed since last call are rendered again
+
+        Returns:
+            bytes: content as utf-8
+        """
+        if self.dirty:
+            for y in self.dirty:
+                self.row_cache[y] = bytes(self.render_row(y), "utf-8")
+            self.dirty.clear()
+            self.body = b"\n".join(self.row_cache)
+            self.version += 1
+        return self.body
+
+    def keyframe(self) -> memoryview:
+        """Full "content" frame of the current map.
+        Packed once per version and shared by every recipient
+
+        Returns:
+            memoryview: packed frame
+        """
+        body = self.render()
+        if self.keyframe_version != self.version:
+            self.keyframe_cache = memoryview(
+                protocol.pack(protocol.TEXT, b"content$" + body))
+            self.keyframe_version = self.version
+        return self.keyframe_cache
+
+    def whole(self) -> bool:
+        """Whether the viewport covers the whole map
+
+        Returns:
+            bool: True if every client sees every cell
+        """
+        return self.view_width >= self.width and self.view_height >= self.height
+
+    def follow(self, client: ClientInfo) -> bool:
+        """Moves the viewport of a client if it got near the edge.
+        Origins snap to half a viewport, so nearby clients share one
+
+        Args:
+            client (ClientInfo): client to follow
+
+        Returns:
+            bool: True if the viewport moved
+        """
+        width = min(self.view_width, self.width)
+        height = min(self.view_height, self.height)
+        if client.view != None:
+            x, y = client.view
+            margin_x, margin_y = width // 4, height // 4
+            # keep viewport unless client is within margin of an inner edge
+            if (client.x >= x + margin_x or x == 0) and \
+                    (client.x < x + width - margin_x or x + width == self.width) and \
+                    (client.y >= y + margin_y or y == 0) and \
+                    (client.y < y + height - margin_y or y + height == self.height) and \
+                    x <= client.x < x + width and y <= client.y < y + height:
+                return False
+        step_x, step_y = max(1, width // 2), max(1, height // 2)
+        x = round((client.x - width // 2) / step_x) * step_x
+        y = round((client.y - height // 2) / step_y) * step_y
+        view = (min(max(x, 0), self.width - width),
+                min(max(y, 0), self.height - height))
+        if view == client.view:
+            return False
+        client.view = view
+        return True
+
+    def window_body(self, x: int, y: int) -> bytes:
+        """Renders the viewport at an origin as encoded content
+
+        Args:
+            x (int): x origin
+            y (int): y origin
+
+        Returns:
+            bytes: content as utf-8
+        """
+        if self.whole():
+            return self.render()
+        end = x + self.view_width
+        return bytes("\n".join(
+            self.render_row(row, x, end)
+            for row in range(y, min(y + self.view_height, self.height))), "utf-8")
+
+    def window(self, x: int, y: int) -> memoryview:
+        """Packed "content" frame of the viewport at an origin.
+        Packed once per version and origin, shared by every client there
+
+        Args:
+            x (int): x origin
+            y (int): y origin
+
+        Returns:
+            memoryview: packed frame
+        """
+        if self.whole():
+            return self.keyframe()
+        self.render()  # bring version up to date
+        cached = self.window_cache.get((x, y))
+        if cached != None and cached[0] == self.version:
+            return cached[1]
+        frame = memoryview(
+            protocol.pack(protocol.TEXT, b"content$" + self.window_body(x, y)))
+        self.window_cache[(x, y)] = (self.version, frame)
+        return frame
+
+    def view_frame(self, client: ClientInfo) -> bytes:
+        """Origin and content of the viewport of a client, packed.
+        Clients with a datagram channel first get a "seq" frame: the content
+        includes every delta up to that sequence number
+
+        Args:
+            client (ClientInfo): client to render for
+
+        Returns:
+            bytes: "seq" frame if any, "view" frame and "content" frame
+        """
+        if client.view == None:
+            self.follow(client)
+        x, y = client.view
+        mark = protocol.pack_text(f"seq${client.udp.sent}") if client.udp != None else b""
+        return mark + protocol.pack_text(f"view${x},{y}") + self.window(x, y)
+
+    def render_row(self, y: int, start: int = 0, end: int = None) -> str:
+        """Renders one row of the grid, or a part of it
+
+        Args:
+            y (int): y position of row
+            start (int, optional): first x position. Defaults to 0.
+            end (int, optional): x position to stop at, None for width. Defaults to None.
+
+        Returns:
+            str: row as string
+        """
+        end = self.width if end == None else min(end, self.width)
+        offset = y * self.width
+        line = self.grid[offset + start:offset + end].decode("ascii")
+        parts = []
+        last = 0
+        for match in STRUCTURE_TILES.finditer(line):
+            structure = self.structures.get((start + match.start(), y))
+            if structure == None:
+                continue
+            parts.append(line[last:match.start()])
+            parts.append(repr(structure))
+            last = match.start() + 1
+        if not parts:
+            return line
+        parts.append(line[last:])
+        return "".join(parts)
+
+    def render_cell(self, x: int, y: int) -> str:
+        """Renders one cell of the grid
+
+        Args:
+            x (int): x position
+            y (int): y position
+
+        Returns:
+            str: cell as string
+        """
+        structure = self.structures.get((x, y))
+        if structure != None:
+            return repr(structure)
+        return chr(self.grid[y * self.width + x])
+
+    def handle_frame(self, client: ClientInfo, kind: int, payload: bytes) -> None:
+        """Routes one frame from a client to the input queue of the room.
+        Called by network threads, only parses and enqueues.
+        Inputs always apply to the client of the connection or channel,
+        the client id in the payload must match it
+
+        Args:
+            client (ClientInfo): client object the frame came from
+            kind (int): kind of frame
+            payload (bytes): payload of frame
+
+        Raises:
+            ValueError: frame is malformed or names another client
+        """
+        if kind == protocol.TEXT:
+            self.handle_request(client, payload.decode("utf-8"))
+        elif kind == protocol.MOVE:
+            cid, attr, value = protocol.unpack_move(payload)
+            if cid != client.id:
+                raise ValueError(f"Move for client {cid} from client {client.id}")
+            self.inputs.append((client, attr, value))
+        elif kind == protocol.STEP:
+            cid, dx, dy = protocol.unpack_step(payload)
+            if cid != client.id:
+                raise ValueError(f"Step for client {cid} from client {client.id}")
+            if dx:
+                self.inputs.append((client, "x", dx))
+            if dy:
+                self.inputs.append((client, "y", dy))
+
+    def handle_request(self, client: ClientInfo, request: str) -> None:
+        """Parses a text request from client and queues it for next tick
+
+        Format of argument request: f"{cid}${attr}${value}"
+
+        Moves are converted here, on the network thread, so a malformed
+        value drops the client instead of reaching the simulation worker
+
+        Args:
+            client (ClientInfo): client object to store data in
+            request (str): request as string
+
+        Raises:
+            ValueError: request is malformed or names another client
+        """
+        cid, attr, value, *_rest = request.split("$")
+        if int(cid) != client.id:
+            raise ValueError(f"Request for client {cid} from client {client.id}")
+        if attr.startswith("x") or attr.startswith("y"):
+            value = int(value)  # ValueError if not a whole number
+        self.inputs.append((client, attr, value))
+
+    def handle_input(self, client: ClientInfo, attr: str, value: Any) -> None:
+        """Decision tree to determine what do do with a request from client.
+        Changes are broadcasted by 'flush' at the end of the tick
+
+        If the server does not respond, the request is treated as declined
+
+        Attr "x" and "y" moves the client. Attr "sync" requests a keyframe.
+        Attr "compress" asks for compressed frames, answered with "compress$1"
+        (frames after it may be compressed) or "compress$0" (declined).
+        Attr "udp" asks for a datagram channel, answered with
+        f"udp${token:x}" or "udp$0" (declined)
+
+        Args:
+            client (ClientInfo): client object to store data in
+            attr (str): name of attribute to update
+            value (Any): value to update attribute to
+        """
+        # x-axis and y-axis
+        if attr.startswith("x") or attr.startswith("y"):
+            # clamp between 1 and -1. won't be 0
+            num = min(max(int(value), -1), 1)
+            if attr.startswith("x"):
+                self.move(client, num, 0)
+            else:
+                self.move(client, 0, num)
 
-    def __init__(self, id: int, x: int, y: int) -> None:
-        """Client object to store client info
+        # client asks for a full keyframe of its viewport
+        elif attr.startswith("sync"):
+            self.send(client, self.view_frame(client))
+
+        # client can inflate "deflate" frames
+        elif attr.startswith("compress"):
+            accepted = self.compress > 0 and str(value) != "0"
+            self.rpc_send(client, "compress", int(accepted))  # sent raw
+            if accepted and client.socket != None and client.deflater == None:
+                client.deflater = protocol.Deflater(self.compress)
+
+        # client listens for moves and deltas on a datagram channel
+        elif attr.startswith("udp"):
+            if self.datagrams == None or client.socket == None:
+                self.rpc_send(client, "udp", 0)
+                return
+            if client.udp == None:
+                client.udp = self.datagrams.open(self, client)
+            self.rpc_send(client, "udp", f"{client.udp.token:x}")
+
+    def move(self, client: ClientInfo, dx: int, dy: int) -> None:
+        """Moves client one cell if the target cell allows it.
+        Keys are picked up, doors opened with the matching key
+        and the goal finishes the game
+
+        Args:
+            client (ClientInfo): client to move
+            dx (int): x direction
+            dy (int): y direction
+        """
+        x, y = client.x + dx, client.y + dy
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return  # ignores request
+        structure = None
+        if self.grid[y * self.width + x] != EMPTY:
+            structure = self.structures.get((x, y))
+            if structure == None:
+                return  # wall or other client
+        if type(structure) is Key:
+            client.keys.add(structure.id)
+        elif type(structure) is Door:
+            if structure.id not in client.keys:
+                return  # locked
+            client.keys.remove(structure.id)
+        elif type(structure) is Goal:
+            message = f"{'finished'}${1}"
+            self.pending.append(message)
+            self.finished = True
+            print(f"= Game finished in room {self.id}!")
+        if structure != None:
+            del self.structures[(x, y)]  # used up
+        self.set_cell(client.x, client.y, EMPTY)
+        self.set_cell(x, y, ord(str(client.id)))
+        client.x, client.y = x, y
+        if self.follow(client):
+            client.stale = True  # scrolled, send new viewport
+
+    def set_cell(self, x: int, y: int, tile: int) -> None:
+        """Sets a cell on the map and remembers it for the next delta
 
         Args:
-            id (int): if of client on server
             x (int): x position
             y (int): y position
+            tile (int): new tile code
         """
-        self.id = id
-        self.x = x
-        self.y = y
-        self.inventory = []
-        self.socket = None
-        self.address = None
+        self.grid[y * self.width + x] = tile
+        self.changes[(x, y)] = tile
+        self.dirty.add(y)
 
-    def clear(self):
-        """Clears socket object and address
+    def flush(self) -> None:
+        """Broadcasts pending messages and cells changed since last call,
+        batched in one send per client. Does nothing if nothing changed
+        and no client waits for a keyframe
+
+        Clients are grouped by viewport. Each group gets only the changed
+        cells inside its viewport, encoded once for the group
+
+        Delta format: f"delta${x},{y},{cell}|{x},{y},{cell}..."
         """
-        if self.socket != None:
-            self.socket.close()
-            self.socket = None
-        self.address = None
+        messages = self.pending
+        self.pending = []
+        changes = self.changes
+        if changes:
+            self.changes = {}
+        watched = self.feed != None and self.feed.watching
+        if not (messages or changes or self.stale() or watched and self.feed.wanted):
+            return
+        start = time.perf_counter()
+        head = b"".join(protocol.pack_text(message) for message in messages)
+        cells = [(x, y, f"{x},{y},{self.render_cell(x, y)}") for x, y in changes]
+        if watched:
+            self.spectate(head, cells)
+        views = {}  # (x, y) origin -> clients seeing it
+        for client in self.clients:
+            if client.socket != None:
+                views.setdefault(client.view, []).append(client)
+        for view, clients in views.items():
+            if view == None or self.whole():
+                seen = [cell for _x, _y, cell in cells]
+            else:
+                left, top = view
+                right, bottom = left + self.view_width, top + self.view_height
+                seen = [cell for x, y, cell in cells
+                        if left <= x < right and top <= y < bottom]
+            state = protocol.pack_text("delta$" + "|".join(seen)) if seen else None
+            self.deliver(clients, head, state)
+        BROADCAST_TIME.observe(time.perf_counter() - start)
 
+    def spectate(self, head: bytes, cells: list) -> None:
+        """Hands the frame of this tick to the spectators of the room.
+        Spectators see the whole map, so the frame is encoded once for all
+        of them. The content is attached when a watcher waits for a keyframe
 
-class Structure:
-    """Base class for structures to interact with on the map
+        Args:
+            head (bytes): packed messages of tick
+            cells (list): (x, y, cell) of every changed cell
+        """
+        frame = head
+        if cells:
+            frame += protocol.pack_text("delta$" + "|".join(cell for _x, _y, cell in cells))
+        body = None
+        if self.feed.wanted:
+            self.feed.wanted = False
+            body = self.render()
+        if frame or body != None:
+            self.fanout.publish(self.feed, frame, body)
 
-    Returns:
-        Structure: subclass object of Structure
-    """
-    symbol = "^"  # error symbol
+    def broadcast(self, *messages: str, state: str = None) -> None:
+        """Broadcasts one or more messages to all clients in the room.
+        Messages are packed as frames and sent in one call per client
 
-    def __init__(self, id: int, color: str, x: int, y: int) -> None:
-        self.id = id
-        self.color = color
-        self.x = x
-        self.y = y
+        Format: f"{attr}${value}"
 
-    def __repr__(self) -> str:
-        return self.color + self.symbol + "\u001b[0m"
+        Args:
+            messages (str): messages to broadcast
+            state (str, optional): delta, may be skipped by slow clients. Defaults to None.
+        """
+        head = b"".join(protocol.pack_text(message) for message in messages)
+        self.deliver(self.clients, head,
+                     protocol.pack_text(state) if state != None else None)
 
+    def deliver(self, clients: list, head: bytes, state: bytes = None) -> None:
+        """Sends packed frames to clients, one call per client.
+        State is shared by one memoryview
 
-class Goal(Structure):
-    """Structure: Goal
-    """
-    symbol = "?"
+        A client with more than COLLAPSE bytes unsent skips the state
+        and is marked stale. Once caught up it gets one keyframe of its
+        viewport instead of every delta it skipped.
+        Clients with a datagram channel get the state as a datagram
 
+        Args:
+            clients (list): clients to send to
+            head (bytes): packed frames every client gets
+            state (bytes, optional): packed delta, may be skipped. Defaults to None.
+        """
+        data = memoryview(head + state if state != None else head)
+        for client in clients:
+            if client.socket == None:
+                continue
+            if client.socket.backlog() > COLLAPSE:
+                client.stale = client.stale or state != None
+                if head:
+                    self.send(client, head)
+            elif client.stale:
+                client.stale = False
+                self.send(client, head + self.view_frame(client))
+            elif state != None and client.udp != None and client.udp.ready(len(state)):
+                if head:
+                    self.send(client, head)
+                client.sent += client.udp.send(state)
+            elif data:
+                self.send(client, data)
 
-class Key(Structure):
-    """Structure: Key
-    """
-    symbol = "!"
+    def stale(self) -> bool:
+        """Whether a client waits for a keyframe
 
+        Returns:
+            bool: True if a connected client skipped deltas
+        """
+        return any(client.stale and client.socket != None
+                   for client in self.clients)
 
-class Door(Structure):
-    """Structure: Door
-    """
-    symbol = "&"
+    def send(self, client: ClientInfo, data: Any) -> None:
+        """Sends packed frames to a spesific client
+
+        Args:
+            client (ClientInfo): client object to store data in
+            data (Any): bytes-like, packed frames
+        """
+        if client.socket == None:
+            return
+        if client.deflater != None and len(data) >= client.deflater.threshold:
+            BYTES_DEFLATED.inc(len(data))
+            data = client.deflater.pack(data)
+        try:
+            client.socket.sendall(data)
+        except ConnectionError as error:
+            if client.address != None and str(error):
+                print(
+                    f"= Client [{client.address[1]}] was dropped: {error}")
+            client.clear()  # clear info
+            return
+        client.sent += len(data)
+        BYTES_SENT.inc(len(data))
+
+    def rpc_send(self, client: ClientInfo, attr: str, value: Any) -> None:
+        """Send a message to a spesific client.
+
+        Format: f"{attr}${value}"
+
+        Args:
+            client (ClientInfo):  client object to store data in
+            attr (str): name of attribute to update
+            value (str): value to update atribute to
+        """
+        message = f"{attr}${value}"
+        self.send(client, protocol.pack_text(message))
 
 
 class Server:
     """Server to handle requests from clients and broadcasting of updates.
-    The middleman (serverside implementation)
+    The middleman (serverside implementation).
+    Hosts many independent rooms, filled by matchmaking
+
+    Game state has a single writer, the simulation worker ('run_ticks').
+    Network and console threads only parse and enqueue: inputs go to
+    the queue of a room, joins, leaves and kicks to 'commands'.
+    Other threads read the published snapshots
     """
 
-    def __init__(self, server_size: int = 2, host: str = "vps.i-h.no", port: int = 5050) -> None:
-        """Init Server and automatically start it
+    def __init__(self, server_size: int = 2, host: str = "vps.i-h.no", port: int = 5050, engine: str = "thread", tps: float = 20, max_rooms: int = 64, start: bool = True, metrics_port: int = 0, metrics_file: str = None, metrics_interval: float = 10, view: tuple = (VIEW_WIDTH, VIEW_HEIGHT), input_log: str = None, state_file: str = None, state_interval: float = 5, reconnect_grace: float = 60, compress: int = 6, udp: bool = False, spectate_port: int = 0) -> None:
+        """Init Server and automatically start it.
+        With start=False nothing is bound and no console is read,
+        which lets rooms and handshakes run without network (benchmarks)
+
+        Engine "thread" starts one thread per client.
+        Engine "asyncio" runs every connection on one event loop.
+        Inputs are queued and applied once per tick, at 'tps' ticks per second
 
         Args:
-            server_size (int, optional): maximum allowed clients. Defaults to 2.
+            server_size (int, optional): maximum allowed clients per room. Defaults to 2.
             host (str, optional): server host. Defaults to "vps.i-h.no".
             port (int, optional): server port. Defaults to 5050.
+            engine (str, optional): "thread" or "asyncio". Defaults to "thread".
+            tps (float, optional): simulation ticks per second. Defaults to 20.
+            max_rooms (int, optional): maximum rooms hosted at once. Defaults to 64.
+            start (bool, optional): bind, serve and read console. Defaults to True.
+            metrics_port (int, optional): local port serving metrics, 0 for none. Defaults to 0.
+            metrics_file (str, optional): file to dump metrics to as json. Defaults to None.
+            metrics_interval (float, optional): seconds between dumps. Defaults to 10.
+            view (tuple, optional): width and height of client viewports. Defaults to (VIEW_WIDTH, VIEW_HEIGHT).
+            input_log (str, optional): file to append applied inputs to, see replay.py. Defaults to None.
+            state_file (str, optional): checkpoint file to restore from and save to. Defaults to None.
+            state_interval (float, optional): seconds between checkpoints. Defaults to 5.
+            reconnect_grace (float, optional): seconds slots are kept for clients after a restore. Defaults to 60.
+            compress (int, optional): zlib level for clients asking for compression, 0 to decline. Defaults to 6.
+            udp (bool, optional): offer datagram channels on the same port. Defaults to False.
+            spectate_port (int, optional): port read-only spectators connect to, 0 for none. Defaults to 0.
         """
+        if engine not in ("thread", "asyncio"):
+            raise ValueError(f"Unknown engine: {engine}")
         self.running = True
         self.port = port
         self.host = host
         self.server_size = server_size
-        # make client containers
-        self.clients = []
-        # read map data and get player pos
-        with open("./map.txt", "r") as f:
-            self.content = []
-            for line in f.readlines():
-                self.content.append(list(line.rstrip()))
-        for index in range(self.server_size):
-            cid = index + 1
-            for line in self.content:
-                if str(cid) in line:
-                    y = self.content.index(line)
-                    x = line.index(str(cid))
-                    # NOTE: might give error if not on map
-                    client = ClientInfo(cid, x, y)
-                    self.clients.append(client)
-                    break
-        # set keys, doors and goal manually, for now...
-        self.keys = [
-            Key(1, "\u001b[32m", 4, 8),
-            Key(2, "\u001b[35m", 3, 4),
-            Key(3, "\u001b[33m", 17, 8),
-            Key(4, "\u001b[34m", 45, 1),
-            Key(5, "\u001b[36m", 13, 1)
-        ]
-        self.doors = [
-            Door(1, "\u001b[32m", 8, 4),
-            Door(2, "\u001b[35m", 5, 6),
-            Door(3, "\u001b[33m", 37, 2),
-            Door(4, "\u001b[34m", 21, 3),
-            Door(5, "\u001b[36m", 52, 7)
-        ]
-        self.goal = Goal(-1, "\u001b[35m", 55, 2)
-        self.objects = self.keys + self.doors + [self.goal]
-        for obj in self.objects:
-            x, y = obj.x, obj.y
-            self.content[y][x] = obj.color + obj.symbol + "\u001b[0m"
-        # ---
+        self.engine = engine
+        self.tps = tps
+        self.max_rooms = max_rooms
+        self.view = view
+        self.compress = compress
+        self.datagrams = Datagrams() if udp else None
+        self.udp_socket = None
+        self.spectate_port = spectate_port
+        self.fanout = FanOut(server_size, self.spectate) if spectate_port else None
+        self.loop = None  # asyncio engine only
+        self.stopped = None  # asyncio engine only
+        self.woken_async = None  # asyncio engine only
+        self.writer = None  # thread engine only
+        self.profiler = None  # sampler of "profile" console command
+        # make room containers
+        self.level = Level("./temple.map", server_size)
+        self.check_map("./temple.map")
+        self.input_log = None
+        if input_log != None:
+            self.input_log = inputlog.InputLog(
+                input_log, "./temple.map", server_size, view, tps)
+        self.rooms = []  # every room made, index is id - 1
+        self.queue = deque()  # rooms waiting for clients, first is filled first
+        self.commands = deque()  # (func, args) for the simulation worker
+        self.woken = threading.Event()  # set when a command is queued
+        self.snapshots = ()  # Snapshot of every room, as of last tick
+        self.waiting = 0  # rooms waiting for clients, as of last tick
+        self.joins = 0  # connections handled by 'join'
+        self.joined = 0  # joins, as of last tick
+        self.state_interval = state_interval
+        self.next_checkpoint = time.monotonic() + state_interval
+        self.reserved_until = None  # end of reconnect grace after a restore
+        self.checkpointer = None
+        if state_file != None:
+            self.checkpointer = checkpoint.Checkpointer(
+                state_file, inputlog.map_digest("./temple.map"), server_size,
+                list(self.level.structures))
+            self.restore(reconnect_grace)
+        self.socket = None
+        self.metrics_port = metrics_port
+        self.metrics_file = metrics_file
+        self.metrics_interval = metrics_interval
+        self.metrics_server = None
+        metrics.REGISTRY.gauge("threads", threading.active_count)
+        metrics.REGISTRY.gauge("rooms", lambda: len(self.snapshots))
+        metrics.REGISTRY.gauge("connections", lambda: sum(
+            len(snapshot.players) for snapshot in self.snapshots))
+        metrics.REGISTRY.gauge("client_bytes_sent", lambda: self.per_client("sent"))
+        metrics.REGISTRY.gauge(
+            "client_bytes_received", lambda: self.per_client("received"))
+        if self.fanout != None:
+            metrics.REGISTRY.gauge("spectators", lambda: len(self.fanout.spectators))
+        if start:
+            self.start()
+            self.console()
+
+    def check_map(self, path: str) -> None:
+        """Warns if the map cannot be finished. See analyzer.py
+
+        Args:
+            path (str): path of map file
+        """
+        report = analyzer.analyze(maps.load(path))
+        if not report["solvable"]:
+            print(f"\u001b[31;1m[Warning] \u001b[37;1mMap {path} cannot be finished\u001b[0m")
+        for key in report["unreachable_keys"]:
+            print(f"\u001b[33;1m[Warning] \u001b[0mUnreachable {key}")
+        for warning in report["warnings"]:
+            print(f"\u001b[33;1m[Warning] \u001b[0m{warning}")
+
+    def restore(self, grace: float) -> None:
+        """Restores the rooms of the checkpoint file, if there is one.
+        Slots of clients connected at the time are kept for their host
+
+        Args:
+            grace (float): seconds slots are kept
+        """
+        try:
+            saved = checkpoint.read(self.checkpointer.path, self.checkpointer.order)
+        except ValueError as error:
+            print(f"\u001b[33;1m[Warning] \u001b[0mCheckpoint not restored: {error}")
+            return
+        if saved == None:
+            return
+        digest, server_size, rooms = saved
+        if digest != self.checkpointer.digest or server_size != self.server_size:
+            print("\u001b[33;1m[Warning] \u001b[0mCheckpoint not restored: other map or server size")
+            return
+        for state in rooms[:self.max_rooms]:
+            while len(self.rooms) < state[0]:
+                self.rooms.append(Room(len(self.rooms) + 1, self.level, self.view, self.input_log,
+                                       self.compress, self.datagrams, self.fanout))
+            self.rooms[state[0] - 1].restore(state)
+        for room in self.rooms:
+            if room.is_open():
+                self.queue.append(room)
+                room.queued = True
+        self.reserved_until = time.monotonic() + grace
+        self.publish()
+        print(f"\u001b[32;1m- Restored {len(rooms)} rooms from {self.checkpointer.path}\u001b[0m")
+
+    def save(self) -> None:
+        """Hands a copy of every room in play to the checkpointer.
+        Simulation worker only
+        """
+        self.checkpointer.submit([
+            room.save() for room in self.rooms
+            if room.players() or room.reservations()])
+
+    def expire(self) -> None:
+        """Frees slots kept after a restore once the grace ran out.
+        Rooms nobody came back to are recycled
+        """
+        self.reserved_until = None
+        for room in self.rooms:
+            for client in room.clients:
+                client.reserved = None
+            if room.players() == 0:
+                room.reset()
+            if room.is_open() and not room.queued:
+                self.queue.append(room)
+                room.queued = True
+            room.publish()
+
+    def start(self, listen: bool = True) -> None:
+        """Binds the server socket and starts serving
 
+        Args:
+            listen (bool, optional): accept connections, False if they are handed over with 'adopt'. Defaults to True.
+        """
         # connect
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
             print(
                 "\u001b[30;1m-- \u001b[32;1mServer startup \u001b[30;1m--\u001b[0m")
-            self.socket.bind((self.host, self.port))
-            self.socket.listen(5)
+            if listen:
+                self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self.socket.bind((self.host, self.port))
+                self.socket.listen(socket.SOMAXCONN)
+            if self.datagrams != None:
+                self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                self.udp_socket.bind((self.host, self.port))
+            if self.fanout != None:
+                listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                listener.bind((self.host, self.spectate_port))
+                listener.listen(socket.SOMAXCONN)
+                self.fanout.listen(listener)
             print(
                 "\u001b[30;1m== \u001b[32;1mServer is running\u001b[30;1m...\u001b[0m")
         except Exception as error:
@@ -146,297 +1837,596 @@ class Server:
             self.shutdown()
         # start server
         self.running = True
-        threading.Thread(target=self.handle_clients).start()  # looping
+        if self.checkpointer != None:
+            threading.Thread(target=self.checkpointer.run,
+                             args=(lambda: self.running,)).start()  # looping
+        if self.fanout != None:
+            threading.Thread(target=self.fanout.run,
+                             args=(lambda: self.running,)).start()  # looping
+        if self.engine == "asyncio":
+            threading.Thread(target=self.run_async).start()  # looping
+        else:
+            self.writer = Writer()
+            threading.Thread(target=self.writer.run,
+                             args=(lambda: self.running,)).start()  # looping
+            if self.socket != None:
+                threading.Thread(target=self.handle_clients).start()  # looping
+            threading.Thread(target=self.run_ticks).start()  # looping
+            if self.udp_socket != None:
+                threading.Thread(target=self.handle_datagrams).start()  # looping
+        # metrics
+        if self.metrics_port:
+            self.metrics_server = metrics.REGISTRY.serve(self.metrics_port)
+        if self.metrics_file:
+            metrics.REGISTRY.start_dump(
+                self.metrics_file, self.metrics_interval, lambda: self.running)
+
+    def per_client(self, attr: str) -> dict:
+        """Byte count of every connected client, for metrics
+
+        Args:
+            attr (str): "sent" or "received"
+
+        Returns:
+            dict: f"{room}.{client}" -> bytes
+        """
+        return {
+            f"{room.id}.{client.id}": getattr(client, attr)
+            for room in self.rooms
+            for client in room.clients
+            if client.socket != None
+        }
 
-        # server commands
+    def spectate(self, room: int = None) -> int:
+        """Room a spectator watches. Any thread, reads the snapshots
+
+        Args:
+            room (int, optional): id of room asked for. Defaults to None.
+
+        Returns:
+            int: room asked for if it exists, else the room with most players
+        """
+        snapshots = self.snapshots
+        if room != None and 1 <= room <= len(snapshots):
+            return room
+        if not snapshots:
+            return 1  # watches the first room once it is made
+        return max(snapshots, key=lambda snapshot: len(snapshot.players)).room
+
+    def console(self) -> None:
+        """Reads server commands until shutdown
+        """
         while self.running:
-            string = input("")
-            do_shutdown = False
+            self.command(input(""))
+
+    def command(self, string: str) -> None:
+        """Runs one server command. Console thread, or a cluster worker
+
+        Args:
+            string (str): command as typed
+        """
+        do_shutdown = False
+        try:
+            if string.startswith("exit"):
+                do_shutdown = True
+            elif string.startswith("kick"):
+                # "kick {client}" in room 1 or "kick {room} {client}"
+                args = string.split(" ")[1:]
+                room_id = int(args[0]) if len(args) > 1 else 1
+                client_id = int(args[-1]) - 1
+                room = self.rooms[room_id - 1]
+                client = room.clients[client_id]
+                self.submit(self.kick, room, client)
+            elif string.startswith("list"):
+                print(
+                    f"= Rooms {len(self.snapshots)}, waiting {self.waiting}")
+                for snapshot in self.snapshots:
+                    for cid, address, _x, _y in snapshot.players:
+                        print("-", "Room", snapshot.room, "Client",
+                              cid, address)
+            elif string.startswith("stats"):
+                print(metrics.REGISTRY.render())
+            elif string.startswith("profile"):
+                self.profile(*string.split(" ")[1:])
+            elif string.startswith("cls"):
+                os.system("cls")
+                print(
+                    "\u001b[30;1m-- \u001b[32;1mServer \u001b[30;1m--\u001b[0m")
+            else:
+                print("| [Invalid]", string)
+        except (TypeError, IndexError, ValueError) as error:
+            print("[Error]", type(error).__name__, error)
+        # shutdown
+        if do_shutdown:
+            self.shutdown()
+
+    def profile(self, action: str = "", argument: str = None) -> None:
+        """Console command. Samples the stacks of every thread, see profiler.py
+
+        Format: "profile start [ms between samples]", "profile stop" or "profile dump [path]"
+
+        Args:
+            action (str, optional): "start", "stop" or "dump". Defaults to "".
+            argument (str, optional): interval in ms for start, path for dump. Defaults to None.
+
+        Raises:
+            ValueError: unknown action or malformed interval
+        """
+        if action == "start":
+            if self.profiler != None and self.profiler.running:
+                print("= Profiler is already running")
+                return
+            interval = float(argument) / 1000 if argument != None else profiler.INTERVAL
+            self.profiler = profiler.Sampler(interval)  # drops samples of last run
+            self.profiler.start()
+            mode = "cpu time" if self.profiler.cpu else "wall time"
+            print(f"- Profiling every {interval * 1000:g} ms, {mode}")
+        elif action == "stop":
+            if self.profiler == None or not self.profiler.stop():
+                print("= Profiler is not running")
+                return
+            print(f"- Profiler stopped after {self.profiler.samples} samples, "
+                  f"{self.profiler.seconds * 1000:.1f} ms spent sampling")
+        elif action == "dump":
+            if self.profiler == None:
+                print("= Nothing profiled")
+                return
+            path = argument or profiler.DEFAULT_PATH
             try:
-                if string.startswith("exit"):
-                    do_shutdown = True
-                elif string.startswith("kick"):
-                    client_id = int(string.split(" ")[1]) - 1
-                    if self.clients[client_id].socket != None:
-                        print(
-                            f"- Kicking client [{self.clients[client_id].address[1]}]")
-                        # tell client to disconnect
-                        # clear later
-                        self.rpc_send(self.clients[client_id], "kick", 1)
-                        # FIXME: send msg to client so it disconnects
-                        self.clients[client_id].socket.close()
-                    else:
-                        print(
-                            f"= Client {client.id} has no socket object assigned")
-                elif string.startswith("list"):
-                    for client in self.clients:
-                        print("-", "Client", client.id, client.address)
-                elif string.startswith("cls"):
-                    os.system("cls")
-                    print(
-                        "\u001b[30;1m-- \u001b[32;1mServer \u001b[30;1m--\u001b[0m")
-                else:
-                    print("| [Invalid]", string)
-            except (TypeError, IndexError) as error:
-                print("[Error]", type(error).__name__, error)
-            # shutdown
-            if do_shutdown:
-                self.shutdown()
+                stacks = self.profiler.dump(path)
+            except OSError as error:
+                print(f"\u001b[33;1m[Warning] \u001b[0mProfile not written: {error}")
+                return
+            print(f"- Wrote {stacks} stacks of {self.profiler.samples} samples to {path}")
+            for label, share in self.profiler.top(5):
+                print(f"- {share * 100:5.1f}% {label}")
+        else:
+            raise ValueError(f"Unknown profile action: {action!r}")
+
+    def submit(self, func: Any, *args: Any) -> None:
+        """Queues a command for the simulation worker. Any thread
+
+        Args:
+            func (Callable): command, called with args on the simulation worker
+            args (Any): arguments of command
+        """
+        self.commands.append((func, args))
+        if self.engine == "asyncio":
+            if self.loop != None and self.woken_async != None:
+                self.loop.call_soon_threadsafe(self.woken_async.set)
+        else:
+            self.woken.set()
+
+    def run_commands(self) -> None:
+        """Runs every queued command. Simulation worker only
+        """
+        for _ in range(len(self.commands)):
+            func, args = self.commands.popleft()
+            func(*args)
 
     def handle_clients(self) -> None:
-        """Accepts client connections and starts a thread to handle recieve
+        """Accepts client connections and queues them for matchmaking
         """
         while self.running:
             try:
-                client = self.socket.accept()
+                clientsocket, address = self.socket.accept()
             except socket.timeout:
                 continue
-            try:
-                clientsocket, address = client
-                index = 0
-                for client in self.clients:
-                    if client.socket != None:
-                        index += 1
-                msg = "$".join([
-                    str(index + 1),
-                    str(self.server_size),
-                    self.stringify(self.content)
-                ])
-                clientsocket.send(bytes(msg, "utf-8"))
-                # keep track of new client socket in existing ClientInfo obj
-                for client in self.clients:
-                    if client.socket == None:
-                        client.address = address
-                        client.socket = clientsocket
-                        break
-            except ConnectionError:
-                client.clear()  # clear info
+            except OSError:
+                return  # listening socket closed
+            self.submit(self.join, Outbox(clientsocket, self.writer),
+                        address, self.start_recv)
 
-            def func(): self.handle_recv(client)  # lambda
-            threading.Thread(target=func).start()  # looping
-            print(f"-- Client [{client.address[1]}] has connected --")
+    def adopt(self, clientsocket: socket.socket, address: tuple) -> None:
+        """Serves a connection accepted by another process, see cluster.py.
+        Any thread, the connection joins like an accepted one
 
-    def shutdown(self) -> None:
-        """Shutdown procedural to shutdown Server
+        Args:
+            clientsocket (socket.socket): connected socket
+            address (tuple): address of the connection
         """
-        self.running = False
-        # dummy join so cancel self.socket.accept
-        print(f"Client size, size ({len(self.clients)})")
-        print("- Making dummy")
-        dummysock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        print("- Connecting dummy")
-        try:
-            dummysock.connect((self.host, self.port))
-            time.sleep(0.1)
-            print("= Connected dummy")
-        except ConnectionRefusedError:
-            print("- Connection failed, continuing")
-        # clear all sockets (including dummy)
-        print(f"- Clearing clients, size ({len(self.clients)})")
-        for client in self.clients:
-            if client.socket != None:
-                client.socket.close()
-        # close socket
-        self.socket.close()
-        print("== Server shutdown ==")
+        if self.engine == "asyncio":
+            asyncio.run_coroutine_threadsafe(self.adopt_async(clientsocket), self.loop)
+        else:
+            self.submit(self.join, Outbox(clientsocket, self.writer),
+                        address, self.start_recv)
 
-    def stringify(self, content: list) -> str:
-        """Stringifies content from 2D array (with str elements)
+    async def adopt_async(self, clientsocket: socket.socket) -> None:
+        """Coroutine serving an adopted connection on the event loop
 
         Args:
-            content (list): content to stringify
+            clientsocket (socket.socket): connected socket
+        """
+        reader, writer = await asyncio.open_connection(sock=clientsocket)
+        await self.handle_stream(reader, writer)
 
-        Returns:
-            str: content as one string
+    def start_recv(self, room: Room, client: ClientInfo) -> None:
+        """Starts a thread to handle recieve of a client that joined
+
+        Args:
+            room (Room): room the client joined
+            client (ClientInfo): client that joined, None if rejected
         """
-        first, *rest = content
-        value = "".join(first)
-        for line in rest:
-            value += "\n" + "".join(line)
-        return value
+        if client == None:
+            return
+        clientsocket, address = client.socket, client.address
 
-    def handle_recv(self, client: ClientInfo) -> None:
-        """Separate thread to handle recieve.
-        One thread per client
+        def func(): self.handle_recv(room, client, clientsocket, address)  # lambda
+        threading.Thread(target=func, name="Recv").start()  # looping
+
+    def join(self, clientsocket: Any, address: tuple, callback: Any) -> None:
+        """Command. Matchmaking and handshake of a new connection
 
         Args:
-            client (ClientInfo): client object to store data in
+            clientsocket (Any): socket (or Outbox, StreamSocket) of the connection
+            address (tuple): address of the connection
+            callback (Callable): called with room and client, client is None if rejected
         """
-        while self.running:
+        self.joins += 1
+        if not self.running:
+            clientsocket.abort()  # shutting down, e.g. the dummy join
+            callback(None, None)
+            return
+        room, client = self.accept(clientsocket, address)
+        if client != None:
+            print(
+                f"-- Client [{client.address[1]}] has connected to room {room.id} --")
+            room.publish()
+        callback(room, client)
+
+    def kick(self, room: Room, client: ClientInfo) -> None:
+        """Command. Tells a client to disconnect and closes its connection
+
+        Args:
+            room (Room): room the client is in
+            client (ClientInfo): client to kick
+        """
+        if client.socket == None:
+            print(f"= Client {client.id} has no socket object assigned")
+            return
+        print(f"- Kicking client [{client.address[1]}]")
+        room.rpc_send(client, "kick", 1)
+        if client.socket != None:
+            client.socket.close()  # after kick is sent, recv loop releases
+
+    def accept(self, clientsocket: Any, address: tuple) -> tuple:
+        """Matchmaking. Routes a new connection to the first room
+        waiting for clients, making a new room if none is waiting.
+        Simulation worker only
+
+        Args:
+            clientsocket (Any): socket (or StreamSocket) of the connection
+            address (tuple): address of the connection
+
+        Returns:
+            tuple: room and client assigned, client is None if full or failed
+        """
+        room = self.reclaim(address[0])
+        if room == None:
+            room = self.match()
+        if room == None:  # every room busy, tell client server is full
+            head = bytes(
+                f"{self.server_size + 1}${self.server_size}$", "utf-8")
             try:
-                request = client.socket.recv(1024)  # is bytes
-                if not request:  # if empty request
-                    continue
-            except (Exception, ConnectionAbortedError) as error:
-                if type(error) is ConnectionAbortedError:
-                    print(f"= Client [{client.address[1]}] has disconnected")
-                    client.clear()
-                elif client in self.clients:
-                    print(
-                        f"= Client [{client.address[1]}] had an unexpected error: {type(error).__name__}")
-                    client.clear()  # clear info
-                return
-            self.handle_request(client, request.decode("utf-8"))
+                clientsocket.sendall(protocol.pack(protocol.TEXT, head))
+            except ConnectionError:
+                pass
+            clientsocket.close()
+            return None, None
+        client = room.accept(clientsocket, address)
+        if not room.is_open() and room.queued:
+            self.queue.remove(room)  # first in queue, unless reclaimed
+            room.queued = False
+        return room, client
 
-    def handle_request(self, client: ClientInfo, request: str) -> None:
-        """Decision tree to determine what do do with a request from client
+    def reclaim(self, host: str) -> Room:
+        """Finds a room keeping a slot for a host after a restore
 
-        If the server does not respond, the request is treated as declined
+        Args:
+            host (str): host of the connection
+
+        Returns:
+            Room: room with a slot kept for host, None if none
+        """
+        if self.reserved_until == None:
+            return None
+        for room in self.rooms:
+            for client in room.clients:
+                if client.socket == None and client.reserved == host:
+                    return room
+        return None
+
+    def match(self) -> Room:
+        """Finds the room to put the next client in
+
+        Returns:
+            Room: room waiting for clients, None if max_rooms are busy
+        """
+        while self.queue and not self.queue[0].is_open():
+            self.queue.popleft().queued = False  # filled or finished
+        if self.queue:
+            return self.queue[0]
+        if len(self.rooms) >= self.max_rooms:
+            return None
+        room = Room(len(self.rooms) + 1, self.level, self.view, self.input_log,
+                    self.compress, self.datagrams, self.fanout)
+        self.rooms.append(room)
+        self.queue.append(room)
+        room.queued = True
+        return room
 
-        Format of argument request: f"{attr}${value}"
+    def release(self, room: Room, client: ClientInfo, clientsocket: Any = None) -> None:
+        """Frees the slot of a client leaving its room.
+        The room is recycled when its last client leaves.
+        Simulation worker only, queue with 'submit' from other threads
 
         Args:
-            client (ClientInfo): client object to store data in
-            request (str): request as string
+            room (Room): room the client was in
+            client (ClientInfo): client leaving
+            clientsocket (Any, optional): socket leaving, slot is kept if reassigned. Defaults to None.
         """
-        cid, attr, value, *_rest = request.split("$")
-        print(cid, attr, value)
-        # if _rest:
-        #     print("REST", _rest)
-        client = self.clients[int(cid) - 1]
+        if clientsocket != None and client.socket not in (clientsocket, None):
+            return  # slot already taken by a new connection
+        if not self.running:
+            return  # shutting down, slot is kept in the last checkpoint
+        client.clear()  # clear info
+        if room.players() == 0 and not room.reservations():
+            room.reset()  # recycle
+        if room.is_open() and not room.queued:
+            self.queue.append(room)
+            room.queued = True
+        room.publish()
 
-        # x-axis
-        if attr.startswith("x"):
-            try:
-                # clamp between 1 and -1. won't be 0
-                num = min(max(int(value), -1), 1)
-                curr = self.content[client.y][client.x + num]
-            except IndexError:
-                return  # ignores error
-
-            if curr == " ":
-                # edit last pos
-                self.content[client.y][client.x] = curr
-                self.content[client.y][client.x + num] = str(client.id)
-                client.x += num
-
-            elif Key.symbol in curr:
-                for key in self.keys:
-                    print((key.x, key.y), (client.x + num, client.y))
-                    if (key.x, key.y) == (client.x + num, client.y):
-                        client.inventory.append(key)
-                        break
-                self.content[client.y][client.x] = " "
-                self.content[client.y][client.x + num] = str(client.id)
-                client.x += num
-                print(client.id, "gained key:", client.inventory)
-
-            elif Door.symbol in curr:
-                for door in self.doors:
-                    if (door.x, door.y) == (client.x + num, client.y):
-                        # got current door
-                        for item in client.inventory:
-                            if type(item) == Key:
-                                if door.id == item.id:
-                                    # do stuff
-                                    client.inventory.remove(item)
-                                    self.content[client.y][client.x] = " "
-                                    self.content[
-                                        client.y][client.x + num] = str(client.id)
-                                    client.x += num
-                                    break
-                        break
-
-            elif Goal.symbol in curr:
-                self.content[client.y][client.x] = " "
-                self.content[client.y][client.x + num] = str(client.id)
-                client.x += num
-                message = f"{'finished'}${1}"
-                self.broadcast(message)
-                print("= Game finished!")
-
-        # y-axis
-        elif attr.startswith("y"):
-            try:
-                # clamp between 1 and -1. won't be 0
-                num = min(max(int(value), -1), 1)
-                curr = self.content[client.y + num][client.x]
-            except IndexError:
-                return  # ignore error. ignore request
-
-            if curr == " ":
-                # edit last pos
-                self.content[client.y][client.x] = curr
-                self.content[client.y + num][client.x] = str(client.id)
-                client.y += num
-
-            elif Key.symbol in curr:
-                for key in self.keys:
-                    print((key.x, key.y), (client.x, client.y + num))
-                    if (key.x, key.y) == (client.x, client.y + num):
-                        client.inventory.append(key)
-                        break
-                self.content[client.y][client.x] = " "
-                self.content[client.y + num][client.x] = str(client.id)
-                client.y += num
-                print(client.id, "gained key:", client.inventory)
-
-            elif Door.symbol in curr:
-                for door in self.doors:
-                    if (door.x, door.y) == (client.x, client.y + num):
-                        # got current door
-                        for item in client.inventory:
-                            if type(item) == Key:
-                                if door.id == item.id:
-                                    # do stuff
-                                    client.inventory.remove(item)
-                                    self.content[client.y][client.x] = " "
-                                    self.content[
-                                        client.y + num][client.x] = str(client.id)
-                                    client.y += num
-                                    break
-                        break
-
-            elif Goal.symbol in curr:
-                self.content[client.y][client.x] = " "
-                self.content[client.y + num][client.x] = str(client.id)
-                client.y += num
-                message = f"{'finished'}${1}"
-                self.broadcast(message)
-                print("= Game finished!")
-
-        # broadcast content to all clients (updated version)
-        message = "content$" + self.stringify(self.content)
-        self.broadcast(message)
-
-    def broadcast(self, message: str) -> None:
-        """Broadcasts a message to all clients.
-        Message is recieved as bytes
+    def run_async(self) -> None:
+        """Runs the asyncio engine until shutdown. Own thread
+        """
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.serve_async())
+        finally:
+            self.loop.close()
 
-        Format: f"{attr}${value}"
+    async def serve_async(self) -> None:
+        """Serves every connection on the event loop until shutdown
+        """
+        self.stopped = asyncio.Event()
+        self.woken_async = asyncio.Event()
+        server = None  # connections are adopted, see 'adopt'
+        if self.socket != None:
+            server = await asyncio.start_server(
+                self.handle_stream, sock=self.socket, backlog=socket.SOMAXCONN)
+        if self.udp_socket != None:
+            await self.loop.create_datagram_endpoint(
+                lambda: DatagramEndpoint(self.datagrams), sock=self.udp_socket)
+        ticks = asyncio.ensure_future(self.run_ticks_async())
+        await self.stopped.wait()
+        if server != None:
+            server.close()
+            await server.wait_closed()
+        ticks.cancel()
+        try:
+            await ticks
+        except asyncio.CancelledError:
+            pass  # stopped mid tick
+        self.stop_worker()
+        if self.datagrams != None and self.datagrams.transport != None:
+            self.datagrams.transport.close()
+
+    async def handle_stream(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Coroutine to handle one connection. Equivalent of 'handle_recv'
+        for the asyncio engine. One coroutine per client
 
         Args:
-            message (str): message to broadcast
+            reader (asyncio.StreamReader): reader of the connection
+            writer (asyncio.StreamWriter): writer of the connection
         """
-        data = bytes(message, "utf-8")
-        for client in self.clients:
-            if client.socket == None:
-                continue
+        clientsocket = StreamSocket(self.loop, writer)
+        joined = self.loop.create_future()
+        self.submit(self.join, clientsocket, writer.get_extra_info("peername"),
+                    lambda room, client: joined.set_result((room, client)))
+        room, client = await joined
+        if client == None:
+            return
+        address = client.address
+        frames = protocol.FrameReader(limit=protocol.MAX_REQUEST)
+        while self.running:
             try:
-                client.socket.send(data)
-            except ConnectionError:
-                client.clear()  # clear info
+                data = await reader.read(4096)  # is bytes
+                if not data:  # connection closed
+                    print(f"= Client [{address[1]}] has disconnected")
+                    break
+                client.received += len(data)
+                BYTES_RECEIVED.inc(len(data))
+                for kind, payload in frames.feed(data):
+                    room.handle_frame(client, kind, payload)
+            except (ConnectionError, ValueError, IndexError) as error:
+                print(
+                    f"= Client [{address[1]}] had an unexpected error: {type(error).__name__}")
+                break
+        self.submit(self.release, room, client, clientsocket)
 
-    def rpc_send(self, client: ClientInfo, attr: str, value: Any) -> None:
-        """Send a message to a spesific client.
+    def run_ticks(self) -> None:
+        """Simulation worker. Runs the simulation at a fixed tick rate
+        until shutdown, and commands as soon as they are queued. Own thread
+        """
+        interval = 1.0 / self.tps
+        deadline = time.monotonic()
+        while self.running:
+            self.tick()
+            deadline += interval
+            if deadline < time.monotonic():
+                deadline = time.monotonic()  # fell behind, skip missed ticks
+            while True:
+                delay = deadline - time.monotonic()
+                if delay <= 0 or not self.woken.wait(delay):
+                    break
+                self.woken.clear()
+                self.run_commands()
+                self.publish()
+        self.stop_worker()
 
-        Format: f"{attr}${value}"
+    async def run_ticks_async(self) -> None:
+        """Simulation worker of the asyncio engine, on the event loop
+        """
+        interval = 1.0 / self.tps
+        deadline = time.monotonic()
+        while self.running:
+            self.tick()
+            deadline += interval
+            if deadline < time.monotonic():
+                deadline = time.monotonic()  # fell behind, skip missed ticks
+            while True:
+                delay = deadline - time.monotonic()
+                if delay <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(self.woken_async.wait(), delay)
+                except asyncio.TimeoutError:
+                    break
+                self.woken_async.clear()
+                self.run_commands()
+                self.publish()
+
+    def stop_worker(self) -> None:
+        """Closes the input log and writes a last checkpoint.
+        Simulation worker only, once it stopped ticking
+        """
+        if self.input_log != None:
+            self.input_log.close()
+        if self.checkpointer != None:
+            self.save()
+            self.checkpointer.write_latest()
+
+    def tick(self) -> None:
+        """Runs queued commands, then ticks every room with queued inputs,
+        pending messages or clients or spectators waiting for a keyframe.
+        Idle rooms cost nothing
+        """
+        self.run_commands()
+        for room in self.rooms:
+            if room.inputs or room.pending or room.stale() or \
+                    room.feed != None and room.feed.wanted and room.feed.watching:
+                room.tick()
+        if self.input_log != None:
+            self.input_log.advance()
+        if self.checkpointer != None and time.monotonic() >= self.next_checkpoint:
+            self.next_checkpoint = time.monotonic() + self.state_interval
+            if self.reserved_until != None and time.monotonic() >= self.reserved_until:
+                self.expire()
+            self.save()
+        self.publish()
+
+    def publish(self) -> None:
+        """Publishes the snapshot of every room for other threads
+        """
+        self.snapshots = tuple(room.snapshot for room in self.rooms)
+        self.waiting = len(self.queue)
+        self.joined = self.joins  # last, snapshots are never older
+
+    def shutdown(self) -> None:
+        """Shutdown procedural to shutdown Server
+        """
+        self.running = False
+        if self.engine == "asyncio":
+            if self.loop != None and self.stopped != None:
+                self.loop.call_soon_threadsafe(self.stopped.set)
+        elif self.socket != None:
+            # dummy join so cancel self.socket.accept
+            print(f"Room size, size ({len(self.rooms)})")
+            print("- Making dummy")
+            dummysock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            print("- Connecting dummy")
+            try:
+                dummysock.connect((self.host, self.port))
+                time.sleep(0.1)
+                print("= Connected dummy")
+            except ConnectionRefusedError:
+                print("- Connection failed, continuing")
+        # clear all sockets (including dummy)
+        if self.metrics_server != None:
+            self.metrics_server.shutdown()
+        print(f"- Clearing rooms, size ({len(self.rooms)})")
+        for room in self.rooms:
+            for client in room.clients:
+                if client.socket != None:
+                    client.socket.abort()
+        # close socket
+        if self.socket == None:
+            pass  # never started
+        elif self.engine == "asyncio" and self.loop != None:
+            pass  # closed by the event loop
+        else:
+            self.socket.close()
+        if self.udp_socket != None and self.engine == "thread":
+            self.udp_socket.close()  # wakes datagram thread
+        print("== Server shutdown ==")
+
+    def handle_recv(self, room: Room, client: ClientInfo, clientsocket: Outbox, address: tuple) -> None:
+        """Separate thread to handle recieve.
+        One thread per client. Only parses and enqueues
 
         Args:
-            client (ClientInfo):  client object to store data in
-            attr (str): name of attribute to update
-            value (str): value to update atribute to
+            room (Room): room the client is in
+            client (ClientInfo): client object to store data in
+            clientsocket (Outbox): connection of the client
+            address (tuple): address of the connection
         """
-        if client.socket == None:
-            return
-        try:
-            message = f"{attr}${value}"
-            data = bytes(message, "utf-8")
-            client.socket.send(data)
-        except ConnectionError:
-            client.clear()  # clear info
+        frames = protocol.FrameReader(limit=protocol.MAX_REQUEST)
+        # own selector, select.select fails on descriptors past 1023
+        with selectors.DefaultSelector() as selector:
+            while self.running:
+                try:
+                    if not selector.get_map():
+                        selector.register(clientsocket.sock, selectors.EVENT_READ)
+                    # socket is non-blocking, sends are done by the writer
+                    if not selector.select(1.0):
+                        if clientsocket.closed:
+                            raise ConnectionAbortedError  # closed while waiting
+                        continue
+                    data = clientsocket.sock.recv(4096)  # is bytes
+                    if not data:  # connection closed
+                        raise ConnectionAbortedError
+                    client.received += len(data)
+                    BYTES_RECEIVED.inc(len(data))
+                    for kind, payload in frames.feed(data):
+                        room.handle_frame(client, kind, payload)
+                except (Exception, ConnectionAbortedError) as error:
+                    if type(error) is ConnectionAbortedError or clientsocket.closed:
+                        print(f"= Client [{address[1]}] has disconnected")
+                    elif client.socket is clientsocket:
+                        print(
+                            f"= Client [{address[1]}] had an unexpected error: {type(error).__name__}")
+                    self.submit(self.release, room, client, clientsocket)
+                    return
+        clientsocket.abort()  # shutdown
+
+    def handle_datagrams(self) -> None:
+        """Receives datagrams of every client until shutdown.
+        Thread engine only, one thread for all clients. Only parses and enqueues
+        """
+        self.udp_socket.settimeout(1.0)
+        self.datagrams.transport = self.udp_socket
+        while self.running:
+            try:
+                data, address = self.udp_socket.recvfrom(65536)
+            except socket.timeout:
+                continue
+            except OSError:
+                return  # socket closed
+            self.datagrams.receive(data, address)
 
 
 if __name__ == "__main__":
     # init
-    server = Server(2, host="127.0.0.1")
+    engine = "asyncio" if "--asyncio" in sys.argv else "thread"
+    input_log = None
+    if "--log" in sys.argv:
+        input_log = sys.argv[sys.argv.index("--log") + 1]
+    state_file = None
+    if "--state" in sys.argv:
+        state_file = sys.argv[sys.argv.index("--state") + 1]
+    spectate_port = 5051 if "--spectate" in sys.argv else 0
+    server = Server(2, host="127.0.0.1", engine=engine, input_log=input_log,
+                    state_file=state_file, udp="--udp" in sys.argv,
+                    spectate_port=spectate_port)